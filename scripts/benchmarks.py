@@ -0,0 +1,254 @@
+"""
+Benchmarks for the build and routing code, run against real output:
+
+    python benchmarks.py routing web/data/sf.json -n 5000
+    python benchmarks.py output web/data/sf.json
+    python benchmarks.py registry web/data/sf.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from array import array
+
+import city_output
+import landmarks
+import routing_graph
+from bike_router import BikeRouter, random_queries
+from intersection_registry import IntersectionRegistry
+from routing_graph import LINK_DELIMITER
+
+
+#################
+# routing
+#################
+def linear_scan_route(cache, start, goal):
+    """
+    BikeMap.Search.AStarSearch as the map runs it: a linear scan of the open
+    set for the lowest f score, with neighbors and costs worked out from the
+    city data at every step. Only here to compare against.
+    """
+    i_cache = cache['intersections']
+    d_cache = cache['directions']
+    rd_cache = cache['route_directives']
+
+    def coordinates(intersection):
+        return i_cache[intersection]['lat'], i_cache[intersection]['lng'], i_cache[intersection]['elevation']
+
+    def cost(origin, destination):
+        leg = d_cache.get(origin + LINK_DELIMITER + destination)
+        if leg:
+            run_distance = leg['length']
+        else:
+            run_distance = routing_graph.distance_between(*(coordinates(origin)[:2] + coordinates(destination)[:2]))
+        directive = rd_cache.get(origin + LINK_DELIMITER + destination) or \
+            rd_cache.get(destination + LINK_DELIMITER + origin) or 'standard'
+        return routing_graph.edge_cost(run_distance, i_cache[destination]['elevation'] - i_cache[origin]['elevation'],
+                                       routing_graph.DIRECTIVE_CLASSES.index(directive))
+
+    open_set = set([start])
+    closed_set = set()
+    came_from = {}
+    g_scores = {start: 0}
+    f_scores = {start: routing_graph.heuristic(coordinates(start), coordinates(goal))}
+    while open_set:
+        current = min(open_set, key=lambda node: f_scores[node])
+        if current == goal:
+            path = [goal]
+            while path[-1] in came_from:
+                path.append(came_from[path[-1]])
+            return path[::-1], g_scores[goal]
+        open_set.remove(current)
+        closed_set.add(current)
+        for neighbor in routing_graph.get_neighbors(cache, current):
+            if neighbor in closed_set:
+                continue
+            tentative_g_score = g_scores[current] + cost(current, neighbor)
+            if neighbor not in open_set or tentative_g_score <= g_scores[neighbor]:
+                came_from[neighbor] = current
+                g_scores[neighbor] = tentative_g_score
+                f_scores[neighbor] = tentative_g_score + routing_graph.heuristic(coordinates(neighbor),
+                                                                                  coordinates(goal))
+                open_set.add(neighbor)
+    return None
+
+
+def benchmark_routing(args):
+    with open(args.city_file) as city_fp:
+        cache = json.load(city_fp)
+
+    start = time.time()
+    graph = routing_graph.build_routing_graph(cache)
+    router = BikeRouter(graph)
+    print 'graph: %d nodes, %d edges, built in %.2f sec' % (len(graph.nodes), len(graph.targets), time.time() - start)
+
+    queries = random_queries(graph, args.queries, args.seed)
+    start = time.time()
+    routes = [route for _, route, _ in router.route_many(queries)]
+    elapsed = time.time() - start
+    print 'heap A*: %d queries in %.2f sec, %.1f queries/sec, %d without a route' % \
+        (len(queries), elapsed, len(queries) / elapsed, routes.count(None))
+
+    if args.landmarks:
+        start = time.time()
+        router.landmarks = landmarks.compute_landmarks(graph, args.landmarks)
+        print '%d landmarks computed in %.2f sec' % (len(router.landmarks.landmark_ids), time.time() - start)
+        start = time.time()
+        alt_routes = [route for _, route, _ in router.route_many(queries)]
+        elapsed = time.time() - start
+        mismatches = sum(1 for route, alt_route in zip(routes, alt_routes)
+                         if (route is None) != (alt_route is None) or
+                         (route is not None and abs(route['cost'] - alt_route['cost']) > 1e-6 * max(1.0, route['cost'])))
+        print 'ALT: %d queries in %.2f sec, %.1f queries/sec, %d cost mismatches' % \
+            (len(queries), elapsed, len(queries) / elapsed, mismatches)
+        router.landmarks = None
+
+    if args.baseline:
+        baseline_queries = queries[:args.baseline]
+        start = time.time()
+        mismatches = 0
+        for (origin, destination), route in zip(baseline_queries, routes):
+            baseline = linear_scan_route(cache, origin, destination)
+            if (baseline is None) != (route is None) or \
+                    (baseline is not None and abs(baseline[1] - route['cost']) > 1e-6 * max(1.0, route['cost'])):
+                mismatches += 1
+        elapsed = time.time() - start
+        print 'linear scan A*: %d queries in %.2f sec, %.1f queries/sec, %d cost mismatches' % \
+            (len(baseline_queries), elapsed, len(baseline_queries) / elapsed, mismatches)
+
+
+#################
+# output
+#################
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_output_case(case, city_file, scratch_dir, results):
+    """
+    Run one output case in this (fresh) process, and put its time and peak
+    memory on results.
+    """
+    before = peak_memory_mb()
+    start = time.time()
+    if case == 'json.load':
+        with open(city_file) as city_fp:
+            json.load(city_fp)
+    elif case == 'load intersections':
+        city_output.load_city_sections(city_file, ['intersections'])
+    elif case == 'load for a build':
+        city_output.load_city_sections(city_file, skip=('route_directives', 'custom_path_names', 'tbds'))
+    else:
+        with open(city_file) as city_fp:
+            cache = json.load(city_fp)
+        before = peak_memory_mb()
+        start = time.time()
+        output_file = os.path.join(scratch_dir, 'city.json')
+        if case == 'json.dump twice':
+            with open(output_file, 'w') as result_file:
+                json.dump(cache, result_file, indent=2, separators=(',', ': '), sort_keys=True)
+            with open(city_output.minified_path(output_file), 'w') as min_result_file:
+                json.dump(cache, min_result_file, sort_keys=True)
+        else:
+            city_output.write_city_json(cache, output_file)
+    results.put((case, time.time() - start, peak_memory_mb() - before))
+
+
+def benchmark_output(args):
+    scratch_dir = tempfile.mkdtemp()
+    try:
+        # the section loader needs the index next to the city
+        city_file = os.path.join(scratch_dir, 'source.json')
+        with open(args.city_file) as city_fp:
+            city_output.write_city_json(json.load(city_fp), city_file)
+
+        print 'peak memory is over what the process held before the case started'
+        for case in ['json.load', 'load intersections', 'load for a build', 'json.dump twice', 'streaming writer']:
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_output_case, args=(case, city_file, scratch_dir, results))
+            process.start()
+            case, elapsed, peak = results.get()
+            process.join()
+            print '%s: %.2f sec, %.1f MB peak' % (case, elapsed, peak)
+    finally:
+        shutil.rmtree(scratch_dir)
+
+
+#################
+# registry
+#################
+def deep_size(value, seen=None):
+    """
+    Return the bytes held by value and everything it refers to, counting
+    each object once.
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key, seen) + deep_size(item, seen) for key, item in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in value)
+    elif isinstance(value, IntersectionRegistry):
+        size += sum(deep_size(getattr(value, column), seen) for column in ['names', 'ids', 'lat', 'lng', 'elevation'])
+    elif isinstance(value, array):
+        # getsizeof already counts an array's buffer
+        pass
+    return size
+
+
+def benchmark_registry(args):
+    cache = city_output.load_city_sections(args.city_file, ['intersections', 'paths'])
+    i_cache = cache['intersections']
+    p_cache = cache['paths']
+    dict_size = deep_size([i_cache, p_cache])
+
+    start = time.time()
+    registry = IntersectionRegistry.from_json(i_cache)
+    registry.share_path_names(p_cache)
+    elapsed = time.time() - start
+    del i_cache
+    registry_size = deep_size([registry, p_cache])
+    print '%d intersections, %d paths' % (len(registry), len(p_cache))
+    print 'dict of dicts: %.1f MB' % (dict_size / 1048576.0)
+    print 'registry: %.1f MB (%.0f%%), built in %.2f sec' % \
+        (registry_size / 1048576.0, 100.0 * registry_size / dict_size, elapsed)
+
+    start = time.time()
+    registry.to_json()
+    print 'back to JSON form in %.2f sec' % (time.time() - start)
+
+
+parser = argparse.ArgumentParser(description='Benchmarks for the build and routing code.')
+subparsers = parser.add_subparsers()
+
+routing_parser = subparsers.add_parser('routing', help='routing throughput over random queries')
+routing_parser.add_argument('city_file', help='city output (i.e. web/data/sf.json)')
+routing_parser.add_argument('-n', '--queries', type=int, default=1000, help='number of random queries')
+routing_parser.add_argument('--seed', type=int, default=0, help='random seed for the queries')
+routing_parser.add_argument('--landmarks', type=int, default=0, metavar='K',
+                            help='also compute K ALT landmarks and run the queries with them')
+routing_parser.add_argument('--baseline', type=int, default=0, metavar='N',
+                            help="also run the first N queries the way the map's search does, and compare costs")
+routing_parser.set_defaults(func=benchmark_routing)
+
+output_parser = subparsers.add_parser('output', help='time and peak memory of writing and loading city JSON')
+output_parser.add_argument('city_file', help='city output (i.e. web/data/sf.json)')
+output_parser.set_defaults(func=benchmark_output)
+
+registry_parser = subparsers.add_parser('registry', help='memory of the intersection registry against the dict of dicts')
+registry_parser.add_argument('city_file', help='city output (i.e. web/data/sf.json)')
+registry_parser.set_defaults(func=benchmark_registry)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,228 @@
+"""
+Routes between intersections over the scraper output, for offline analysis
+and for serving routes without the browser.
+
+The search is A* with a binary heap, over the RoutingGraph built from the
+city (or read from the -graph.json the build writes next to it). Costs and
+the heuristic are the map's own (CostFunction and AStarHeuristic in
+web/js/bikemap.js), so a route here costs the same as the map's search.
+With ALT landmarks (see landmarks.py) the heuristic is the larger of
+AStarHeuristic and the landmark bound, which settles far fewer
+intersections and finds the same costs.
+
+Usage:
+    python bike_router.py web/data/sf.json queries.txt routes.json
+
+where queries.txt holds one "origin | destination" per line, i.e.
+"Fell St and Baker St | Page St and Scott St". Each route is written as a
+line of JSON.
+"""
+import argparse
+import heapq
+import json
+import math
+import os.path
+import random
+import sys
+
+import landmarks
+import routing_graph
+from routing_graph import EARTH_RADIUS, LINK_DELIMITER
+
+
+class RoutingException(Exception):
+    def __init__(self, *args):
+        self.args = args
+    def __str__(self):
+        return repr(self.args)
+
+
+class UnknownIntersectionException(RoutingException):
+    pass
+
+
+class BikeRouter(object):
+    def __init__(self, graph, landmarks=None):
+        self.graph = graph
+        self.landmarks = landmarks
+        # Plain lists index much faster than numpy arrays, one item at a time.
+        self.offsets = graph.offsets.tolist()
+        self.targets = graph.targets.tolist()
+        self.costs = graph.cost.tolist()
+        self.lengths = graph.length.tolist()
+        self.elevations = graph.elevation.tolist()
+        self.lat_radians = [math.radians(lat) for lat in graph.lat.tolist()]
+        self.lng_radians = [math.radians(lng) for lng in graph.lng.tolist()]
+        self.cos_lats = [math.cos(lat) for lat in self.lat_radians]
+
+    @classmethod
+    def from_city_file(cls, city_file):
+        """
+        Load the router for a city's output, using the routing graph and
+        landmarks written next to it when there are any.
+        """
+        base = os.path.splitext(city_file)[0]
+        if os.path.exists(base + '-graph.json'):
+            with open(base + '-graph.json') as graph_fp:
+                graph = routing_graph.read_routing_graph(graph_fp)
+        else:
+            with open(city_file) as city_fp:
+                graph = routing_graph.build_routing_graph(json.load(city_fp))
+
+        city_landmarks = None
+        if os.path.exists(base + '-landmarks.bin'):
+            with open(base + '-landmarks.bin', 'rb') as landmarks_fp:
+                city_landmarks = landmarks.read_landmarks(landmarks_fp, graph)
+        return cls(graph, city_landmarks)
+
+    def node_id(self, intersection):
+        try:
+            return self.graph.index[intersection]
+        except KeyError:
+            raise UnknownIntersectionException('Unknown intersection', intersection)
+
+    def route(self, origin, destination):
+        """
+        Return the cheapest route from origin to destination, as a dict of
+        its 'path' (intersection names), 'cost' and 'length' in meters, or
+        None if there is no route.
+        """
+        start = self.node_id(origin)
+        goal = self.node_id(destination)
+
+        offsets = self.offsets
+        targets = self.targets
+        costs = self.costs
+        elevations = self.elevations
+        lat_radians = self.lat_radians
+        lng_radians = self.lng_radians
+        cos_lats = self.cos_lats
+        goal_lat = lat_radians[goal]
+        goal_lng = lng_radians[goal]
+        goal_cos_lat = cos_lats[goal]
+        goal_elevation = elevations[goal]
+        sin = math.sin
+        sqrt = math.sqrt
+        lower_bound = self.landmarks.lower_bound(start, goal) if self.landmarks is not None else None
+
+        def heuristic(node):
+            # routing_graph.heuristic, inlined
+            a = sin((goal_lat - lat_radians[node]) / 2) ** 2 + \
+                cos_lats[node] * goal_cos_lat * sin((goal_lng - lng_radians[node]) / 2) ** 2
+            run_distance = 2 * EARTH_RADIUS * math.asin(sqrt(a if a < 1.0 else 1.0))
+            elevation_diff = goal_elevation - elevations[node]
+            if elevation_diff < 0:
+                run_distance = sqrt(run_distance * run_distance + elevation_diff * elevation_diff)
+            if lower_bound is not None:
+                landmark_bound = lower_bound(node)
+                if landmark_bound > run_distance:
+                    return landmark_bound
+            return run_distance
+
+        g_scores = {start: 0.0}
+        f_scores = {start: heuristic(start)}
+        came_from = {}
+        closed_set = set()
+        # (f score, insertion order, node); the order keeps ties first in, first out
+        open_heap = [(f_scores[start], 0, start)]
+        pushes = 1
+
+        while open_heap:
+            f_score, _, current = heapq.heappop(open_heap)
+            if current in closed_set or f_score > f_scores[current]:
+                continue
+            if current == goal:
+                return self.reconstruct_route(came_from, goal)
+            closed_set.add(current)
+
+            current_g_score = g_scores[current]
+            for edge in xrange(offsets[current], offsets[current + 1]):
+                neighbor = targets[edge]
+                if neighbor in closed_set:
+                    continue
+                tentative_g_score = current_g_score + costs[edge]
+                if neighbor not in g_scores or tentative_g_score <= g_scores[neighbor]:
+                    came_from[neighbor] = (current, edge)
+                    g_scores[neighbor] = tentative_g_score
+                    f_scores[neighbor] = tentative_g_score + heuristic(neighbor)
+                    heapq.heappush(open_heap, (f_scores[neighbor], pushes, neighbor))
+                    pushes += 1
+
+        return None
+
+    def reconstruct_route(self, came_from, node):
+        path = [node]
+        cost = 0.0
+        length = 0.0
+        while node in came_from:
+            node, edge = came_from[node]
+            path.append(node)
+            cost += self.costs[edge]
+            length += self.lengths[edge]
+        path.reverse()
+        return {'path': [self.graph.nodes[node_id] for node_id in path], 'cost': cost, 'length': length}
+
+    def route_many(self, queries):
+        """
+        Given (origin, destination) pairs, yield (query, route, exception)
+        for each in order. A failed query has a None route and the exception
+        it raised; a query with no route has neither.
+        """
+        for query in queries:
+            try:
+                yield query, self.route(*query), None
+            except RoutingException as e:
+                yield query, None, e
+
+
+def random_queries(graph, count, seed):
+    """
+    Return count random (origin, destination) pairs of intersections that
+    have neighbors.
+    """
+    rng = random.Random(seed)
+    connected = [node for node_id, node in enumerate(graph.nodes) if graph.offsets[node_id + 1] > graph.offsets[node_id]]
+    return [(rng.choice(connected), rng.choice(connected)) for _ in range(count)]
+
+
+def read_queries(fp):
+    """
+    Given a file of "origin | destination" lines, yield (origin, destination).
+    """
+    for line in fp:
+        line = line.decode('utf-8').strip() if isinstance(line, str) else line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split(LINK_DELIMITER)
+        if len(parts) != 2:
+            raise RoutingException('Not an "origin | destination" query', line)
+        yield parts[0], parts[1]
+
+
+parser = argparse.ArgumentParser(description='Route between intersections of a built city.')
+parser.add_argument('city_file', help='city output (i.e. web/data/sf.json)')
+parser.add_argument('queries', help='file of "origin | destination" lines, or - for stdin')
+parser.add_argument('output_file', nargs='?', default=None, help='where to write routes (default: stdout)')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    router = BikeRouter.from_city_file(args.city_file)
+
+    queries_fp = sys.stdin if args.queries == '-' else open(args.queries)
+    output_fp = sys.stdout if args.output_file is None else open(args.output_file, 'w')
+    found = 0
+    failed = 0
+    for (origin, destination), route, exception in router.route_many(read_queries(queries_fp)):
+        result = {'origin': origin, 'destination': destination}
+        if exception is not None:
+            result['error'] = str(exception)
+            failed += 1
+        elif route is not None:
+            result.update(route)
+            found += 1
+        output_fp.write(json.dumps(result, sort_keys=True) + '\n')
+
+    if output_fp is not sys.stdout:
+        output_fp.close()
+    print >> sys.stderr, 'routes found: %d, failed queries: %d' % (found, failed)
@@ -0,0 +1,124 @@
+"""
+Build several cities at once, each in its own process, sharing one Google
+API rate limit and one fetch store.
+
+The manifest is a JSON file:
+
+    {
+        "rate_limit": 40,
+        "store": "../bike-elevation-map-data/fetch-store.db",
+        "args": ["--workers", "4"],
+        "cities": [
+            {"input_data": "../bike-elevation-map-data/.../sf.py",
+             "output_file": "web/data/sf.json",
+             "bad_cache": "../bike-elevation-map-data/.../sf-bad-address-cache.txt"},
+            {"input_data": "../bike-elevation-map-data/.../berkeley.py",
+             "output_file": "web/data/berkeley.json",
+             "bad_cache": "../bike-elevation-map-data/.../berkeley-bad-address-cache.txt",
+             "args": ["--incremental"]}
+        ]
+    }
+
+"args" (for every city, then each city's own) are google_maps_scraper.py
+options. The rate limit, in requests per second, is for all the cities
+together, so leave --rate-limit out of them. Each city's output goes to
+OUTPUT_FILE.log, and a summary of every build is printed at the end.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import sys
+import time
+import traceback
+
+import google_maps_scraper
+
+
+def init_worker(rate, next_slot, lock):
+    google_maps_scraper.rate_limiter = google_maps_scraper.SharedRateLimiter(rate, next_slot, lock)
+
+
+def build_city(job):
+    """
+    Build one city, given its scraper args and log file, and return its
+    summary (or its error).
+    """
+    args, log_file = job
+    with open(log_file, 'w') as log_fp:
+        stdout = sys.stdout
+        sys.stdout = log_fp
+        logging.getLogger().addHandler(logging.StreamHandler(log_fp))
+        try:
+            return google_maps_scraper.run_build(args)
+        except Exception:
+            log_fp.write(traceback.format_exc())
+            return {'output_file': args.output_file, 'error': traceback.format_exc().splitlines()[-1]}
+        finally:
+            sys.stdout = stdout
+
+
+def make_jobs(manifest):
+    """
+    Given a manifest, return a (scraper args, log file) job for every city.
+    """
+    jobs = []
+    for city in manifest['cities']:
+        city_args = list(manifest.get('args', [])) + list(city.get('args', []))
+        if manifest.get('store'):
+            city_args += ['--store', manifest['store']]
+        city_args += [city['input_data'], city['output_file'], city['bad_cache']]
+        jobs.append((google_maps_scraper.parser.parse_args(city_args), city['output_file'] + '.log'))
+    return jobs
+
+
+def print_summary(summary):
+    if 'error' in summary:
+        print '%s: FAILED, %s' % (summary['output_file'], summary['error'])
+        return
+    if 'plan' in summary:
+        print '%s: planned %s' % (summary['output_file'], ', '.join(
+            '%d %s' % (count, endpoint) for endpoint, count in sorted(summary['plan']['requests'].iteritems())))
+        return
+    stats = summary['stats']
+    print '%s: %d intersections, %d good, %d cached, %d bad, %d skipped, %d errors, %d deferred in %.0f sec' % \
+        (summary['output_file'], summary['total_intersections'], stats['good'], stats['cached'], stats['bad'],
+         stats['skipped'], stats['error'], stats['deferred'], summary['seconds'])
+    for endpoint, endpoint_stats in sorted(summary['requests'].iteritems()):
+        print '    %s requests: %d, retries: %d, failures: %d' % \
+            (endpoint, endpoint_stats['requests'], endpoint_stats['retries'], endpoint_stats['failures'])
+
+
+parser = argparse.ArgumentParser(description='Build several cities in parallel.')
+parser.add_argument('manifest', help='JSON manifest of the cities to build')
+parser.add_argument('-p', '--processes', type=int, default=None,
+                    help='number of cities to build at once (default: all of them)')
+parser.add_argument('--summary', default=None, help='also write the summaries to this JSON file')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with open(args.manifest) as manifest_fp:
+        manifest = json.load(manifest_fp)
+
+    jobs = make_jobs(manifest)
+    start = time.time()
+    # one process per city, so every build starts from fresh module state
+    # (and at least one, so an empty manifest builds nothing instead of failing)
+    pool = multiprocessing.Pool(processes=args.processes or max(1, len(jobs)), initializer=init_worker,
+                                initargs=(manifest.get('rate_limit'), multiprocessing.Value('d', 0.0),
+                                          multiprocessing.Lock()),
+                                maxtasksperchild=1)
+    summaries = []
+    for summary in pool.imap_unordered(build_city, jobs):
+        print_summary(summary)
+        summaries.append(summary)
+    pool.close()
+    pool.join()
+
+    print 'built %d cities in %.0f sec' % (len(summaries), time.time() - start)
+    if args.summary:
+        with open(args.summary, 'w') as summary_fp:
+            json.dump(sorted(summaries, key=lambda summary: summary['output_file']), summary_fp,
+                      indent=2, separators=(',', ': '), sort_keys=True)
+    sys.exit(1 if any('error' in summary for summary in summaries) else 0)
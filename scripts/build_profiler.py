@@ -0,0 +1,155 @@
+"""
+Where a build spends its time: wall and CPU seconds for each stage, Google
+API request latencies per endpoint, and hits and misses of the caches the
+stages check before fetching anything.
+
+The scraper records into one BuildProfiler, and with --metrics FILE writes
+its report as JSON:
+
+    {
+        "stages": {"sort_path_cache": {"calls": 1, "wall_seconds": 0.2, "cpu_seconds": 0.2}, ...},
+        "requests": {"geocode": {"requests": 2500, "retries": 3, "failures": 0,
+                                 "latency": {"buckets": [0.025, 0.05, ...], "counts": [...],
+                                             "mean": 0.08, "max": 1.2, "p50": 0.05, "p90": 0.1, "p99": 0.5}},
+                     ...},
+        "caches": {"intersections": {"hits": 9000, "misses": 2500}, ...}
+    }
+
+CPU seconds are the whole process's (every thread's) user and system time
+over the stage, so a stage waiting on the network shows far less CPU time
+than wall time.
+
+With --profile FILE, the build also runs under cProfile and writes its
+stats to FILE, to read with pstats:
+
+    python -c "import pstats; pstats.Stats('build.prof').sort_stats('cumulative').print_stats(30)"
+"""
+import bisect
+import functools
+import os
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets; the last
+# bucket holds everything slower.
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+PERCENTILES = [50, 90, 99]
+
+
+def cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+
+class LatencyHistogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        self.counts[bisect.bisect_left(self.buckets, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, percent):
+        """
+        Return the upper bound of the bucket the given percentile falls in
+        (the slowest latency seen, for the last bucket), or None if there are
+        no latencies.
+        """
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def to_json(self):
+        report = {'buckets': self.buckets, 'counts': self.counts,
+                  'mean': self.total / self.count if self.count else None, 'max': self.max}
+        for percent in PERCENTILES:
+            report['p%d' % percent] = self.percentile(percent)
+        return report
+
+
+class BuildProfiler(object):
+    """
+    Stage timings, request latencies and cache counters for one build. Safe
+    to record into from worker threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.latencies = {}
+            self.caches = {}
+
+    def stage(self, func):
+        """
+        Decorate a pipeline stage, so every call's wall and CPU time is
+        recorded under its name.
+        """
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.time()
+            start_cpu = cpu_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                wall = time.time() - start
+                cpu = cpu_time() - start_cpu
+                self.record_stage(func.__name__, wall, cpu)
+                print '%r %2.2f sec (%2.2f sec cpu)' % (func.__name__, wall, cpu)
+        return timed
+
+    def record_stage(self, name, wall, cpu):
+        with self.lock:
+            stats = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            stats['calls'] += 1
+            stats['wall_seconds'] += wall
+            stats['cpu_seconds'] += cpu
+
+    def record_latency(self, endpoint, latency):
+        with self.lock:
+            if endpoint not in self.latencies:
+                self.latencies[endpoint] = LatencyHistogram()
+            self.latencies[endpoint].add(latency)
+
+    def count(self, cache_name, hit, amount=1):
+        """
+        Count amount lookups in the named cache as hits (or misses).
+        """
+        with self.lock:
+            stats = self.caches.setdefault(cache_name, {'hits': 0, 'misses': 0})
+            stats['hits' if hit else 'misses'] += amount
+
+    def report(self, request_stats=None):
+        """
+        Return the report, as a dict JSON can hold. Given the session's
+        per-endpoint request stats, each endpoint's counts are reported along
+        with its latencies.
+        """
+        with self.lock:
+            requests = {}
+            for endpoint in set(self.latencies) | set(request_stats or {}):
+                endpoint_stats = (request_stats or {}).get(endpoint, {})
+                requests[endpoint] = {
+                    'requests': endpoint_stats.get('requests', 0),
+                    'retries': endpoint_stats.get('retries', 0),
+                    'failures': endpoint_stats.get('failures', 0),
+                    'latency': self.latencies.get(endpoint, LatencyHistogram()).to_json(),
+                }
+            return {'stages': dict((name, dict(stats)) for name, stats in self.stages.iteritems()),
+                    'requests': requests,
+                    'caches': dict((name, dict(stats)) for name, stats in self.caches.iteritems())}
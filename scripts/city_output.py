@@ -0,0 +1,635 @@
+"""
+Writers (and readers) for the city data the scraper builds.
+
+JSON output
+-----------
+sf.json (indented) and sf-min.json are written together in one pass over
+the cache, byte for byte what json.dump gives for each, along with
+sf-index.json: the byte offsets of every top-level section's value in both
+files, and their sizes. A loader that wants only some sections seeks to
+them and parses just those bytes.
+
+Compact format
+--------------
+A string table plus integer-id columns, for clients that want to download
+and parse far fewer bytes than sf.json. Everything is little-endian, and
+every array starts on an 8 byte boundary so it can be read in place as a
+typed array.
+
+    magic 'TBMC', uint32 version
+    strings:        uint32 count, uint32 offsets[count + 1], utf-8 bytes
+    intersections:  uint32 count, float64 lat[count], float64 lng[count],
+                    float64 elevation[count]
+    paths:          uint32 count, uint32 name[count], uint32 offsets[count + 1],
+                    int32 members[offsets[count]]
+    custom paths:   uint32 count, uint32 name[count]
+    directions:     uint32 count, uint32 origin[count], uint32 destination[count],
+                    uint32 path[count], float64 length[count]
+    directives:     uint32 count, uint32 origin[count], uint32 destination[count],
+                    uint32 type[count]
+    tbds:           uint32 count, uint32 name[count], float64 lat[count],
+                    float64 lng[count]
+    build time:     int64 timestamp, uint32 readable
+    extra:          uint32 string holding any other keys, as JSON
+
+The first strings in the table are the intersection names, in intersection
+order, so intersection i is named by string i. Path members are string ids,
+with -1 for a '--BREAK'. Directions and route directive keys ('A | B') are
+stored as their origin and destination. NONE marks a missing string, and a
+NaN length a missing number (i.e. a failed directions lookup).
+
+Tiled output
+------------
+The same city split into slippy map tiles (the z/x/y scheme Google Maps
+uses) at a single zoom, so a client only fetches the tiles in its viewport:
+
+    sf-tiles/manifest.json
+    sf-tiles/<zoom>/<x>/<y>.json
+
+The manifest holds the zoom, the bounding box of the whole city, the city
+wide keys (custom_path_names, tbds, build time) and, for every tile that has
+anything in it, its bounds and the bounding box of what it holds. A tile
+holds the path segments (pairs of neighbouring intersections) that cross it,
+as runs of intersections per path, along with every intersection those runs
+touch and the directions and route directives of their segments. A segment
+is in every tile its bounding box (including any directions polyline)
+overlaps, so drawing the tiles in the viewport draws everything in it.
+"""
+import collections
+import errno
+import json
+import math
+import os
+import struct
+
+import numpy
+
+from polyline import decode_polyline
+
+COMPACT_MAGIC = 'TBMC'
+COMPACT_VERSION = 1
+
+NONE = 0xFFFFFFFF
+BREAK = '--BREAK'
+LINK_DELIMITER = ' | '
+
+KNOWN_KEYS = ['intersections', 'paths', 'custom_path_names', 'directions', 'route_directives', 'tbds',
+              'buildtimestamp', 'buildtimereadable']
+
+
+####################
+# streaming JSON output
+####################
+INDEX_SUFFIX = '-index.json'
+
+PRETTY_ENCODER = json.JSONEncoder(indent=2, separators=(',', ': '), sort_keys=True)
+MINIFIED_ENCODER = json.JSONEncoder(sort_keys=True)
+
+
+def minified_path(output_file):
+    return '-min.'.join(output_file.split('.', 1))
+
+
+def index_path(output_file):
+    return os.path.splitext(output_file)[0] + INDEX_SUFFIX
+
+
+class CountingWriter(object):
+    """
+    A file wrapper that keeps count of the bytes written through it.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.position = 0
+
+    def write(self, chunk):
+        self.fp.write(chunk)
+        self.position += len(chunk)
+
+
+def write_encoded(out, encoder, value, indent=''):
+    """
+    Write value's JSON to out, nested under indent (json's own indentation
+    starts from the left margin; strings never hold a raw newline). One
+    entry at a time is small, so it is encoded whole and written at once,
+    far faster than writing iterencode's many tiny chunks.
+    """
+    encoded = encoder.encode(value)
+    out.write(encoded.replace('\n', '\n' + indent) if indent else encoded)
+
+
+def write_city_json(cache, output_file):
+    """
+    Write the cache to output_file, indented, and to its minified twin, the
+    same as json.dump(cache, fp, indent=2, separators=(',', ': '),
+    sort_keys=True) and json.dump(cache, fp, sort_keys=True) would, along
+    with the section index. Sections and their entries are encoded one at a
+    time, straight to both files. Keys must be strings; a section may be
+    any mapping (like the intersection registry), not just a dict.
+    """
+    files = [output_file, minified_path(output_file)]
+    index = dict((os.path.basename(path), {'sections': {}}) for path in files)
+    with open(files[0], 'w') as pretty_fp, open(files[1], 'w') as minified_fp:
+        pretty = CountingWriter(pretty_fp)
+        minified = CountingWriter(minified_fp)
+        if not cache:
+            pretty.write('{}')
+            minified.write('{}')
+
+        for position, section in enumerate(sorted(cache)):
+            key = PRETTY_ENCODER.encode(section)
+            pretty.write(('{' if position == 0 else ',') + '\n  ' + key + ': ')
+            minified.write(('{' if position == 0 else ', ') + key + ': ')
+            starts = [pretty.position, minified.position]
+
+            value = cache[section]
+            if isinstance(value, collections.Mapping) and not value:
+                value = {}
+            if isinstance(value, collections.Mapping) and value:
+                for entry_position, entry in enumerate(sorted(value)):
+                    entry_key = PRETTY_ENCODER.encode(entry)
+                    pretty.write(('{' if entry_position == 0 else ',') + '\n    ' + entry_key + ': ')
+                    minified.write(('{' if entry_position == 0 else ', ') + entry_key + ': ')
+                    write_encoded(pretty, PRETTY_ENCODER, value[entry], '    ')
+                    write_encoded(minified, MINIFIED_ENCODER, value[entry])
+                pretty.write('\n  }')
+                minified.write('}')
+            else:
+                write_encoded(pretty, PRETTY_ENCODER, value, '  ')
+                write_encoded(minified, MINIFIED_ENCODER, value)
+
+            for path, out, start in zip(files, [pretty, minified], starts):
+                index[os.path.basename(path)]['sections'][section] = [start, out.position]
+
+        if cache:
+            pretty.write('\n}')
+            minified.write('}')
+
+    for path, out in zip(files, [pretty, minified]):
+        index[os.path.basename(path)]['size'] = out.position
+    with open(index_path(output_file), 'w') as index_fp:
+        json.dump(index, index_fp, sort_keys=True)
+
+
+def read_section_index(output_file, index_file=None):
+    """
+    Return the section offsets of output_file from its index, or None if
+    there is no index for it or the file has changed since.
+    """
+    index_file = index_file or index_path(output_file)
+    if not os.path.exists(index_file) or not os.path.exists(output_file):
+        return None
+    with open(index_file) as index_fp:
+        entry = json.load(index_fp).get(os.path.basename(output_file))
+    if entry is None or entry['size'] != os.path.getsize(output_file):
+        return None
+    return entry['sections']
+
+
+def load_city_sections(output_file, sections=None, skip=(), index_file=None):
+    """
+    Load the city written to output_file, or just the named top-level
+    sections of it, leaving out any in skip. With a section index that
+    matches the file, only the wanted sections' bytes are read and parsed.
+    """
+    def wanted(section):
+        return (sections is None or section in sections) and section not in skip
+
+    offsets = read_section_index(output_file, index_file)
+    if offsets is None:
+        with open(output_file) as city_fp:
+            cache = json.load(city_fp)
+        return dict((section, value) for section, value in cache.iteritems() if wanted(section))
+
+    cache = {}
+    with open(output_file, 'rb') as city_fp:
+        for section, (start, end) in sorted(offsets.iteritems(), key=lambda item: item[1][0]):
+            if wanted(section):
+                city_fp.seek(start)
+                cache[section] = json.loads(city_fp.read(end - start))
+    return cache
+
+
+####################
+# compact format writer
+####################
+class StringTable(object):
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def add(self, string):
+        if string is None:
+            return NONE
+        string_id = self.ids.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(string)
+            self.ids[string] = string_id
+        return string_id
+
+
+def split_link(link):
+    """
+    Given a directions or route directive key ("A and B | A and C"), return
+    its origin and destination.
+    """
+    parts = link.split(LINK_DELIMITER)
+    if len(parts) != 2:
+        raise ValueError('not an "origin | destination" key: %r' % link)
+    return parts
+
+
+def encode_compact_city(cache):
+    """
+    Given a city cache, as written to sf.json, return it in the compact format.
+    """
+    strings = StringTable()
+    intersections = sorted(cache.get('intersections', {}))
+    for intersection in intersections:
+        strings.add(intersection)
+
+    i_cache = cache.get('intersections', {})
+    sections = []
+
+    sections.append(uint32(len(intersections)))
+    for column in ('lat', 'lng', 'elevation'):
+        sections.append(numpy.array([i_cache[name][column] for name in intersections], dtype='<f8'))
+
+    paths = sorted(cache.get('paths', {}))
+    members = []
+    offsets = [0]
+    for path in paths:
+        members.extend(-1 if intersection == BREAK else strings.add(intersection)
+                       for intersection in cache['paths'][path])
+        offsets.append(len(members))
+    sections.append(uint32(len(paths)))
+    sections.append(numpy.array([strings.add(path) for path in paths], dtype='<u4'))
+    sections.append(numpy.array(offsets, dtype='<u4'))
+    sections.append(numpy.array(members, dtype='<i4'))
+
+    custom_path_names = cache.get('custom_path_names', [])
+    sections.append(uint32(len(custom_path_names)))
+    sections.append(numpy.array([strings.add(path) for path in custom_path_names], dtype='<u4'))
+
+    directions = sorted(cache.get('directions', {}).iteritems())
+    sections.append(uint32(len(directions)))
+    links = [split_link(link) for link, _ in directions]
+    sections.append(numpy.array([strings.add(origin) for origin, _ in links], dtype='<u4'))
+    sections.append(numpy.array([strings.add(destination) for _, destination in links], dtype='<u4'))
+    sections.append(numpy.array([strings.add(leg['path'] if leg else None) for _, leg in directions], dtype='<u4'))
+    sections.append(numpy.array([leg['length'] if leg and leg.get('length') is not None else numpy.nan
+                                 for _, leg in directions], dtype='<f8'))
+
+    directives = sorted(cache.get('route_directives', {}).iteritems())
+    sections.append(uint32(len(directives)))
+    links = [split_link(link) for link, _ in directives]
+    sections.append(numpy.array([strings.add(origin) for origin, _ in links], dtype='<u4'))
+    sections.append(numpy.array([strings.add(destination) for _, destination in links], dtype='<u4'))
+    sections.append(numpy.array([strings.add(directive) for _, directive in directives], dtype='<u4'))
+
+    tbds = sorted(cache.get('tbds', {}).iteritems())
+    sections.append(uint32(len(tbds)))
+    sections.append(numpy.array([strings.add(tbd) for tbd, _ in tbds], dtype='<u4'))
+    sections.append(numpy.array([latlng['lat'] for _, latlng in tbds], dtype='<f8'))
+    sections.append(numpy.array([latlng['lng'] for _, latlng in tbds], dtype='<f8'))
+
+    sections.append(numpy.array([cache.get('buildtimestamp', -1)], dtype='<i8'))
+    sections.append(uint32(strings.add(cache.get('buildtimereadable'))))
+
+    extra = dict((key, value) for key, value in cache.iteritems() if key not in KNOWN_KEYS)
+    sections.append(uint32(strings.add(json.dumps(extra, sort_keys=True) if extra else None)))
+
+    encoded = [to_utf8(string) for string in strings.strings]
+    string_offsets = numpy.cumsum([0] + [len(string) for string in encoded])
+
+    out = Buffer()
+    out.write(COMPACT_MAGIC)
+    out.write(struct.pack('<I', COMPACT_VERSION))
+    out.write_array(uint32(len(encoded)))
+    out.write_array(numpy.array(string_offsets, dtype='<u4'))
+    out.write_array(numpy.frombuffer(''.join(encoded), dtype='u1'))
+    for section in sections:
+        out.write_array(section)
+    return out.getvalue()
+
+
+def write_compact_city(fp, cache):
+    fp.write(encode_compact_city(cache))
+
+
+def uint32(value):
+    return numpy.array([value], dtype='<u4')
+
+
+def to_utf8(string):
+    return string.encode('utf-8') if isinstance(string, unicode) else string
+
+
+class Buffer(object):
+    """
+    A byte buffer that starts every array on an 8 byte boundary.
+    """
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.length += len(data)
+
+    def write_array(self, array):
+        if self.length % 8:
+            self.write('\0' * (8 - self.length % 8))
+        self.write(array.tostring())
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
+####################
+# tiled output
+####################
+TILE_MANIFEST = 'manifest.json'
+TILE_PATH = '{z}/{x}/{y}.json'
+
+
+def lat_lng_to_tile(lat, lng, zoom):
+    """
+    Given a point, return the (x, y) of the slippy map tile holding it at zoom.
+    """
+    n = 2 ** zoom
+    lat_rad = math.radians(lat)
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(x, y, zoom):
+    """
+    Given a tile, return its [south, west, north, east] bounds.
+    """
+    n = 2.0 ** zoom
+
+    def tile_lat(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return [tile_lat(y + 1), x / n * 360.0 - 180.0, tile_lat(y), (x + 1) / n * 360.0 - 180.0]
+
+
+def extend_bbox(bbox, points):
+    for lat, lng in points:
+        if bbox is None:
+            bbox = [lat, lng, lat, lng]
+        else:
+            bbox = [min(bbox[0], lat), min(bbox[1], lng), max(bbox[2], lat), max(bbox[3], lng)]
+    return bbox
+
+
+def segment_link(cache_key, origin, destination):
+    """
+    Given a directions or route_directives dict, return the key it holds for
+    the segment between origin and destination, in either order, or None.
+    """
+    for link in (origin + LINK_DELIMITER + destination, destination + LINK_DELIMITER + origin):
+        if link in cache_key:
+            return link
+    return None
+
+
+def partition_city_tiles(cache, zoom):
+    """
+    Given a city cache, return (manifest, tiles), where tiles maps (x, y) to
+    that tile's data.
+    """
+    i_cache = cache.get('intersections', {})
+    directions = cache.get('directions', {})
+    route_directives = cache.get('route_directives', {})
+
+    tiles = {}
+    segment_counts = {}
+    bboxes = {}
+
+    def get_tile(tile):
+        if tile not in tiles:
+            tiles[tile] = {'intersections': {}, 'paths': {}, 'directions': {}, 'route_directives': {}}
+            segment_counts[tile] = 0
+        return tiles[tile]
+
+    def point(intersection):
+        return i_cache[intersection]['lat'], i_cache[intersection]['lng']
+
+    # Every intersection is in the tile it sits in, even if no segment is.
+    for intersection in i_cache:
+        tile = lat_lng_to_tile(i_cache[intersection]['lat'], i_cache[intersection]['lng'], zoom)
+        get_tile(tile)['intersections'][intersection] = i_cache[intersection]
+        bboxes[tile] = extend_bbox(bboxes.get(tile), [point(intersection)])
+
+    for path, intersections in cache.get('paths', {}).iteritems():
+        # (tile -> index of the last intersection in that tile's current run)
+        run_ends = {}
+        for index in range(len(intersections) - 1):
+            origin = intersections[index]
+            destination = intersections[index + 1]
+            if BREAK in (origin, destination) or origin not in i_cache or destination not in i_cache:
+                continue
+
+            points = [point(origin), point(destination)]
+            directions_link = segment_link(directions, origin, destination)
+            if directions_link is not None and directions[directions_link]:
+                points.extend(decode_polyline(directions[directions_link]['path']))
+            directive_link = segment_link(route_directives, origin, destination)
+
+            bbox = extend_bbox(None, points)
+            west, north = lat_lng_to_tile(bbox[2], bbox[1], zoom)
+            east, south = lat_lng_to_tile(bbox[0], bbox[3], zoom)
+            for x in range(west, east + 1):
+                for y in range(north, south + 1):
+                    tile = (x, y)
+                    tile_data = get_tile(tile)
+                    runs = tile_data['paths'].setdefault(path, [])
+                    if run_ends.get(tile) == index:
+                        runs[-1].append(destination)
+                    else:
+                        runs.append([origin, destination])
+                    run_ends[tile] = index + 1
+
+                    tile_data['intersections'][origin] = i_cache[origin]
+                    tile_data['intersections'][destination] = i_cache[destination]
+                    if directions_link is not None:
+                        tile_data['directions'][directions_link] = directions[directions_link]
+                    if directive_link is not None:
+                        tile_data['route_directives'][directive_link] = route_directives[directive_link]
+                    segment_counts[tile] += 1
+                    bboxes[tile] = extend_bbox(bboxes.get(tile), points)
+
+    manifest = {
+        'zoom': zoom,
+        'tile_path': TILE_PATH,
+        'bbox': extend_bbox(None, [point(intersection) for intersection in i_cache]),
+        'tiles': {},
+    }
+    for key in ('custom_path_names', 'tbds', 'buildtimestamp', 'buildtimereadable'):
+        if key in cache:
+            manifest[key] = cache[key]
+    for (x, y), tile_data in tiles.iteritems():
+        manifest['tiles']['%d/%d' % (x, y)] = {
+            'bounds': tile_bounds(x, y, zoom),
+            'bbox': bboxes[(x, y)],
+            'intersections': len(tile_data['intersections']),
+            'segments': segment_counts[(x, y)],
+        }
+    return manifest, tiles
+
+
+def write_tiled_city(directory, cache, zoom):
+    """
+    Write a city cache as tiles at zoom under directory, removing any tiles
+    left at that zoom from an earlier build. Returns the number of tiles.
+    """
+    manifest, tiles = partition_city_tiles(cache, zoom)
+
+    written = set()
+    for (x, y), tile_data in tiles.iteritems():
+        tile_file = os.path.join(directory, TILE_PATH.format(z=zoom, x=x, y=y))
+        make_dirs(os.path.dirname(tile_file))
+        with open(tile_file, 'w') as tile_fp:
+            json.dump(tile_data, tile_fp, sort_keys=True)
+        written.add(os.path.abspath(tile_file))
+
+    for root, _, files in os.walk(os.path.join(directory, str(zoom))):
+        for name in files:
+            tile_file = os.path.abspath(os.path.join(root, name))
+            if name.endswith('.json') and tile_file not in written:
+                os.remove(tile_file)
+
+    with open(os.path.join(directory, TILE_MANIFEST), 'w') as manifest_fp:
+        json.dump(manifest, manifest_fp, sort_keys=True)
+    return len(tiles)
+
+
+def make_dirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+####################
+# compact format reader
+####################
+class Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, length):
+        chunk = self.data[self.position:self.position + length]
+        self.position += length
+        return chunk
+
+    def read_array(self, dtype, count):
+        if self.position % 8:
+            self.position += 8 - self.position % 8
+        dtype = numpy.dtype(dtype)
+        array = numpy.frombuffer(self.data, dtype=dtype, count=count, offset=self.position)
+        self.position += dtype.itemsize * count
+        return array
+
+    def read_uint32(self):
+        return int(self.read_array('<u4', 1)[0])
+
+
+def decode_compact_city(data):
+    """
+    Given data in the compact format, return the city cache it holds, the
+    same as json.load would give for sf.json.
+    """
+    reader = Reader(data)
+    if reader.read(4) != COMPACT_MAGIC:
+        raise ValueError('not a compact city file')
+    version = struct.unpack('<I', reader.read(4))[0]
+    if version != COMPACT_VERSION:
+        raise ValueError('unsupported compact city version: %d' % version)
+
+    string_count = reader.read_uint32()
+    string_offsets = reader.read_array('<u4', string_count + 1)
+    blob = reader.read_array('u1', int(string_offsets[-1])).tostring()
+    strings = [blob[string_offsets[index]:string_offsets[index + 1]].decode('utf-8')
+               for index in range(string_count)]
+
+    def string(string_id):
+        return None if string_id == NONE else strings[string_id]
+
+    def number(value):
+        return int(value) if value == int(value) else float(value)
+
+    cache = {}
+
+    count = reader.read_uint32()
+    lats = reader.read_array('<f8', count)
+    lngs = reader.read_array('<f8', count)
+    elevations = reader.read_array('<f8', count)
+    cache['intersections'] = dict(
+        (strings[index], {'lat': float(lats[index]), 'lng': float(lngs[index]), 'elevation': float(elevations[index])})
+        for index in range(count))
+
+    count = reader.read_uint32()
+    names = reader.read_array('<u4', count)
+    offsets = reader.read_array('<u4', count + 1)
+    members = reader.read_array('<i4', int(offsets[-1]))
+    cache['paths'] = dict(
+        (strings[names[index]], [BREAK if member == -1 else strings[member]
+                                 for member in members[offsets[index]:offsets[index + 1]]])
+        for index in range(count))
+
+    count = reader.read_uint32()
+    cache['custom_path_names'] = [strings[name] for name in reader.read_array('<u4', count)]
+
+    count = reader.read_uint32()
+    origins = reader.read_array('<u4', count)
+    destinations = reader.read_array('<u4', count)
+    polylines = reader.read_array('<u4', count)
+    lengths = reader.read_array('<f8', count)
+    cache['directions'] = {}
+    for index in range(count):
+        link = strings[origins[index]] + LINK_DELIMITER + strings[destinations[index]]
+        if polylines[index] == NONE:
+            cache['directions'][link] = None
+        else:
+            cache['directions'][link] = {'path': strings[polylines[index]],
+                                         'length': None if numpy.isnan(lengths[index]) else number(lengths[index])}
+
+    count = reader.read_uint32()
+    origins = reader.read_array('<u4', count)
+    destinations = reader.read_array('<u4', count)
+    directives = reader.read_array('<u4', count)
+    cache['route_directives'] = dict(
+        (strings[origins[index]] + LINK_DELIMITER + strings[destinations[index]], strings[directives[index]])
+        for index in range(count))
+
+    count = reader.read_uint32()
+    names = reader.read_array('<u4', count)
+    lats = reader.read_array('<f8', count)
+    lngs = reader.read_array('<f8', count)
+    cache['tbds'] = dict((strings[names[index]], {'lat': float(lats[index]), 'lng': float(lngs[index])})
+                         for index in range(count))
+
+    timestamp = int(reader.read_array('<i8', 1)[0])
+    if timestamp != -1:
+        cache['buildtimestamp'] = timestamp
+    readable = string(reader.read_uint32())
+    if readable is not None:
+        cache['buildtimereadable'] = readable
+
+    extra = string(reader.read_uint32())
+    if extra is not None:
+        cache.update(json.loads(extra))
+
+    return cache
+
+
+def read_compact_city(fp):
+    return decode_compact_city(fp.read())
+
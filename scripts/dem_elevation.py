@@ -0,0 +1,272 @@
+"""
+Elevations from local DEM (digital elevation model) tiles, instead of the
+Google Elevation API.
+
+A DEM directory holds SRTM .hgt tiles (named for their south west corner,
+i.e. N37W123.hgt, 1201 or 3601 samples square) and/or uncompressed GeoTIFFs
+(.tif) in lat/lng. Tiles are memory mapped, so only the pages a lookup
+touches are read, and the most recently used few are kept open. Elevations
+for whole arrays of points are bilinearly interpolated at once.
+
+A point no tile covers, or next to a void in one, gets NaN, and is left to
+the API. Compressed GeoTIFFs can't be memory mapped; decompress them first,
+i.e. `gdal_translate -co COMPRESS=NONE in.tif out.tif`.
+
+To sample points, or the points of an encoded directions polyline:
+    python dem_elevation.py ../dem 37.7775,-122.4376 37.7694,-122.4862
+    python dem_elevation.py ../dem --polyline '_zceF~wtjVoK_cB'
+"""
+import collections
+import math
+import os
+import re
+import struct
+
+import numpy
+
+from polyline import decode_polyline
+
+HGT_NAME = re.compile(r'^([NS])(\d{2})([EW])(\d{3})\.hgt$', re.IGNORECASE)
+HGT_VOID = -32768
+
+# How many tiles are kept open at once
+DEFAULT_OPEN_TILES = 8
+
+TIFF_TYPES = {1: ('B', 1), 2: ('c', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1), 8: ('h', 2),
+              9: ('i', 4), 11: ('f', 4), 12: ('d', 8), 16: ('Q', 8)}
+TIFF_DTYPES = {(1, 8): 'u1', (1, 16): 'u2', (1, 32): 'u4', (2, 8): 'i1', (2, 16): 'i2', (2, 32): 'i4',
+               (3, 32): 'f4', (3, 64): 'f8'}
+
+# GTRasterTypeGeoKey, in the GeoKeyDirectory: whether a pixel is an area
+# (the default), or a point, like SRTM samples
+GT_RASTER_TYPE_GEO_KEY = 1025
+RASTER_PIXEL_IS_AREA = 1
+RASTER_PIXEL_IS_POINT = 2
+
+
+class DemException(Exception):
+    def __init__(self, *args):
+        self.args = args
+    def __str__(self):
+        return repr(self.args)
+
+
+class DemTile(object):
+    """
+    One raster of elevations: the header, and its samples once opened.
+    Sample (row, column) is at (north - row * lat_step, west + column *
+    lng_step).
+    """
+    def __init__(self, path, north, west, rows, columns, lat_step, lng_step, dtype, offset=0, nodata=None):
+        self.path = path
+        self.north = north
+        self.west = west
+        self.rows = rows
+        self.columns = columns
+        self.lat_step = lat_step
+        self.lng_step = lng_step
+        self.dtype = dtype
+        self.offset = offset
+        self.nodata = nodata
+        self.samples = None
+
+    @property
+    def south(self):
+        return self.north - (self.rows - 1) * self.lat_step
+
+    @property
+    def east(self):
+        return self.west + (self.columns - 1) * self.lng_step
+
+    def covers(self, lats, lngs):
+        return (lats <= self.north) & (lats >= self.south) & (lngs >= self.west) & (lngs <= self.east)
+
+    def open(self):
+        if self.samples is None:
+            self.samples = numpy.memmap(self.path, dtype=self.dtype, mode='r', offset=self.offset,
+                                        shape=(self.rows, self.columns))
+
+    def close(self):
+        self.samples = None
+
+    def sample(self, lats, lngs):
+        """
+        Return the bilinearly interpolated elevations at points this tile
+        covers, NaN next to voids.
+        """
+        self.open()
+        rows = (self.north - lats) / self.lat_step
+        columns = (lngs - self.west) / self.lng_step
+        top = numpy.clip(numpy.floor(rows).astype(numpy.intp), 0, self.rows - 2)
+        left = numpy.clip(numpy.floor(columns).astype(numpy.intp), 0, self.columns - 2)
+        down = rows - top
+        right = columns - left
+
+        corners = [self.samples[top + row, left + column].astype(numpy.float64) for row in (0, 1) for column in (0, 1)]
+        elevations = corners[0] * (1 - down) * (1 - right) + corners[1] * (1 - down) * right + \
+            corners[2] * down * (1 - right) + corners[3] * down * right
+        if self.nodata is not None:
+            void = numpy.zeros(len(elevations), dtype=bool)
+            for corner in corners:
+                void |= corner == self.nodata
+            elevations[void] = numpy.nan
+        return elevations
+
+
+def read_hgt_header(path):
+    match = HGT_NAME.match(os.path.basename(path))
+    if match is None:
+        raise DemException('Not an SRTM tile name', path)
+    south = int(match.group(2)) * (1 if match.group(1).upper() == 'N' else -1)
+    west = int(match.group(4)) * (1 if match.group(3).upper() == 'E' else -1)
+    size = int(round(math.sqrt(os.path.getsize(path) / 2)))
+    if size * size * 2 != os.path.getsize(path):
+        raise DemException('Not a square SRTM tile', path)
+    step = 1.0 / (size - 1)
+    return DemTile(path, south + 1, west, size, size, step, step, '>i2', nodata=HGT_VOID)
+
+
+def read_geo_keys(directory):
+    """
+    Given the GeoKeyDirectory tag's shorts, return a dict of each geo key
+    held in it to its value. Keys held in other tags are left out.
+    """
+    keys = {}
+    if len(directory) < 4:
+        return keys
+    for index in range(directory[3]):
+        key, location, count, value = directory[4 + index * 4:8 + index * 4]
+        if location == 0 and count == 1:
+            keys[key] = value
+    return keys
+
+
+def read_tiff_header(path):
+    """
+    Read the DemTile of a single band, uncompressed GeoTIFF in lat/lng,
+    whose samples are stored contiguously.
+    """
+    with open(path, 'rb') as tiff_fp:
+        data = tiff_fp.read(65536)
+        byte_order = {'II': '<', 'MM': '>'}.get(data[:2])
+        if byte_order is None or struct.unpack(byte_order + 'H', data[2:4])[0] != 42:
+            raise DemException('Not a TIFF', path)
+
+        def read_at(offset, length):
+            if offset + length > len(data):
+                tiff_fp.seek(offset)
+                return tiff_fp.read(length)
+            return data[offset:offset + length]
+
+        ifd = struct.unpack(byte_order + 'I', data[4:8])[0]
+        count = struct.unpack(byte_order + 'H', read_at(ifd, 2))[0]
+        tags = {}
+        for entry in range(count):
+            tag, kind, values = struct.unpack(byte_order + 'HHI', read_at(ifd + 2 + entry * 12, 8))
+            code, size = TIFF_TYPES[kind]
+            total = size * values
+            raw = read_at(ifd + 10 + entry * 12, 4)
+            if total > 4:
+                raw = read_at(struct.unpack(byte_order + 'I', raw)[0], total)
+            if kind == 2:
+                tags[tag] = raw[:total].rstrip('\0')
+            else:
+                tags[tag] = struct.unpack(byte_order + code * values, raw[:total])
+
+    if tags.get(259, (1,))[0] != 1:
+        raise DemException('Compressed GeoTIFFs are not supported', path)
+    if tags.get(277, (1,))[0] != 1 or tags.get(284, (1,))[0] != 1:
+        raise DemException('Only single band GeoTIFFs are supported', path)
+    if 322 in tags:
+        raise DemException('Tiled GeoTIFFs are not supported', path)
+    if 33922 not in tags or 33550 not in tags:
+        raise DemException('Not a GeoTIFF', path)
+    columns, rows = tags[256][0], tags[257][0]
+    bits = tags[258][0]
+    dtype = byte_order + TIFF_DTYPES[(tags.get(339, (1,))[0], bits)]
+    offsets = tags[273]
+    strip_bytes = tags[279]
+    if any(offset != offsets[0] + sum(strip_bytes[:index]) for index, offset in enumerate(offsets)):
+        raise DemException('GeoTIFF strips are not contiguous', path)
+
+    # ModelTiepoint ties pixel (i, j) to (x, y). Where pixels are areas, that
+    # is their corner, and their samples are at their centers; where they are
+    # points, it is the sample itself.
+    i, j, _, x, y, _ = tags[33922][:6]
+    lng_step, lat_step = tags[33550][:2]
+    raster_type = read_geo_keys(tags.get(34735, ())).get(GT_RASTER_TYPE_GEO_KEY, RASTER_PIXEL_IS_AREA)
+    to_sample = 0.5 if raster_type == RASTER_PIXEL_IS_AREA else 0.0
+    north = y + (j - to_sample) * lat_step
+    west = x - (i - to_sample) * lng_step
+    nodata = float(tags[42113]) if 42113 in tags else None
+    return DemTile(path, north, west, rows, columns, lat_step, lng_step, dtype, offset=offsets[0], nodata=nodata)
+
+
+class DemElevation(object):
+    """
+    The DEM tiles in a directory, sampled for elevations.
+    """
+    def __init__(self, directory, open_tiles=DEFAULT_OPEN_TILES):
+        self.tiles = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.lower().endswith('.hgt'):
+                self.tiles.append(read_hgt_header(path))
+            elif name.lower().endswith(('.tif', '.tiff')):
+                self.tiles.append(read_tiff_header(path))
+        self.open_tiles = open_tiles
+        # most recently used last
+        self.opened = collections.OrderedDict()
+
+    def use(self, tile):
+        if tile.path in self.opened:
+            del self.opened[tile.path]
+        self.opened[tile.path] = tile
+        while len(self.opened) > self.open_tiles:
+            _, evicted = self.opened.popitem(last=False)
+            evicted.close()
+
+    def elevations(self, lats, lngs):
+        """
+        Given arrays of latitudes and longitudes, return an array of their
+        elevations in meters, NaN where there is none.
+        """
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lngs = numpy.asarray(lngs, dtype=numpy.float64)
+        elevations = numpy.empty(len(lats))
+        elevations.fill(numpy.nan)
+        for tile in self.tiles:
+            pending = numpy.isnan(elevations)
+            if not pending.any():
+                break
+            covered = numpy.flatnonzero(pending & tile.covers(lats, lngs))
+            if len(covered):
+                self.use(tile)
+                elevations[covered] = tile.sample(lats[covered], lngs[covered])
+        return elevations
+
+    def elevations_along(self, encoded_polyline):
+        """
+        Given an encoded directions polyline, return the elevations of its
+        points.
+        """
+        points = numpy.array(decode_polyline(encoded_polyline), dtype=numpy.float64).reshape(-1, 2)
+        return self.elevations(points[:, 0], points[:, 1])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Sample elevations from DEM tiles.')
+    parser.add_argument('dem_dir', help='directory of .hgt and .tif tiles')
+    parser.add_argument('points', nargs='*', metavar='LAT,LNG')
+    parser.add_argument('--polyline', default=None, help='an encoded polyline to sample along')
+    args = parser.parse_args()
+
+    dem = DemElevation(args.dem_dir)
+    points = [[float(value) for value in point.split(',')] for point in args.points]
+    if points:
+        for point, elevation in zip(args.points, dem.elevations(*zip(*points))):
+            print '%s: %s' % (point, elevation)
+    if args.polyline:
+        print ' '.join('%.1f' % elevation for elevation in dem.elevations_along(args.polyline))
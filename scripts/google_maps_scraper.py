@@ -1,114 +1,435 @@
 import argparse
+import cProfile
+import copy
 import datetime
+import hashlib
 import json
 import logging
+import math
 import os.path
+import random
+import sqlite3
 import sys
+import threading
 import time
 
 import pickle
 
 import imp
+import itertools
+import Queue
 
+import numpy
 import requests
+import requests.adapters
+import urlparse
+
+import build_profiler
+import city_output
+import dem_elevation
+import landmarks
+import osm_geocoder
+import polyline
+import routing_graph
+from intersection_registry import IntersectionRegistry
 
 ############
-# timer util
+# build profiling
 ############
-def timeit(func):
-    def timed(*args, **kwargs):
-        start = time.time()
-        result = func(*args, **kwargs)
-        end = time.time()
-
-        print '%r %2.2f sec' % \
-              (func.__name__, end-start)
-        return result
-    return timed
+# Stage timings, request latencies and cache hits of the build in progress
+profiler = build_profiler.BuildProfiler()
 
 ############
-# data definition getters and intersection generation
+# city data definition and intersection generation
 ############
-@timeit
-def compute_all_intersections(source_file, cache=None):
-    """
-    Given a source file to draw paths from, return a set of all intersections
-    among those paths.
+class CityDefinition(object):
     """
-    all_intersections = set([])
+    A city data file (i.e. data/sf.py), loaded and validated once.
 
-    assert os.path.exists(source_file)
-    data_module = imp.load_source('local_data', source_file)
+    The getters hand back fresh copies, so stages can consume what they are
+    given without touching the definition itself.
+    """
+    def __init__(self, source_file):
+        assert os.path.exists(source_file)
+        # a fresh module, so a section one data file leaves out isn't the
+        # last one loaded's
+        sys.modules.pop('local_data', None)
+        data_module = imp.load_source('local_data', source_file)
+
+        self.source_file = source_file
+        self.city = data_module.city
+        # the sections below are optional in a data file
+        self._regions = tuple(tuple(tuple(bucket) for bucket in region)
+                              for region in data_module.regions)
+        self._breaks = dict((path, frozenset(streets))
+                            for path, streets in getattr(data_module, 'breaks', {}).iteritems())
+        self._curved_roads = dict((road, tuple(tuple(section) for section in sections))
+                                  for road, sections in getattr(data_module, 'curved_roads', {}).iteritems())
+        self._custom_paths = copy.deepcopy(getattr(data_module, 'custom_paths', {}))
+        self._route_directives = tuple((path, tuple(tuple(section) for section in sections))
+                                       for path, sections in getattr(data_module, 'route_directives', []))
+        self._tbds = dict(getattr(data_module, 'tbds', {}))
+        self._bounds = tuple(data_module.bounds) if getattr(data_module, 'bounds', None) else None
+
+        self.validate()
+
+    def validate(self):
+        """
+        Raise CityDefinitionException if any section is malformed.
+        """
+        if not isinstance(self.city, basestring):
+            raise CityDefinitionException(self.source_file, 'city must be a string')
+        for region in self._regions:
+            for bucket in region:
+                for street in bucket:
+                    if not isinstance(street, basestring):
+                        raise CityDefinitionException(self.source_file, 'bad street in regions', street)
+        for road, sections in self._curved_roads.iteritems():
+            for section in sections:
+                if len(section) != 2:
+                    raise CityDefinitionException(self.source_file, 'curved road sections are (start, end)', road)
+        for custom_path, entry in self._custom_paths.iteritems():
+            if 'path' not in entry:
+                raise CityDefinitionException(self.source_file, 'custom path has no path', custom_path)
+        for path, sections in self._route_directives:
+            for section in sections:
+                if len(section) != 3:
+                    raise CityDefinitionException(self.source_file, 'route directives are (start, end, type)', path)
+        for tbd, latlng in self._tbds.iteritems():
+            if len(latlng) != 2:
+                raise CityDefinitionException(self.source_file, 'tbds are (lat, lng)', tbd)
+        if self._bounds is not None:
+            if len(self._bounds) != 4 or self._bounds[0] >= self._bounds[2] or self._bounds[1] >= self._bounds[3]:
+                raise CityDefinitionException(self.source_file, 'bounds are (south, west, north, east)')
+
+    def get_regions(self):
+        """
+        Get the regions, as a list of regions, each a list of buckets of streets.
+        """
+        return [[list(bucket) for bucket in region] for region in self._regions]
+
+    def get_all_paths(self):
+        """
+        Get the set of all streets in all regions.
+        """
+        return set(street for region in self._regions for bucket in region for street in bucket)
+
+    def get_path_breaks(self, path):
+        """
+        Get the set of streets that break the given path.
+        """
+        return self._breaks.get(path, frozenset())
+
+    def get_curved_roads(self):
+        """
+        Get the dict of curved roads to their list of (start, end) sections.
+        """
+        return dict((road, list(sections)) for road, sections in self._curved_roads.iteritems())
+
+    def get_custom_paths(self):
+        """
+        Get the dict of custom paths.
+        """
+        return copy.deepcopy(self._custom_paths)
+
+    def get_route_directives(self):
+        """
+        Get the list of (path, [(start, end, type), ...]) route directives.
+        """
+        return [(path, list(sections)) for path, sections in self._route_directives]
+
+    def get_tbds(self):
+        """
+        Get the dict of TBD markers to their (lat, lng).
+        """
+        return dict(self._tbds)
+
+    def get_bounds(self):
+        """
+        Get the city's (south, west, north, east) bounds, or None if the
+        data file doesn't give them.
+        """
+        return self._bounds
+
+
+# Every street name and intersection key seen, so each is stored once.
+_street_names = {}
+_intersection_keys = {}
+
+def intern_street(street):
+    """
+    Given a street name, return the one shared copy of it.
+    """
+    return _street_names.setdefault(street, street)
 
-    # TODO: use getattr, since it is easier to distinguish strings
-    for region in data_module.regions:
-        while len(region) > 0:
-            bucket = region.pop(0)
-            for street in bucket:
-                for other_bucket in region:
-                    for other_street in other_bucket:
-                        all_intersections.add('%s and %s' % (street, other_street))
+def intersection_key(intersection):
+    """
+    Given an intersection string ("McAllister St and Divisadero St"), return
+    its canonical key, which is the same for either order of the streets:
+    ("Divisadero St", "McAllister St"). Custom intersections with no ' and '
+    get a one street key.
+    """
+    key = _intersection_keys.get(intersection)
+    if key is None:
+        key = tuple(sorted(intern_street(part) for part in intersection.split(' and ')))
+        _intersection_keys[intersection] = key
+    return key
 
-    return all_intersections
+def intersection_name(key):
+    """
+    Given an intersection key, return the intersection string to look up.
+    """
+    return ' and '.join(key)
 
-def get_all_paths(source_file):
+def index_intersections(intersections):
     """
-    Given a source file to draw paths from, get all the paths.
+    Given an iterable of intersection strings, return a dict of each one's
+    key to the string.
     """
-    all_paths = set([])
+    return dict((intersection_key(intersection), intersection) for intersection in intersections)
 
-    assert os.path.exists(source_file)
-    data_module = imp.load_source('local_data', source_file)
+@profiler.stage
+def compute_all_intersections(city_data, cache=None, regions=None):
+    """
+    Given a city definition to draw paths from, return a set of the keys of
+    all intersections among those paths: every street in a bucket meets every
+    street in the later buckets of its region. Given regions, only those.
+    """
+    all_intersections = set([])
 
-    for region in data_module.regions:
-        while len(region) > 0:
-            bucket = region.pop(0)
+    for region in (regions if regions is not None else city_data.get_regions()):
+        buckets = [[intern_street(street) for street in bucket] for bucket in region]
+        later_streets = []
+        # walk the buckets backwards, so the streets of all later buckets are
+        # already collected when we get to each one.
+        for bucket in reversed(buckets):
             for street in bucket:
-                all_paths.add(street)
+                for other_street in later_streets:
+                    all_intersections.add((street, other_street) if street < other_street else (other_street, street))
+            later_streets.extend(bucket)
 
-    return all_paths
+    return all_intersections
 
-def get_path_breaks(source_file, path):
+####################
+# geometric pruning
+####################
+# How near (in meters) two streets' shapes must come for them to possibly
+# meet. Geocodes are not exact, so this is generous.
+PRUNE_MARGIN = 150.0
+
+def street_polylines(cache, streets, reach=None):
     """
-    Given a source file and a path, get the breaks on that path.
+    Given streets, return a dict of each one with at least two known
+    intersections to its shape, as an array of (x, y) meters: its sorted
+    intersections, following the directions between them where we have them.
+
+    A street runs on past its outermost known intersections, so each end is
+    carried on reach meters further the way it was heading. By default that
+    is the span of all the cache's intersections, so a street can reach
+    anywhere they do.
     """
-    data_module = imp.load_source('local_data', source_file)
-    return data_module.breaks.get(path, set([]))
-
-def get_curved_roads(source_file):
+    i_cache = cache['intersections']
+    p_cache = cache['paths']
+    d_cache = cache.get('directions', {})
+    if not len(i_cache):
+        return {}
+    origin_lat = math.radians(sum(i_cache.lat) / len(i_cache))
+    scale = math.pi / 180 * routing_graph.EARTH_RADIUS
+    if reach is None:
+        reach = math.hypot((max(i_cache.lat) - min(i_cache.lat)) * scale,
+                           (max(i_cache.lng) - min(i_cache.lng)) * scale * math.cos(origin_lat))
+
+    polylines = {}
+    for street in streets:
+        members = [intersection for intersection in p_cache.get(street, [])
+                   if not intersection.startswith('--') and intersection in i_cache]
+        if len(members) < 2:
+            continue
+        points = []
+        for origin, destination in zip(members, members[1:]):
+            points.append(i_cache.coordinates(origin)[:2])
+            leg = d_cache.get('%s | %s' % (origin, destination)) or {}
+            if leg.get('path'):
+                points.extend(polyline.decode_polyline(leg['path']))
+        points.append(i_cache.coordinates(members[-1])[:2])
+        lat_lng = numpy.array(points, dtype=numpy.float64)
+        xy = numpy.column_stack((lat_lng[:, 1] * scale * math.cos(origin_lat), lat_lng[:, 0] * scale))
+        polylines[street] = extend_polyline(xy, reach)
+    return polylines
+
+def extend_polyline(points, reach):
     """
-    Given a source file, get the dict of curved roads.
+    Return a polyline with each end carried on reach meters further, in the
+    direction of its last segment that has any length.
     """
-    data_module = imp.load_source('local_data', source_file)
-    return data_module.curved_roads
+    ends = []
+    for end, inner in ((points[0], points[1:]), (points[-1], points[-2::-1])):
+        vectors = end - inner
+        lengths = numpy.sqrt((vectors ** 2).sum(axis=1))
+        moved = numpy.flatnonzero(lengths > 0)
+        if len(moved):
+            ends.append(end + vectors[moved[0]] / lengths[moved[0]] * reach)
+        else:
+            ends.append(end)
+    return numpy.vstack((ends[0], points, ends[1]))
 
-def get_custom_paths(source_file):
+def segment_distances(points, starts, vectors):
     """
-    Given a source file, get the dict of custom paths.
+    Return the distance from every point to every segment, as a
+    (points, segments) array.
     """
-    data_module = imp.load_source('local_data', source_file)
-    return data_module.custom_paths
+    offsets = points[:, None, :] - starts[None, :, :]
+    lengths = (vectors ** 2).sum(axis=1)
+    along = (offsets * vectors[None, :, :]).sum(axis=2) / numpy.where(lengths > 0, lengths, 1.0)
+    nearest = starts[None, :, :] + numpy.clip(along, 0.0, 1.0)[:, :, None] * vectors[None, :, :]
+    return numpy.sqrt(((points[:, None, :] - nearest) ** 2).sum(axis=2))
 
-def get_route_directives(source_file):
+def polyline_distance(a, b):
+    """
+    Return the least distance between two polylines, each an array of
+    (x, y) points: 0 if they cross.
     """
-    Given a source file, get the dict of route directives.
+    def cross(u, v):
+        return u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+
+    a_starts, a_vectors = a[:-1], numpy.diff(a, axis=0)
+    b_starts, b_vectors = b[:-1], numpy.diff(b, axis=0)
+    # (a segment, b segment) pairs whose ends are strictly on opposite sides
+    # of each other. Segments that only touch, or are collinear, have an end
+    # on the other one, which the distances below find.
+    to_b_starts = b_starts[None, :, :] - a_starts[:, None, :]
+    to_b_ends = to_b_starts + b_vectors[None, :, :]
+    a_sides = cross(a_vectors[:, None, :], to_b_starts) * cross(a_vectors[:, None, :], to_b_ends)
+    b_sides = cross(b_vectors[None, :, :], -to_b_starts) * \
+        cross(b_vectors[None, :, :], a_starts[:, None, :] + a_vectors[:, None, :] - b_starts[None, :, :])
+    if ((a_sides < 0) & (b_sides < 0)).any():
+        return 0.0
+    return min(segment_distances(a, b_starts, b_vectors).min(), segment_distances(b, a_starts, a_vectors).min())
+
+@profiler.stage
+def prune_intersections(cache, intersections, margin=PRUNE_MARGIN, conservative=False):
     """
-    data_module = imp.load_source('local_data', source_file)
-    return data_module.route_directives
+    Given intersection keys, drop the street pairs whose shapes, carried on
+    past their known ends (see street_polylines), never come within margin
+    meters of each other, and return (the keys kept, the keys dropped).
+    Streets with fewer than two known intersections have no shape yet, and
+    their pairs are always kept.
+
+    Conservative pruning only drops pairs whose bounding boxes, grown by
+    margin, do not overlap, and never drops a pair already in the cache.
+    """
+    polylines = street_polylines(cache, set(street for key in intersections for street in key))
+    bboxes = dict((street, (points.min(axis=0) - margin, points.max(axis=0) + margin))
+                  for street, points in polylines.iteritems())
+    cached_keys = index_intersections(cache['intersections']) if conservative else {}
+
+    kept = set([])
+    pruned = set([])
+    for key in intersections:
+        street, other_street = key
+        if street not in polylines or other_street not in polylines or key in cached_keys:
+            kept.add(key)
+            continue
+        (low, high), (other_low, other_high) = bboxes[street], bboxes[other_street]
+        if (low > other_high).any() or (other_low > high).any():
+            pruned.add(key)
+        elif not conservative and polyline_distance(polylines[street], polylines[other_street]) > margin:
+            pruned.add(key)
+        else:
+            kept.add(key)
+    return kept, pruned
 
-def get_city(source_file):
+############
+# concurrent fetch utils
+############
+class RateLimiter(object):
     """
-    Given a source file, get the city it refers to.
+    Spaces out calls so that no more than `rate` of them start per second,
+    across all threads. A rate of None means no limit.
     """
-    data_module = imp.load_source('local_data', source_file)
-    return data_module.city
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.next_slot = 0
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class SharedRateLimiter(RateLimiter):
+    """
+    A RateLimiter whose schedule is shared with other processes, through a
+    multiprocessing Value('d') and Lock made by their parent.
+    """
+    def __init__(self, rate, next_slot, lock):
+        self.shared_next_slot = next_slot
+        self.lock = lock
+        self.set_rate(rate)
+
+    @property
+    def next_slot(self):
+        return self.shared_next_slot.value
+
+    @next_slot.setter
+    def next_slot(self, value):
+        self.shared_next_slot.value = value
+
+# Every Google API request waits on this limiter.
+rate_limiter = RateLimiter()
 
-def get_tbds(source_file):
+def fetch_concurrently(fetch, items, workers=1):
     """
-    Given a source file, get the TBD markers we need.
+    Call fetch(item) for every item, using up to `workers` threads.
+
+    Yields (item, result, exception) tuples in the same order as items, where
+    exception is None if the fetch succeeded. With one worker, everything
+    happens on the calling thread.
     """
-    data_module = imp.load_source('local_data', source_file)
-    return data_module.tbds
+    if workers <= 1:
+        for item in items:
+            try:
+                yield item, fetch(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    work_queue = Queue.Queue()
+    result_queue = Queue.Queue()
+    for index, item in enumerate(items):
+        work_queue.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = work_queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result_queue.put((index, item, fetch(item), None))
+            except Exception as e:
+                result_queue.put((index, item, None, e))
+
+    for _ in range(min(workers, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    # Hand results back in order, holding on to any that finish early.
+    finished = {}
+    for index in range(len(items)):
+        while index not in finished:
+            done_index, item, result, error = result_queue.get()
+            finished[done_index] = (item, result, error)
+        yield finished.pop(index)
 
 ####################
 # bad address cache functions
@@ -140,9 +461,419 @@ def write_bad_address_cache(fp, cache):
             fp.write('\n')
 
 
+####################
+# scrape journal
+####################
+class ScrapeJournal(object):
+    """
+    An append-only JSON-lines log of everything fetched during a build, so an
+    interrupted build can be replayed into the cache instead of re-fetched.
+
+    Every line is one of:
+        {"intersection": "A and B", "value": {"lat": ..., "lng": ..., "elevation": ...}}
+        {"custom_intersection": "A and B", "value": {...}}
+        {"directions": "A and B | A and C", "value": {"path": ..., "length": ...}}
+        {"bad_address": "A and B", "attr": "not_intersection"}
+    """
+    SYNC_INTERVAL = 5.0
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.last_sync = time.time()
+        # a build killed mid-write can leave a partial last line; start
+        # a fresh line so it does not swallow the next entry.
+        needs_newline = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as fp:
+                fp.seek(-1, os.SEEK_END)
+                needs_newline = fp.read(1) != '\n'
+        self.fp = open(path, 'a')
+        if needs_newline:
+            self.fp.write('\n')
+
+    def record_intersection(self, intersection, value):
+        self.write({'intersection': intersection, 'value': value})
+
+    def record_custom_intersection(self, intersection, value):
+        self.write({'custom_intersection': intersection, 'value': value})
+
+    def record_directions(self, key_name, value):
+        self.write({'directions': key_name, 'value': value})
+
+    def record_bad_address(self, attr, address):
+        self.write({'bad_address': address, 'attr': attr})
+
+    def write(self, entry):
+        with self.lock:
+            self.fp.write(json.dumps(entry))
+            self.fp.write('\n')
+            self.fp.flush()
+            if time.time() - self.last_sync > self.SYNC_INTERVAL:
+                os.fsync(self.fp.fileno())
+                self.last_sync = time.time()
+
+    def close(self):
+        with self.lock:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+            self.fp.close()
+
+    def remove(self):
+        """
+        Close and delete the journal, once everything in it has been written out.
+        """
+        self.close()
+        os.remove(self.path)
+
+def replay_journal(fp, cache, bad_address_cache):
+    """
+    Given a journal file, add every entry in it to the cache and bad address
+    cache, the same way the lookup that fetched it did. Returns the number of
+    entries replayed.
+    """
+    i_cache = cache['intersections']
+    p_cache = cache['paths']
+    d_cache = cache['directions']
+
+    replayed = 0
+    for line in fp:
+        if line.strip() == '':
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            logging.warning('skipping partial journal entry: %r' % line)
+            continue
+
+        if 'intersection' in entry:
+            intersection = entry['intersection']
+            if intersection not in i_cache:
+                i_cache[intersection] = entry['value']
+                for street in intersection_key(intersection):
+                    p_cache.setdefault(street, []).append(intersection)
+        elif 'custom_intersection' in entry:
+            intersection = entry['custom_intersection']
+            if intersection not in i_cache:
+                i_cache[intersection] = entry['value']
+                for street in intersection_key(intersection):
+                    if street in p_cache:
+                        p_cache[street].append(intersection)
+        elif 'directions' in entry:
+            d_cache[entry['directions']] = entry['value']
+        elif 'bad_address' in entry:
+            bad_address_cache[entry['attr']].add(entry['bad_address'])
+        replayed += 1
+
+    return replayed
+
+
+####################
+# shared fetch store
+####################
+class FetchStore(object):
+    """
+    A local SQLite store of geocodes, elevations and directions legs, shared
+    by every city and every build that points at it.
+
+    Geocodes are keyed by normalized intersection name and city, so
+    "McAllister St and Divisadero St" finds "Divisadero St and McAllister St".
+    Entries fetched more than `ttl` seconds ago count as missing, and are
+    replaced when fetched again.
+    """
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS geocodes (
+               intersection TEXT NOT NULL,
+               city TEXT NOT NULL,
+               status TEXT NOT NULL,
+               lat REAL,
+               lng REAL,
+               fetched_at REAL NOT NULL,
+               PRIMARY KEY (intersection, city))""",
+        """CREATE TABLE IF NOT EXISTS elevations (
+               lat REAL NOT NULL,
+               lng REAL NOT NULL,
+               elevation REAL NOT NULL,
+               fetched_at REAL NOT NULL,
+               PRIMARY KEY (lat, lng))""",
+        """CREATE TABLE IF NOT EXISTS directions (
+               origin TEXT NOT NULL,
+               destination TEXT NOT NULL,
+               city TEXT NOT NULL,
+               path TEXT NOT NULL,
+               length INTEGER NOT NULL,
+               fetched_at REAL NOT NULL,
+               PRIMARY KEY (origin, destination, city))""",
+    ]
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = {'geocode': 0, 'elevation': 0, 'directions': 0}
+        self.misses = {'geocode': 0, 'elevation': 0, 'directions': 0}
+        # several builds may share one store, so wait on their locks
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+
+    def oldest_fresh_time(self):
+        return time.time() - self.ttl if self.ttl else 0
+
+    def count(self, table, found, total=1):
+        self.hits[table] += found
+        self.misses[table] += total - found
+
+    def get_geocode(self, intersection, city):
+        """
+        Return (status, lat, lng) for the intersection, or None if it is not
+        stored (or is stale).
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT status, lat, lng FROM geocodes WHERE intersection = ? AND city = ? AND fetched_at >= ?',
+                (normalize_intersection(intersection), city, self.oldest_fresh_time())).fetchone()
+            self.count('geocode', row is not None)
+        return row
+
+    def put_geocode(self, intersection, city, status, lat=None, lng=None):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?, ?)',
+                              (normalize_intersection(intersection), city, status, lat, lng, time.time()))
+
+    def get_elevations(self, points):
+        """
+        Given a list of (lat, lng) tuples, return a dict of {(lat, lng): elevation}
+        for the ones that are stored.
+        """
+        elevations = {}
+        with self.lock:
+            for lat, lng in points:
+                row = self.conn.execute(
+                    'SELECT elevation FROM elevations WHERE lat = ? AND lng = ? AND fetched_at >= ?',
+                    (lat, lng, self.oldest_fresh_time())).fetchone()
+                if row is not None:
+                    elevations[(lat, lng)] = row[0]
+            self.count('elevation', len(elevations), len(points))
+        return elevations
+
+    def put_elevations(self, elevations):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO elevations VALUES (?, ?, ?, ?)',
+                                  [(lat, lng, elevation, now) for (lat, lng), elevation in elevations.iteritems()])
+
+    def get_directions(self, origin, destination, city):
+        """
+        Return the {'path': ..., 'length': ...} directions leg from origin to
+        destination, or None if it is not stored (or is stale).
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT path, length FROM directions WHERE origin = ? AND destination = ? AND city = ? AND fetched_at >= ?',
+                (normalize_intersection(origin), normalize_intersection(destination), city,
+                 self.oldest_fresh_time())).fetchone()
+            self.count('directions', row is not None)
+        if row is None:
+            return None
+        return {'path': row[0], 'length': row[1]}
+
+    def put_directions(self, origin, destination, city, directions):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO directions VALUES (?, ?, ?, ?, ?, ?)',
+                              (normalize_intersection(origin), normalize_intersection(destination), city,
+                               directions['path'], directions['length'], time.time()))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def normalize_intersection(intersection):
+    """
+    Given an intersection string, return a key that is the same no matter the
+    order or case of its streets ("divisadero st and mcallister st").
+    """
+    parts = [' '.join(part.lower().split()) for part in intersection.split(' and ')]
+    return ' and '.join(sorted(parts))
+
+# Set by the main script when a store is given.
+fetch_store = None
+
+# Set by the main script to an OsmGeocoder with --geocoder osm.
+geocoder = None
+
+# Set by the main script to a DemElevation with --dem-dir.
+elevation_source = None
+
+
+####################
+# daily quota budget
+####################
+class QuotaBudget(object):
+    """
+    A daily budget of requests per endpoint ({'geocode': 2500, ...}), with
+    what has been spent today kept in a state file, so runs later in the
+    same day pick up where this one left off. Endpoints without a limit are
+    not budgeted. Every request is saved as it is spent, so a build that
+    crashes or is interrupted never under-records what it used.
+    """
+    def __init__(self, limits, state_file):
+        self.limits = limits
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.today = datetime.date.today().isoformat()
+        self.used = {}
+        if os.path.exists(state_file):
+            with open(state_file) as state_fp:
+                state = json.load(state_fp)
+            if state.get('date') == self.today:
+                self.used = state['used']
+
+    def remaining(self, endpoint):
+        """
+        Return how many requests are left today, or None if there is no limit.
+        """
+        if endpoint not in self.limits:
+            return None
+        return max(0, self.limits[endpoint] - self.used.get(endpoint, 0))
+
+    def spend(self, endpoint):
+        with self.lock:
+            if endpoint in self.limits and self.used.get(endpoint, 0) >= self.limits[endpoint]:
+                raise QuotaExhaustedException(endpoint, self.limits[endpoint])
+            self.used[endpoint] = self.used.get(endpoint, 0) + 1
+            self._save()
+
+    def affordable_lookups(self, wanted, chunk_size):
+        """
+        Return how many of `wanted` intersection lookups (a geocode each, plus
+        their share of batched elevation requests, made `chunk_size` at a time)
+        fit in what is left of today's budget.
+        """
+        geocodes = self.remaining('geocode')
+        affordable = wanted if geocodes is None else min(wanted, geocodes)
+        elevations = self.remaining('elevation')
+        if elevations is not None:
+            # the largest count whose elevation batches still fit
+            low, high = 0, affordable
+            while low < high:
+                middle = (low + high + 1) / 2
+                if estimate_elevation_requests(middle, chunk_size) <= elevations:
+                    low = middle
+                else:
+                    high = middle - 1
+            affordable = low
+        return affordable
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        # written whole, then moved over the old state, so a build killed
+        # mid-write leaves one or the other
+        with open(self.state_file + '.tmp', 'w') as state_fp:
+            json.dump({'date': self.today, 'used': self.used, 'limits': self.limits}, state_fp)
+        os.rename(self.state_file + '.tmp', self.state_file)
+
+def parse_budget(budget):
+    """
+    Given a budget string ("geocode=2500,elevation=2500"), return a dict of
+    endpoint to daily limit.
+    """
+    limits = {}
+    for entry in budget.split(','):
+        endpoint, limit = entry.split('=')
+        limits[endpoint.strip()] = int(limit)
+    return limits
+
+def estimate_elevation_requests(points, chunk_size):
+    """
+    Given a number of points looked up `chunk_size` at a time, return the most
+    Elevation API requests their batches could take.
+    """
+    # a long lat/lng, so batches are never bigger than the real thing
+    placeholder = (-90.12345678901, -180.12345678901)
+    requests_needed = 0
+    for chunk_start in range(0, points, chunk_size):
+        chunk = min(chunk_size, points - chunk_start)
+        requests_needed += len(make_elevation_batches([(index, placeholder) for index in range(chunk)]))
+    return requests_needed
+
+def prioritize_intersections(keys):
+    """
+    Given intersection keys to look up, order them so that the streets with
+    the fewest of them come first, each street's intersections together, so
+    a run cut short by its budget completes as many whole paths as it can.
+    """
+    keys_by_street = {}
+    for key in keys:
+        for street in key:
+            keys_by_street.setdefault(street, []).append(key)
+
+    ordered = []
+    seen = set([])
+    for street in sorted(keys_by_street, key=lambda street: (len(keys_by_street[street]), street)):
+        for key in sorted(keys_by_street[street]):
+            if key not in seen:
+                seen.add(key)
+                ordered.append(key)
+    return ordered
+
+def find_uncached_intersections(i_cache, intersections, bad_address_cache):
+    """
+    Given the intersection cache, intersection keys and the bad address cache,
+    return the keys that are neither cached nor known to be bad.
+    """
+    cached_keys = index_intersections(i_cache)
+    bad_keys = index_intersections(bad_address_cache['not_intersection'])
+    bad_keys.update(index_intersections(bad_address_cache['ambiguous']))
+    return [key for key in intersections if key not in bad_keys and key not in cached_keys]
+
+
+####################
+# columnar intersection table
+####################
+class IntersectionTable(object):
+    """
+    The intersection registry as numpy columns: arrays of latitude, longitude
+    and elevation indexed by the registry's ids, and the intersection name of
+    each id.
+    """
+    def __init__(self, registry):
+        self.names = registry.names
+        self.ids = registry.ids
+        self.lat, self.lng, self.elevation = registry.columns()
+        # the ids of the intersections on each street, built when first needed
+        self.street_ids = None
+
+    def get_ids(self, names):
+        """
+        Given intersection names, return an array of their ids.
+        """
+        return numpy.array([self.ids[name] for name in names], dtype=numpy.intp)
+
+    def get_break_mask(self, ids, breaks):
+        """
+        Given an array of ids and a set of streets, return a boolean array of
+        whether each id's intersection is on one of the streets.
+        """
+        if self.street_ids is None:
+            self.street_ids = {}
+            for index, name in enumerate(self.names):
+                for street in intersection_key(name):
+                    self.street_ids.setdefault(street, []).append(index)
+        break_ids = [index for street in breaks for index in self.street_ids.get(street, [])]
+        return numpy.in1d(ids, break_ids)
+
+
 ##################
 # google api calls
 ##################
+GOOGLE_MAPS_API_BASE = 'http://maps.googleapis.com/maps/api'
+
 def get_lat_lng_and_elevation(intersection, city, custom=False):
     """
     Given an intersection string ("Divisadero St and McAllister St"),
@@ -159,11 +890,51 @@ def get_geocode(intersection, city, custom=False):
     Given an intersection string ("Divisadero St and McAllister St"),
     and a city string ("San Francisco, CA"), return the latitude
     and longitude as a tuple, or raise an exception.
+
+    With an OSM geocoder, it answers instead, and nothing is fetched.
+    Otherwise checks the fetch store, if there is one, before going to the
+    network.
+    """
+    if geocoder is not None:
+        status, latitude, longitude = geocoder.geocode(intersection)
+        if status == 'not_intersection':
+            raise NotIntersectionAddressException(intersection, city)
+        elif status == 'ambiguous':
+            raise AmbiguousAddressException(intersection, city)
+        return latitude, longitude
+
+    if fetch_store is None:
+        return fetch_geocode(intersection, city, custom=custom)
+
+    stored = fetch_store.get_geocode(intersection, city)
+    if stored is not None:
+        status, latitude, longitude = stored
+        if status == 'not_intersection':
+            raise NotIntersectionAddressException(intersection, city)
+        elif status == 'ambiguous':
+            raise AmbiguousAddressException(intersection, city)
+        return latitude, longitude
+
+    try:
+        latitude, longitude = fetch_geocode(intersection, city, custom=custom)
+    except NotIntersectionAddressException:
+        fetch_store.put_geocode(intersection, city, 'not_intersection')
+        raise
+    except AmbiguousAddressException:
+        fetch_store.put_geocode(intersection, city, 'ambiguous')
+        raise
+    fetch_store.put_geocode(intersection, city, 'ok', latitude, longitude)
+    return latitude, longitude
+
+
+def fetch_geocode(intersection, city, custom=False):
+    """
+    Same as get_geocode, but always asks the Geocoding API.
     """
     original_city = city
     city = city.replace(' ', '+')
 
-    geocode_uri = 'http://maps.googleapis.com/maps/api/geocode/json?address=%s,+%s&sensor=false' % (intersection, city)
+    geocode_uri = GOOGLE_MAPS_API_BASE + '/geocode/json?address=%s,+%s&sensor=false' % (intersection, city)
 
     data = make_json_request(geocode_uri)
 
@@ -216,9 +987,119 @@ def get_elevation(lat, lng):
     """
     Given a latitude and a longitude, return the elevation at the point, in meters.
     """
-    elevation_uri = 'http://maps.googleapis.com/maps/api/elevation/json?locations=%s,%s&sensor=false' % (lat, lng)
-    data = make_json_request(elevation_uri)
-    return data['results'][0]['elevation']
+    return get_elevations([(lat, lng)])[0]
+
+
+# The Elevation API takes up to 512 locations per request, in an URL of at
+# most 8192 characters.
+MAX_ELEVATION_BATCH_SIZE = 512
+MAX_ELEVATION_URI_LENGTH = 8000
+
+def get_elevation_uri(points):
+    locations = '|'.join('%s,%s' % (lat, lng) for lat, lng in points)
+    return GOOGLE_MAPS_API_BASE + '/elevation/json?locations=%s&sensor=false' % locations
+
+
+def get_elevations(points):
+    """
+    Given a list of (latitude, longitude) tuples, return a list of the
+    elevations at those points, in meters, using at most one request for
+    the points not in the DEM (if there is one) or the fetch store.
+    """
+    stored = sample_dem_elevations(points)
+    missing = [point for point in points if point not in stored]
+    if missing and fetch_store is not None:
+        stored.update(fetch_store.get_elevations(missing))
+        missing = [point for point in points if point not in stored]
+
+    if missing:
+        elevation_uri = get_elevation_uri(missing)
+        data = make_json_request(elevation_uri)
+        if len(data['results']) != len(missing):
+            logging.error('wrong number of elevation results: %s' % elevation_uri)
+            raise GoogleMapsApiException(elevation_uri, len(data['results']))
+        fetched = dict(zip(missing, [result['elevation'] for result in data['results']]))
+        if fetch_store is not None:
+            fetch_store.put_elevations(fetched)
+        stored.update(fetched)
+
+    return [stored[point] for point in points]
+
+
+def sample_dem_elevations(points):
+    """
+    Given a list of (latitude, longitude) tuples, return a dict of the
+    elevations of those the DEM covers, all at once.
+    """
+    if elevation_source is None or not points:
+        return {}
+    lats, lngs = zip(*points)
+    elevations = elevation_source.elevations(lats, lngs)
+    return dict((point, float(elevation)) for point, elevation in zip(points, elevations)
+                if not numpy.isnan(elevation))
+
+
+def make_elevation_batches(locations):
+    """
+    Given a list of (key, (latitude, longitude)) pairs, split it into batches
+    that each fit in one Elevation API request.
+    """
+    batches = []
+    batch = []
+    uri_length = len(get_elevation_uri([]))
+    for key, (lat, lng) in locations:
+        # each location adds 'lat,lng' and a '|' separator to the uri
+        location_length = len('%s,%s' % (lat, lng)) + 1
+        if batch and (len(batch) == MAX_ELEVATION_BATCH_SIZE or
+                      uri_length + location_length > MAX_ELEVATION_URI_LENGTH):
+            batches.append(batch)
+            batch = []
+            uri_length = len(get_elevation_uri([]))
+        batch.append((key, (lat, lng)))
+        uri_length += location_length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def lookup_elevations(locations, workers=1):
+    """
+    Given a list of (key, (latitude, longitude)) pairs, look up the elevation
+    of every point in as few requests as possible.
+
+    Returns a dict of {key: elevation} and a dict of {key: exception} for the
+    points that could not be looked up. A batch that fails is split in half
+    and retried, so one bad point only ever fails on its own.
+    """
+    errors = {}
+
+    # Whatever the DEM covers needs no requests, and is sampled in one go.
+    sampled = sample_dem_elevations([point for _, point in locations])
+    elevations = dict((key, sampled[point]) for key, point in locations if point in sampled)
+    locations = [(key, point) for key, point in locations if point not in sampled]
+    if sampled and locations:
+        logging.info('%d points outside the DEM, asking the API' % len(locations))
+
+    def lookup(batch):
+        return get_elevations([point for _, point in batch])
+
+    batches = make_elevation_batches(locations)
+    while batches:
+        failed_batches = []
+        for batch, result, error in fetch_concurrently(lookup, batches, workers):
+            if error is None:
+                for (key, _), elevation in zip(batch, result):
+                    elevations[key] = elevation
+            elif len(batch) == 1 or isinstance(error, QuotaExhaustedException):
+                for key, _ in batch:
+                    errors[key] = error
+            else:
+                logging.warning('elevation batch of %d failed, splitting: %s' % (len(batch), error))
+                middle = len(batch) / 2
+                failed_batches.extend([batch[:middle], batch[middle:]])
+        batches = failed_batches
+
+    return elevations, errors
 
 
 def get_directions_and_length(origin, destination, city):
@@ -226,34 +1107,269 @@ def get_directions_and_length(origin, destination, city):
     Given an origin and destination, return the
     encoded directions path, as well as the distance of the trip,
     in a dict.
+
+    Checks the fetch store, if there is one, before going to the network.
+    """
+    return get_directions_along([origin, destination], city)[0]
+
+
+def fetch_directions_and_length(origin, destination, city):
+    """
+    Same as get_directions_and_length, but always asks the Directions API.
+    Returns None if the request failed.
+    """
+    fetched = fetch_directions_along([origin, destination], city)
+    return fetched[0] if fetched is not None else None
+
+
+# The Directions API takes up to 8 waypoints between the origin and the
+# destination, so one request covers up to 9 legs.
+MAX_DIRECTIONS_WAYPOINTS = 8
+
+def chain_legs(legs):
+    """
+    Given (origin, destination) legs, return runs of intersections, each leg
+    of a run starting where the one before it ended.
+    """
+    runs = []
+    for origin, destination in legs:
+        if runs and runs[-1][-1] == origin:
+            runs[-1].append(destination)
+        else:
+            runs.append([origin, destination])
+    return runs
+
+def count_directions_requests(legs):
+    """
+    Given (origin, destination) legs, return how many Directions requests
+    getting them along their runs takes.
+    """
+    legs_per_request = MAX_DIRECTIONS_WAYPOINTS + 1
+    return sum((len(run) - 2) / legs_per_request + 1 for run in chain_legs(legs))
+
+def get_directions_along(intersections, city):
+    """
+    Given a run of intersections, return the directions (as from
+    get_directions_and_length) of each leg between them, using a request
+    with waypoints for as many legs at a time as the API takes. Legs in the
+    fetch store, if there is one, are not fetched.
+
+    A piece of the run that fails as a whole is retried one leg at a time,
+    so one bad intersection only ever fails its own legs.
+    """
+    directions = [fetch_store.get_directions(origin, destination, city) if fetch_store is not None else None
+                  for origin, destination in zip(intersections, intersections[1:])]
+
+    # (first leg, last leg + 1) of every stretch of legs not in the store
+    stretches = []
+    for index, leg_directions in enumerate(directions):
+        if leg_directions is not None:
+            continue
+        if stretches and stretches[-1][1] == index:
+            stretches[-1][1] = index + 1
+        else:
+            stretches.append([index, index + 1])
+
+    legs_per_request = MAX_DIRECTIONS_WAYPOINTS + 1
+    for first, end in stretches:
+        for start in range(first, end, legs_per_request):
+            piece = intersections[start:min(start + legs_per_request, end) + 1]
+            fetched = fetch_directions_along(piece, city)
+            if fetched is None and len(piece) > 2:
+                fetched = [fetch_directions_and_length(origin, destination, city)
+                           for origin, destination in zip(piece, piece[1:])]
+            elif fetched is None:
+                fetched = [None]
+            for index, leg_directions in enumerate(fetched, start):
+                directions[index] = leg_directions
+                # failed requests are not stored, so they are retried next time
+                if fetch_store is not None and leg_directions is not None:
+                    fetch_store.put_directions(intersections[index], intersections[index + 1], city,
+                                               leg_directions)
+    return directions
+
+def fetch_directions_along(intersections, city):
+    """
+    Ask the Directions API for the route through a run of intersections in
+    one request (those between the first and the last as waypoints), and
+    return each leg's {'path': ..., 'length': ...}, or None if the request
+    failed. Running out of budget still raises QuotaExhaustedException.
+
+    A leg's path is built from its steps, at their full detail, rather
+    than taken from the route's smoothed overview, so it comes out the
+    same whether the leg was asked for alone or along a run.
     """
-    directions_uri = 'http://maps.googleapis.com/maps/api/directions/json?origin=%s&destination=%s&sensor=false&mode=walking' % \
-                        (origin.replace(' ', '+') + ', ' + city, destination.replace(' ', '+') + ', ' + city)
-    data = make_json_request(directions_uri)
+    def location(intersection):
+        return intersection.replace(' ', '+') + ', ' + city
+
+    directions_uri = GOOGLE_MAPS_API_BASE + '/directions/json?origin=%s&destination=%s' % \
+        (location(intersections[0]), location(intersections[-1]))
+    if len(intersections) > 2:
+        directions_uri += '&waypoints=%s' % '|'.join(location(intersection) for intersection in intersections[1:-1])
+    directions_uri += '&sensor=false&mode=walking'
+    try:
+        data = make_json_request(directions_uri)
+    except QuotaExhaustedException:
+        raise
+    except GoogleMapsApiException as e:
+        logging.error('failed directions request: %s (%s)' % (directions_uri, e))
+        return None
     print directions_uri
 
     try:
         if len(data['routes']) > 1:
             logging.warning('> 1 route on directions req: %s' % directions_uri)
-        # Note: we are doing point to point directions, so there will only be
-        # one "leg" of the journey from the Google Directions API
-        return {'path': data['routes'][0]['overview_polyline']['points'], 'length': data['routes'][0]['legs'][0]['distance']['value']}
-    except:
-        logging.error('failed directions request: %s' % directions_uri)
-        pass
+        legs = data['routes'][0]['legs']
+        if len(legs) != len(intersections) - 1:
+            raise ValueError('expected %d legs, got %d' % (len(intersections) - 1, len(legs)))
+        return [leg_directions(leg) for leg in legs]
+    except Exception as e:
+        logging.error('failed directions request: %s (%s)' % (directions_uri, e))
+        return None
+
+def leg_directions(leg):
+    """
+    Given a leg of a Directions API route, return its {'path': ...,
+    'length': ...}, the path joining its steps' polylines.
+    """
+    points = []
+    for step in leg['steps']:
+        step_points = polyline.decode_polyline(step['polyline']['points'])
+        # each step starts where the last one ended
+        points.extend(step_points[1:] if points and step_points and step_points[0] == points[-1] else step_points)
+    return {'path': polyline.encode_polyline(points), 'length': leg['distance']['value']}
+
+def lookup_directions(d_cache, legs, city, journal=None, kind='directions'):
+    """
+    Given (origin, destination) legs, get the directions of every one not in
+    the directions cache, a run of legs at a time, and add them to it.
+    Returns False if the budget ran out part way through.
+    """
+    missing = []
+    for origin, destination in legs:
+        key_name = '%s | %s' % (origin, destination)
+        profiler.count('directions', key_name in d_cache)
+        if key_name in d_cache:
+            logging.info(' [skipped %s] %s -> %s' % (kind, origin, destination))
+        elif (origin, destination) not in missing:
+            missing.append((origin, destination))
+
+    for run in chain_legs(missing):
+        try:
+            run_directions = get_directions_along(run, city)
+        except QuotaExhaustedException:
+            logging.info(' [deferred %s] out of budget' % kind)
+            return False
+        for (origin, destination), directions in zip(zip(run, run[1:]), run_directions):
+            key_name = '%s | %s' % (origin, destination)
+            d_cache[key_name] = directions
+            if journal:
+                journal.record_directions(key_name, directions)
+            print ' [fetched %s] %s -> %s' % (kind, origin, destination)
+    return True
 
 
 def make_json_request(uri):
     """
     Given an URL, return the content at the URL in JSON.
 
-    Raises Exception if status code is not 200.
+    Raises Exception if status code is not 200, or the API is still over its
+    query limit, after retrying.
     """
-    req = requests.get(uri)
-    if req.status_code != 200:
+    return api_session.get_json(uri)
+
+
+##################
+# http session
+##################
+class GoogleMapsSession(object):
+    """
+    A keep-alive, connection pooled HTTP session shared by every API request.
+
+    OVER_QUERY_LIMIT responses, 5xx responses and connection errors are
+    retried with exponential backoff and jitter. Request counts, retries and
+    latencies are kept per endpoint (geocode, elevation, directions).
+
+    Given a budget, every attempt is charged to it first, and
+    QuotaExhaustedException is raised once it runs out.
+    """
+    def __init__(self, pool_size=10, max_retries=5, backoff=0.5, max_backoff=30.0):
+        self.lock = threading.Lock()
+        self.stats = {}
+        # a QuotaBudget, if requests are being budgeted
+        self.budget = None
+        self.session = None
+        self.configure(pool_size, max_retries, backoff, max_backoff)
+
+    def configure(self, pool_size=10, max_retries=5, backoff=0.5, max_backoff=30.0):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # the old session's pooled connections would otherwise stay open
+        if self.session is not None:
+            self.session.close()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_json(self, uri):
+        endpoint = get_endpoint(uri)
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.record(endpoint, retry=True)
+                # full jitter: sleep anywhere up to the exponential backoff
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+            if self.budget is not None:
+                self.budget.spend(endpoint)
+            rate_limiter.wait()
+            start = time.time()
+            try:
+                req = self.session.get(uri)
+            except requests.exceptions.RequestException as e:
+                self.record(endpoint, latency=time.time() - start)
+                logging.warning('request error (attempt %d): %s %s' % (attempt + 1, uri, e))
+                status = e
+                continue
+            self.record(endpoint, latency=time.time() - start)
+
+            status = req.status_code
+            if status == 200:
+                data = json.loads(req.content)
+                if data.get('status') != 'OVER_QUERY_LIMIT':
+                    return data
+                status = data['status']
+            elif status < 500:
+                break
+            logging.warning('retryable failure (attempt %d): %s %s' % (attempt + 1, uri, status))
+
+        self.record(endpoint, failure=True)
         logging.error('failed request: %s' % uri)
-        raise GoogleMapsApiException(uri, req.status_code)
-    return json.loads(req.content)
+        raise GoogleMapsApiException(uri, status)
+
+    def record(self, endpoint, latency=None, retry=False, failure=False):
+        with self.lock:
+            stats = self.stats.setdefault(endpoint,
+                {'requests': 0, 'retries': 0, 'failures': 0, 'total_latency': 0.0, 'max_latency': 0.0})
+            if latency is not None:
+                stats['requests'] += 1
+                stats['total_latency'] += latency
+                stats['max_latency'] = max(stats['max_latency'], latency)
+                profiler.record_latency(endpoint, latency)
+            if retry:
+                stats['retries'] += 1
+            if failure:
+                stats['failures'] += 1
+
+def get_endpoint(uri):
+    """
+    Given an API URL (".../maps/api/geocode/json?..."), return the name of
+    the endpoint it calls ("geocode").
+    """
+    return urlparse.urlparse(uri).path.rstrip('/').split('/')[-2]
+
+api_session = GoogleMapsSession()
 
 
 #################
@@ -271,53 +1387,73 @@ class NotIntersectionAddressException(GoogleMapsApiException):
 class AmbiguousAddressException(GoogleMapsApiException):
     pass
 
+class QuotaExhaustedException(GoogleMapsApiException):
+    pass
+
+class CityDefinitionException(Exception):
+    def __init__(self, *args):
+        self.args = args
+    def __str__(self):
+        return repr(self.args)
+
 
 ##############
 # main functions
 ##############
-@timeit
-def lookup_all_intersections(cache, intersections, bad_address_cache, city):
+# Number of intersections geocoded before their elevations are looked up and
+# the results recorded.
+LOOKUP_CHUNK_SIZE = MAX_ELEVATION_BATCH_SIZE
+
+@profiler.stage
+def lookup_all_intersections(cache, intersections, bad_address_cache, city, workers=1, journal=None, budget=None):
     """
-    Fill the caches with stuff.
+    Given the keys of the intersections to look up, fill the caches with stuff.
+
+    Geocodes are spread over `workers` threads and elevations are looked up in
+    batches; results are applied to the caches on this thread, in the same
+    order a one-at-a-time lookup would, and written to the journal if given.
+
+    Given a budget, only as many lookups as it can afford are made, streets
+    closest to complete first; the rest are counted as deferred.
     """
-    stats = {key: 0 for key in ['good', 'cached', 'skipped', 'bad', 'error']}
+    stats = {key: 0 for key in ['good', 'cached', 'skipped', 'bad', 'error', 'deferred']}
 
     i_cache = cache['intersections']
     p_cache = cache['paths']
 
-    for intersection in intersections:
-        parts = intersection.split(' and ')
-        flip_intersection = parts[1] + ' and ' + parts[0]
-        if intersection in bad_address_cache['not_intersection'] or intersection in bad_address_cache['ambiguous']:
-            logging.info(' [skipped] %s' % intersection)
-            stats['skipped'] += 1
-            continue
-
-        if intersection in i_cache or flip_intersection in i_cache:
-            logging.info(' [cached] %s' % intersection)
-            stats['cached'] += 1
-            continue
+    def geocode(intersection):
+        return get_geocode(intersection, city)
 
-        try:
-            latitude, longitude, elevation = get_lat_lng_and_elevation(intersection, city)
-            stats['good'] += 1
-        except NotIntersectionAddressException:
+    def record(intersection, result, error):
+        if isinstance(error, NotIntersectionAddressException):
             bad_address_cache['not_intersection'].add(intersection)
+            if journal:
+                journal.record_bad_address('not_intersection', intersection)
             stats['bad'] += 1
-            continue
-        except AmbiguousAddressException:
+            return
+        elif isinstance(error, AmbiguousAddressException):
             bad_address_cache['ambiguous'].add(intersection)
+            if journal:
+                journal.record_bad_address('ambiguous', intersection)
             stats['bad'] += 1
-            continue
-        except Exception as e:
-            logging.error(e)
+            return
+        elif isinstance(error, QuotaExhaustedException):
+            stats['deferred'] += 1
+            return
+        elif error is not None:
+            logging.error(error)
             stats['error'] += 1
-            continue
+            return
+
+        latitude, longitude, elevation = result
+        stats['good'] += 1
 
         i_cache[intersection] = {'lat': latitude,
                                 'lng': longitude,
                                 'elevation': elevation,
                                }
+        if journal:
+            journal.record_intersection(intersection, i_cache[intersection])
 
         logging.info(' [fetched] %s  %s' % \
             (intersection, str(i_cache[intersection])))
@@ -325,19 +1461,72 @@ def lookup_all_intersections(cache, intersections, bad_address_cache, city):
         print ' [fetched] %s  %s' % (intersection, str(i_cache[intersection]))
 
         # If we in fact added this new intersection, add it to the paths list. We'll sort later.
-        parts = intersection.split(' and ')
-        for index in (0, 1):
-            if parts[index] not in p_cache:
-                p_cache[parts[index]] = [intersection]
+        for street in intersection_key(intersection):
+            if street not in p_cache:
+                p_cache[street] = [intersection]
             else:
-                p_cache[parts[index]].append(intersection)
+                p_cache[street].append(intersection)
+
+    cached_keys = index_intersections(i_cache)
+    bad_keys = index_intersections(bad_address_cache['not_intersection'])
+    bad_keys.update(index_intersections(bad_address_cache['ambiguous']))
+
+    pending = []
+    for key in intersections:
+        intersection = intersection_name(key)
+        if key in bad_keys:
+            logging.info(' [skipped] %s' % intersection)
+            stats['skipped'] += 1
+            continue
+
+        if key in cached_keys:
+            logging.info(' [cached] %s' % intersection)
+            stats['cached'] += 1
+            continue
+
+        pending.append(key)
+    profiler.count('intersections', True, stats['cached'])
+    profiler.count('intersections', False, len(pending))
+
+    if budget is not None:
+        pending = prioritize_intersections(pending)
+        affordable = budget.affordable_lookups(len(pending), LOOKUP_CHUNK_SIZE)
+        stats['deferred'] += len(pending) - affordable
+        pending = pending[:affordable]
+    pending = [intersection_name(key) for key in pending]
+
+    # Work through the lookups a chunk at a time: geocode the chunk, then look
+    # up its elevations as a batch, so results are recorded as we go.
+    exhausted = False
+    for chunk_start in range(0, len(pending), LOOKUP_CHUNK_SIZE):
+        chunk = pending[chunk_start:chunk_start + LOOKUP_CHUNK_SIZE]
+        geocodes = list(fetch_concurrently(geocode, chunk, workers))
+        elevations, elevation_errors = lookup_elevations(
+            [(name, latlng) for name, latlng, error in geocodes if error is None], workers)
+
+        for intersection, latlng, error in geocodes:
+            result = None
+            if error is None:
+                if intersection in elevation_errors:
+                    error = elevation_errors[intersection]
+                else:
+                    result = latlng + (elevations[intersection],)
+            if isinstance(error, QuotaExhaustedException):
+                exhausted = True
+            record(intersection, result, error)
+
+        if exhausted:
+            # out of budget part way through; everything after this waits too
+            stats['deferred'] += len(pending) - chunk_start - len(chunk)
+            break
+
 
     return cache, bad_address_cache, stats
 
-@timeit
-def sort_path_cache(cache, input_data):
+@profiler.stage
+def sort_path_cache(cache, city_data, paths=None):
     """
-    Do cool stuff
+    Do cool stuff. Given paths, only those are sorted.
 
     # Now, sort the path cache, so that all paths' intersections go from west -> east or south -> south.
     # TODO: Persist, somehow, exceptions (i.e. 2nd Ave -> Fulton to Lincoln are actually two paths)
@@ -356,228 +1545,527 @@ def sort_path_cache(cache, input_data):
     # NOW DO THE SORT PER STREET
 
     """
-    i_cache = cache['intersections']
     p_cache = cache['paths']
-    cp_cache = cache['custom_path_names']
+    cp_cache = set(cache['custom_path_names'])
+    table = IntersectionTable(cache['intersections'])
+
+    # do NOT sort custom paths
+    paths = [path for path in (p_cache if paths is None else paths) if path in p_cache and path not in cp_cache]
+
+    # Lay every path's intersection ids end to end, with the index of the path
+    # each belongs to, so all the paths are sorted at once.
+    # kill all the control data in the cache - we will recompute these every time.
+    # i.e. --BREAK, etc.
+    id_lists = [[table.ids[k] for k in p_cache[path] if not k.startswith('--')] for path in paths]
+    lengths = numpy.array([len(id_list) for id_list in id_lists], dtype=numpy.intp)
+    ids = numpy.fromiter(itertools.chain.from_iterable(id_lists), dtype=numpy.intp, count=lengths.sum())
+    path_indices = numpy.repeat(numpy.arange(len(paths)), lengths)
+
+    # just make sure everything is unique... keeping the first of any repeats.
+    _, first_indices = numpy.unique(path_indices * len(table.names) + ids, return_index=True)
+    if len(first_indices) < len(ids):
+        logging.info('dropping %d repeated intersections' % (len(ids) - len(first_indices)))
+        keep = numpy.sort(first_indices)
+        ids = ids[keep]
+        path_indices = path_indices[keep]
+        lengths = numpy.bincount(path_indices, minlength=len(paths))
+
+    # compute the min and max lats and lngs of every (non-empty) path
+    starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+    lats = table.lat[ids]
+    lngs = table.lng[ids]
+    use_lng = numpy.zeros(len(paths), dtype=bool)
+    present = lengths > 0
+    if present.any():
+        present_starts = starts[present]
+        lat_extent = numpy.maximum.reduceat(lats, present_starts) - numpy.minimum.reduceat(lats, present_starts)
+        lng_extent = numpy.maximum.reduceat(lngs, present_starts) - numpy.minimum.reduceat(lngs, present_starts)
+        use_lng[present] = numpy.abs(lng_extent) > numpy.abs(lat_extent)
+
+    # sort each path by lng (west -> east) or lat (south -> north). lexsort
+    # is stable, so ties keep their order like sorted() does.
+    choice = numpy.where(use_lng[path_indices], lngs, lats)
+    sorted_ids = ids[numpy.lexsort((choice, path_indices))]
+    sorted_names = [table.names[i] for i in sorted_ids]
+
+    for index, path in enumerate(paths):
+        start = starts[index]
+        sorted_path = sorted_names[start:start + lengths[index]]
 
-    for path in p_cache:
-        # do NOT sort custom paths
-        if path in cp_cache:
+        # Add the breaks!
+        breaks = city_data.get_path_breaks(path)
+        if not breaks:
+            p_cache[path] = sorted_path
             continue
 
-        #print path,
-
-        # kill all the control data in the cache - we will recompute these every time.
-        # i.e. --BREAK, etc.
-        p_cache[path] = filter(lambda k: not k.startswith('--'), p_cache[path])
-
-        # just make sure everything is unique...
-        try:
-            assert len(p_cache[path]) == len(set(p_cache[path]))
-        except AssertionError:
-            print p_cache[path]
-            p_cache[path] = list(set(p_cache[path]))
-
-        # compute the min and max lats
-        min_lat = i_cache[min(p_cache[path], key=lambda k: i_cache[k]['lat'])]['lat']
-        max_lat = i_cache[max(p_cache[path], key=lambda k: i_cache[k]['lat'])]['lat']
-        min_lng = i_cache[min(p_cache[path], key=lambda k: i_cache[k]['lng'])]['lng']
-        max_lng = i_cache[max(p_cache[path], key=lambda k: i_cache[k]['lng'])]['lng']
-
-        #print min_lat, min_lng, max_lat, max_lng
-
-        if abs(max_lng - min_lng) > abs(max_lat - min_lat):
-            choice = 'lng'
-        else:
-            choice = 'lat'
-
-        # use sorted() for creating new object, sort() for inplace.
-        sorted_path = sorted(p_cache[path], key=lambda k: i_cache[k][choice])
-
-        #if choice == 'lat':
-            #print 'south -> north'
-        #if choice == 'lng':
-            #print 'west -> east'
-
-        # Add the breaks!
-        breaks = get_path_breaks(input_data, path)
+        break_mask = table.get_break_mask(sorted_ids[start:start + lengths[index]], breaks)
         path_with_breaks = []
-        for intersection in sorted_path:
+        for intersection, is_break in zip(sorted_path, break_mask):
             path_with_breaks.append(intersection)
-            parts = intersection.split(' and ')
-            if parts[0] in breaks or parts[1] in breaks:
+            if is_break:
                 path_with_breaks.append('--BREAK')
 
-        #print path_with_breaks
-
         p_cache[path] = path_with_breaks
 
     return cache
 
-@timeit
-def lookup_curved_road_directions(cache, input_data, city):
-    p_cache = cache['paths']
-    d_cache = cache['directions']
-    curved_roads = get_curved_roads(input_data)
-
-    for road, curved_sections in curved_roads.iteritems():
-        in_section = False
-        last_intersection = None
-        for intersection in p_cache[road]:
-            if len(curved_sections) == 0:
-                break
-
-            secondary_street = curved_sections[0][0] if not in_section else curved_sections[0][1]
-            int_name1 = ' and '.join([road, secondary_street])
-            int_name2 = ' and '.join([secondary_street, road])
-
-            # Start the section if needed. We will call direction API on the NEXT intersection.
-            if not in_section and (int_name1 == intersection or int_name2 == intersection):
-                in_section = True
+def path_positions(path_intersections):
+    """
+    Given a sorted path, return the key of each of its intersections to its
+    (first) index in the path.
+    """
+    positions = {}
+    for index, intersection in enumerate(path_intersections):
+        positions.setdefault(intersection_key(intersection), index)
+    return positions
 
-            # Call the direction API.
-            elif in_section:
-                key_name = '%s | %s' % (last_intersection, intersection)
-                if key_name in d_cache:
-                    logging.info(' [skipped directions] %s -> %s' % (last_intersection, intersection))
-                else:
-                    d_cache[key_name] = get_directions_and_length(last_intersection, intersection, city)
-                    print ' [fetched directions] %s -> %s' % (last_intersection, intersection)
+def resolve_sections(path_intersections, path, sections, unresolved=None):
+    """
+    Given a sorted path and its sections (each starting with the cross streets
+    at either end, in either order), yield (first, last, section) for each,
+    the indexes of its ends in the path. Sections with an end that isn't on
+    the path are appended to unresolved, if given, instead.
+    """
+    positions = path_positions(path_intersections)
+    for section in sections:
+        start = positions.get(intersection_key(' and '.join([path, section[0]])))
+        end = positions.get(intersection_key(' and '.join([path, section[1]])))
+        if start is None or end is None or start == end:
+            if unresolved is not None:
+                unresolved.append((path, section))
+            continue
+        yield min(start, end), max(start, end), section
 
-                # Are we done with this section?
-                if int_name1 == intersection or int_name2 == intersection:
-                    in_section = False
-                    curved_sections.pop(0)
+def report_unresolved_sections(unresolved, kind):
+    for path, section in unresolved:
+        logging.warning(' [unresolved %s] %s: %s to %s' % (kind, path, section[0], section[1]))
 
-            last_intersection = intersection
+def curved_road_legs(p_cache, curved_roads, unresolved=None):
+    """
+    Given the sorted path cache and the curved roads, yield an (origin,
+    destination) pair of intersections for every step along a curved section,
+    except across breaks. Sections that can't be found on their road are
+    appended to unresolved, if given.
+    """
+    for road, curved_sections in curved_roads.iteritems():
+        path_intersections = p_cache.get(road, [])
+        for first, last, _ in resolve_sections(path_intersections, road, curved_sections, unresolved):
+            section_intersections = path_intersections[first:last + 1]
+            for origin, destination in zip(section_intersections, section_intersections[1:]):
+                if origin != '--BREAK' and destination != '--BREAK':
+                    yield origin, destination
+
+@profiler.stage
+def lookup_curved_road_directions(cache, city_data, city, journal=None, incomplete_streets=(), roads=None):
+    """
+    Get directions along every curved section of road (or just the roads
+    given), except on the incomplete streets given, whose intersections are
+    still being looked up.
+    """
+    p_cache = cache['paths']
+    d_cache = cache['directions']
+    curved_roads = city_data.get_curved_roads()
+    if roads is not None:
+        curved_roads = dict((road, sections) for road, sections in curved_roads.iteritems() if road in roads)
+    for road in incomplete_streets:
+        if curved_roads.pop(road, None) is not None:
+            logging.info(' [deferred directions] %s' % road)
+
+    # Call the direction API, a section (or as much of it as one request
+    # takes) at a time.
+    unresolved = []
+    lookup_directions(d_cache, list(curved_road_legs(p_cache, curved_roads, unresolved)), city, journal=journal)
+    report_unresolved_sections(unresolved, 'curved road section')
 
     return cache
 
-@timeit
-def lookup_and_add_custom_paths(cache, input_data, city):
+@profiler.stage
+def lookup_and_add_custom_paths(cache, city_data, city, workers=1, journal=None, budget=None):
+    """
+    Look up every custom path's intersections, add the paths to the caches
+    and get directions along them.
+
+    Given a budget, the paths with the fewest intersections left to look up
+    go first, and only complete paths get directions.
+    """
     i_cache = cache['intersections']
     p_cache = cache['paths']
     d_cache = cache['directions']
     cp_cache = cache['custom_path_names']
 
-    custom_paths = get_custom_paths(input_data)
+    custom_paths = city_data.get_custom_paths()
+
+    # look up every custom intersection that is not cached, under either
+    # order of its streets, before building any of the paths, so elevations
+    # can be batched.
+    cached_keys = index_intersections(i_cache)
+    ordered_paths = custom_paths.keys()
+    if budget is not None:
+        ordered_paths.sort(key=lambda custom_path: (len([
+            intersection for intersection in custom_paths[custom_path]['path']
+            if intersection_key(intersection) not in cached_keys]), custom_path))
+
+    pending = []
+    pending_keys = set([])
+    for custom_path in ordered_paths:
+        for intersection in custom_paths[custom_path]['path']:
+            key = intersection_key(intersection)
+            if key in cached_keys:
+                logging.info(' [cached custom intersection] %s' % intersection)
+                profiler.count('custom_intersections', True)
+            elif key not in pending_keys:
+                pending.append(intersection)
+                pending_keys.add(key)
+                profiler.count('custom_intersections', False)
+
+    def geocode(intersection):
+        return get_geocode(intersection, city, custom=True)
+
+    if budget is not None:
+        pending = pending[:budget.affordable_lookups(len(pending), len(pending) or 1)]
+
+    geocodes = list(fetch_concurrently(geocode, pending, workers))
+    for intersection, latlng, error in geocodes:
+        # TODO: error handling similar to lookup_all_intersections
+        if error is not None and not isinstance(error, QuotaExhaustedException):
+            raise error
+    geocodes = [(intersection, latlng) for intersection, latlng, error in geocodes if error is None]
+    elevations, elevation_errors = lookup_elevations(geocodes, workers)
+    for error in elevation_errors.itervalues():
+        if not isinstance(error, QuotaExhaustedException):
+            raise error
+
+    for intersection, (latitude, longitude) in geocodes:
+        if intersection not in elevations:
+            continue
+        i_cache[intersection] = {'lat': latitude,
+                                'lng': longitude,
+                                'elevation': elevations[intersection]}
+        if journal:
+            journal.record_custom_intersection(intersection, i_cache[intersection])
+        cached_keys[intersection_key(intersection)] = intersection
+
+        # if one street matches, add it to the pcache to be sorted
+        for street in intersection_key(intersection):
+            if street in p_cache:
+                p_cache[street].append(intersection)
 
-    for custom_path, entry in custom_paths.iteritems():
-        intersections = entry['path']
+        print ' [fetched] %s  %s' % (intersection, str(i_cache[intersection]))
+
+    out_of_budget = False
+    for custom_path in ordered_paths:
+        intersections = custom_paths[custom_path]['path']
         cache['custom_path_names'].append(custom_path)
         p_cache[custom_path] = []
 
         for intersection in intersections:
-            # look it up if it, or its flip, is not there already
-            parts = intersection.split(' and ')
-            # ONLY FOR CUSTOM PATHS - we can do without flips
-            if len(parts) < 2:
-                flipped_intersection = intersection
-            else:
-                flipped_intersection = parts[1] + ' and ' + parts[0]
-            if intersection not in i_cache and flipped_intersection not in i_cache:
-                latitude, longitude, elevation = get_lat_lng_and_elevation(intersection, city, custom=True)
-                # TODO: error handling similar to lookup_all_intersections
-                i_cache[intersection] = {'lat': latitude,
-                                        'lng': longitude,
-                                        'elevation': elevation}
-
-                # if one street matches, add it to the pcache to be sorted
-                for part in parts:
-                    if part in p_cache:
-                        p_cache[part].append(intersection)
-
-                print ' [fetched] %s  %s' % (intersection, str(i_cache[intersection]))
+            # make sure we add the cached one to the path, whichever
+            # order its streets are in.
+            if intersection in i_cache:
                 p_cache[custom_path].append(intersection)
-            else:
-                logging.info(' [cached custom intersection] %s' % intersection)
-                # if the intersection or its flip is already cached, make sure
-                # we add the cached one to the path.
-                if intersection in i_cache:
-                    p_cache[custom_path].append(intersection)
-                elif flipped_intersection in i_cache:
-                    p_cache[custom_path].append(flipped_intersection)
-
-        # get directions for all the intersections
-        # note that we are used the possibly flipped intersections in p_cache
-        last_intersection = None
-        for intersection in p_cache[custom_path]:
-            if last_intersection is None:
-                last_intersection = intersection
-                continue
+            elif intersection_key(intersection) in cached_keys:
+                p_cache[custom_path].append(cached_keys[intersection_key(intersection)])
 
-            key_name = '%s | %s' % (last_intersection, intersection)
-            if key_name in d_cache:
-                logging.info(' [skipped custom directions] %s -> %s' % (last_intersection, intersection))
-            else:
-                d_cache[key_name] = get_directions_and_length(last_intersection, intersection, city)
-                print ' [fetched custom directions] %s -> %s' % (last_intersection, intersection)
+        # an incomplete path would get directions between the wrong
+        # intersections; wait until it is complete.
+        if budget is not None and (out_of_budget or len(p_cache[custom_path]) < len(intersections)):
+            logging.info(' [deferred custom directions] %s' % custom_path)
+            continue
 
-            last_intersection = intersection
+        # get directions for all the intersections, as many legs a request
+        # as the API takes
+        # note that we are used the possibly flipped intersections in p_cache
+        path = p_cache[custom_path]
+        if not lookup_directions(d_cache, zip(path, path[1:]), city, journal=journal, kind='custom directions'):
+            logging.info(' [deferred custom directions] %s' % custom_path)
+            out_of_budget = True
 
     return cache
 
-@timeit
-def define_route_directives(cache, input_data):
+@profiler.stage
+def define_route_directives(cache, city_data, memo=None):
+    """
+    Work out the route directives of every route directive section and
+    route or path custom path, over the sorted paths.
+
+    Given a memo dict (of a fingerprint of each one's definition and path to
+    the directives it gave), the ones whose fingerprint is in it are reused
+    instead of walked again, and the memo is left holding just the current
+    ones. Returns the cache and the number walked.
+    """
     p_cache = cache['paths']
     # start from scratch every time.
     rd_cache = {}
 
-    route_directives = get_route_directives(input_data)
+    definitions = [(['sections', path, sections], path) for path, sections in city_data.get_route_directives()]
 
-    for route_directive in route_directives:
-        path, sections = route_directive
-        in_section = False
-        last_intersection = None
+    # Get any route directives in custom paths as well
+    # Note; we need to use the p_cache, since it has been sorted and cleaned (i.e. Baker St + Fell St -> Fell St + Baker St)
+    custom_paths = city_data.get_custom_paths()
+    for custom_path, entry in custom_paths.iteritems():
+        if 'type' in entry and entry['type'] in ['route', 'path']:
+            definitions.append((['custom', custom_path, entry['type']], custom_path))
+
+    current_memo = {}
+    unresolved = []
+    walked = 0
+    for definition, path in definitions:
+        fingerprint = fingerprint_of([definition, p_cache.get(path, [])])
+        if memo is not None and fingerprint in memo:
+            directives = memo[fingerprint]
+        elif definition[0] == 'sections':
+            directives = find_section_route_directives(p_cache.get(path, []), path, definition[2], unresolved)
+            walked += 1
+        else:
+            directives = find_custom_route_directives(p_cache[path], definition[2])
+            walked += 1
+        current_memo[fingerprint] = directives
+        # later definitions override earlier ones, like they always have
+        rd_cache.update(directives)
 
-        for intersection in p_cache[path]:
-            if len(sections) == 0:
-                break
+    report_unresolved_sections(unresolved, 'route directive section')
 
-            secondary_street = sections[0][0] if not in_section else sections[0][1]
-            int_name1 = ' and '.join([path, secondary_street])
-            int_name2 = ' and '.join([secondary_street, path])
-            # Start the section if needed. We will add route directive on the NEXT intersection.
-            if not in_section and (int_name1 == intersection or int_name2 == intersection):
-                in_section = True
+    if memo is not None:
+        memo.clear()
+        memo.update(current_memo)
 
-            # Add the route directive
-            elif in_section:
-                key_name = '%s | %s' % (last_intersection, intersection)
-                rd_cache[key_name] = sections[0][2]
+    # BREAKS OVERRIDE ROUTE DIRECTIVES
+    cache['route_directives'] = rd_cache
+    return cache, walked
 
-                # Are we done with this section?
-                if int_name1 == intersection or int_name2 == intersection:
-                    in_section = False
-                    sections.pop(0)
+def find_section_route_directives(path_intersections, path, sections, unresolved=None):
+    """
+    Given a sorted path and its (start, end, type) sections, return the
+    route directives along them. Sections that can't be found on the path
+    are appended to unresolved, if given.
+    """
+    rd_cache = {}
+    for first, last, section in resolve_sections(path_intersections, path, sections, unresolved):
+        for index in xrange(first, last):
+            rd_cache['%s | %s' % (path_intersections[index], path_intersections[index + 1])] = section[2]
+    return rd_cache
 
-                    # Start the NEXT section immediately if needed.
-                    if len(sections) == 0:
-                        break
-                    secondary_street = sections[0][0] if not in_section else sections[0][1]
-                    int_name1 = ' and '.join([path, secondary_street])
-                    int_name2 = ' and '.join([secondary_street, path])
+def find_custom_route_directives(path_intersections, route_type):
+    """
+    Given a custom path and its type, return the route directives along it.
+    """
+    rd_cache = {}
+    for index, intersection in enumerate(path_intersections):
+        if index+1 == len(path_intersections):
+            continue
+        key_name = '%s | %s' % (intersection, path_intersections[index+1])
+        rd_cache[key_name] = route_type
+    return rd_cache
 
-                    if int_name1 == intersection or int_name2 == intersection:
-                        in_section = True
+#################
+# build planning
+#################
+def plan_build(cache, intersections, bad_address_cache, city_data, rate_limit=None):
+    """
+    Work out which Google API requests a build would make, without making any.
 
+    Counts geocode, elevation and directions requests against the cache, the
+    bad address cache and the fetch store (if there is one), and returns them
+    in a dict along with the uncached keys and, given a rate limit in requests
+    per second, an estimate of the wall time.
 
-            last_intersection = intersection
+    Elevation counts assume every geocode succeeds, so they are an upper
+    bound. Directions along curved roads can only be worked out over the
+    intersections we already have, so roads with intersections still to look
+    up are listed as incomplete.
+    """
+    i_cache = cache['intersections']
+    d_cache = cache['directions']
+    city = city_data.city
 
-    # Get any route directives in custom paths as well
-    # Note; we need to use the p_cache, since it has been sorted and cleaned (i.e. Baker St + Fell St -> Fell St + Baker St)
-    custom_paths = get_custom_paths(input_data)
-    for custom_path, entry in custom_paths.iteritems():
-        if 'type' in entry and entry['type'] in ['route', 'path']:
-            for index, intersection in enumerate(p_cache[custom_path]):
-                if index+1 == len(p_cache[custom_path]):
-                    continue
-                key_name = '%s | %s' % (intersection, p_cache[custom_path][index+1])
-                rd_cache[key_name] = entry['type']
+    cached_keys = index_intersections(i_cache)
+
+    def count_lookups(names):
+        geocodes = 0
+        elevation_points = 0
+        for name in names:
+            if geocoder is not None:
+                stored = geocoder.geocode(name)
+            else:
+                stored = fetch_store.get_geocode(name, city) if fetch_store is not None else None
+            if stored is None:
+                geocodes += 1
+                if elevation_source is None:
+                    elevation_points += 1
+            elif stored[0] == 'ok' and not sample_dem_elevations([(stored[1], stored[2])]) and \
+                    (fetch_store is None or not fetch_store.get_elevations([(stored[1], stored[2])])):
+                elevation_points += 1
+        return geocodes, elevation_points
+
+    def needs_directions(origin, destination):
+        if '%s | %s' % (origin, destination) in d_cache:
+            return False
+        return fetch_store is None or fetch_store.get_directions(origin, destination, city) is None
+
+    # intersections
+    uncached_keys = find_uncached_intersections(i_cache, intersections, bad_address_cache)
+    uncached_intersections = sorted(intersection_name(key) for key in uncached_keys)
+    geocodes, elevation_points = count_lookups(uncached_intersections)
+    elevations = estimate_elevation_requests(elevation_points, LOOKUP_CHUNK_SIZE)
+
+    # custom paths, and the directions between their intersections
+    custom_paths = city_data.get_custom_paths()
+    uncached_custom = []
+    custom_keys = set([])
+    uncached_directions = []
+    # anything the intersection lookup fetches is cached by the time custom
+    # paths are looked up, under its key's name.
+    planned_keys = dict(cached_keys)
+    planned_keys.update((key, intersection_name(key)) for key in uncached_keys)
+    for custom_path, entry in sorted(custom_paths.iteritems()):
+        path = []
+        for intersection in entry['path']:
+            key = intersection_key(intersection)
+            if intersection in i_cache or key not in planned_keys:
+                path.append(intersection)
+            else:
+                path.append(planned_keys[key])
+            if key not in planned_keys and key not in custom_keys:
+                uncached_custom.append(intersection)
+                custom_keys.add(key)
+        for origin, destination in zip(path, path[1:]):
+            if needs_directions(origin, destination):
+                uncached_directions.append('%s | %s' % (origin, destination))
+
+    custom_geocodes, custom_elevation_points = count_lookups(uncached_custom)
+    geocodes += custom_geocodes
+    elevations += estimate_elevation_requests(custom_elevation_points, custom_elevation_points or 1)
+
+    # curved roads, over a sorted copy of the paths we have so far
+    planned_cache = {'intersections': i_cache,
+                     'paths': dict((path, list(intersections)) for path, intersections in cache['paths'].iteritems()),
+                     'custom_path_names': custom_paths.keys()}
+    sort_path_cache(planned_cache, city_data)
+    curved_roads = city_data.get_curved_roads()
+    for origin, destination in curved_road_legs(planned_cache['paths'], curved_roads):
+        if needs_directions(origin, destination) and '%s | %s' % (origin, destination) not in uncached_directions:
+            uncached_directions.append('%s | %s' % (origin, destination))
+    pending_streets = set(street for key in uncached_keys for street in key)
+    incomplete_curved_roads = sorted(road for road in curved_roads if road in pending_streets)
+
+    request_counts = {'geocode': geocodes, 'elevation': elevations,
+                      'directions': count_directions_requests([leg.split(' | ') for leg in uncached_directions])}
+    total_requests = sum(request_counts.values())
+    return {
+        'requests': request_counts,
+        'total_requests': total_requests,
+        'estimated_seconds': total_requests / float(rate_limit) if rate_limit else None,
+        'uncached': {
+            'intersections': uncached_intersections,
+            'custom_intersections': uncached_custom,
+            'directions': uncached_directions,
+        },
+        'incomplete_curved_roads': incomplete_curved_roads,
+    }
+
+####################
+# incremental rebuilds
+####################
+def fingerprint_of(value):
+    """
+    Return a short, stable fingerprint of anything JSON can hold.
+    """
+    return hashlib.md5(json.dumps(value, sort_keys=True)).hexdigest()
+
+def path_fingerprint(cache, city_data, path):
+    """
+    Fingerprint what a path's sorted order depends on: which intersections
+    are on it, where each one is, and its breaks.
+    """
+    i_cache = cache['intersections']
+    members = sorted(set(intersection for intersection in cache['paths'][path] if not intersection.startswith('--')))
+    return fingerprint_of([[(intersection, i_cache[intersection]['lat'], i_cache[intersection]['lng'])
+                            for intersection in members],
+                           sorted(city_data.get_path_breaks(path))])
+
+class BuildFingerprints(object):
+    """
+    What went into a build's output, kept next to it, so an incremental build
+    only redoes what has changed since:
+
+      - regions: a fingerprint of each region. Only new or changed regions
+        have their intersections computed and looked up, along with any
+        still pending (failed, deferred or pruned) from the last build.
+      - paths: a fingerprint of each path's intersections, their locations
+        and its breaks. Only changed paths are sorted again.
+      - curved_roads: a fingerprint of each curved road's sections and sorted
+        path, for roads with all their directions. Only the rest are walked.
+      - route_directives: the directives each route directive section and
+        custom path gave, by a fingerprint of it and its sorted path.
+
+    Fingerprints are only trusted for the output they were written with.
+    """
+    def __init__(self, path, buildtimestamp=None):
+        self.path = path
+        self.valid = False
+        self.regions = set([])
+        self.pending = set([])
+        self.paths = {}
+        self.curved_roads = {}
+        self.route_directives = {}
+
+        if buildtimestamp is None or not os.path.exists(path):
+            return
+        with open(path) as fingerprints_fp:
+            data = json.load(fingerprints_fp)
+        if data.get('buildtimestamp') != buildtimestamp:
+            logging.warning('%s is not from the last build; rebuilding everything' % path)
+            return
+        self.valid = True
+        self.regions = set(data['regions'])
+        self.pending = set(tuple(intern_street(street) for street in key) for key in data['pending'])
+        self.paths = data['paths']
+        self.curved_roads = data['curved_roads']
+        self.route_directives = data['route_directives']
+
+    def changed_regions(self, city_data):
+        return [region for region in city_data.get_regions() if fingerprint_of(region) not in self.regions]
+
+    def changed_paths(self, cache, city_data):
+        """
+        Return the paths (not custom paths) whose sorted order may have changed.
+        """
+        custom_path_names = set(cache['custom_path_names'])
+        return [path for path in cache['paths'] if path not in custom_path_names and
+                self.paths.get(path) != path_fingerprint(cache, city_data, path)]
+
+    def changed_curved_roads(self, cache, city_data):
+        p_cache = cache['paths']
+        return [road for road, sections in city_data.get_curved_roads().iteritems()
+                if self.curved_roads.get(road) != fingerprint_of([sections, p_cache.get(road, [])])]
+
+    def save(self, cache, city_data, pending):
+        """
+        Fingerprint the finished build, with the intersection keys still
+        pending, and write it out.
+        """
+        p_cache = cache['paths']
+        d_cache = cache['directions']
+        custom_path_names = set(cache['custom_path_names'])
+
+        curved_roads = {}
+        for road, sections in city_data.get_curved_roads().iteritems():
+            legs = curved_road_legs({road: p_cache.get(road, [])}, {road: list(sections)})
+            if all('%s | %s' % leg in d_cache for leg in legs):
+                curved_roads[road] = fingerprint_of([sections, p_cache.get(road, [])])
+
+        data = {
+            'buildtimestamp': cache['buildtimestamp'],
+            'regions': sorted(fingerprint_of(region) for region in city_data.get_regions()),
+            'pending': sorted(pending),
+            'paths': dict((path, path_fingerprint(cache, city_data, path))
+                          for path in p_cache if path not in custom_path_names),
+            'curved_roads': curved_roads,
+            'route_directives': self.route_directives,
+        }
+        with open(self.path, 'w') as fingerprints_fp:
+            json.dump(data, fingerprints_fp, sort_keys=True)
 
-    # BREAKS OVERRIDE ROUTE DIRECTIVES
-    cache['route_directives'] = rd_cache
-    return cache
 
 #################
 # main script executable
@@ -585,18 +2073,75 @@ def define_route_directives(cache, input_data):
 
 parser = argparse.ArgumentParser()
 
-parser.add_argument('-f', '--force', action='store_true', help='force an overwrite of any existing scraped keys')
+parser.add_argument('-f', '--force', action='store_true', help='force an overwrite of any existing scraped keys '
+                    '(a journal left by an interrupted build is still replayed)')
 parser.add_argument('-v', '--verbose', action='store_true', help='display all informational logging')
 parser.add_argument('-d', '--debug', action='store_true', help='display all debug logging')
+parser.add_argument('-w', '--workers', type=int, default=1, help='number of concurrent intersection lookups')
+parser.add_argument('--rate-limit', type=float, default=None, help='maximum Google API requests per second')
+parser.add_argument('--pool-size', type=int, default=10, help='number of keep-alive connections to the Google API')
+parser.add_argument('--max-retries', type=int, default=5, help='retries for quota and server errors, with exponential backoff')
+parser.add_argument('--store', default=None, help='SQLite store of fetched data, shared across cities and builds')
+parser.add_argument('--store-ttl', type=float, default=None, help='refetch stored data older than this many days')
+parser.add_argument('--daily-budget', default=None, metavar='ENDPOINT=LIMIT,...',
+                    help='daily request budget per endpoint (i.e. geocode=2500,elevation=2500,directions=2500); '
+                    'the build fetches what it can afford, most complete paths first, and resumes next run')
+parser.add_argument('--budget-state', default=None,
+                    help='where to keep what has been spent today (default: OUTPUT_FILE.quota.json)')
+parser.add_argument('--plan', default=None, metavar='PLAN_FILE',
+                    help='write a JSON plan of the API requests the build would make to this file, '
+                    'then exit without any network access')
+parser.add_argument('--geocoder', choices=['google', 'osm'], default='google',
+                    help='geocode intersections with the Google API, or offline from --osm-extract')
+parser.add_argument('--osm-extract', default=None, metavar='OSM_FILE',
+                    help='OpenStreetMap XML extract of the city (.osm, .osm.bz2 or .osm.gz), for --geocoder osm')
+parser.add_argument('--dem-dir', default=None, metavar='DEM_DIR',
+                    help='sample elevations from the SRTM .hgt / GeoTIFF tiles here, asking the API only outside them')
+parser.add_argument('--dem-open-tiles', type=int, default=dem_elevation.DEFAULT_OPEN_TILES, metavar='N',
+                    help='DEM tiles to keep memory mapped at once (default: %d)' % dem_elevation.DEFAULT_OPEN_TILES)
+parser.add_argument('--tile-zoom', type=int, default=None, metavar='ZOOM',
+                    help='also write the city as map tiles at this zoom (i.e. 14) to OUTPUT_FILE-tiles/, '
+                    'so the map only loads what is in view')
+parser.add_argument('--alt-landmarks', type=int, default=0, metavar='K',
+                    help='also precompute K ALT landmarks (i.e. 16) for fast route queries, '
+                    'to OUTPUT_FILE-landmarks.bin')
+parser.add_argument('--incremental', action='store_true',
+                    help='only redo the intersections, paths, curved roads and route directives whose inputs '
+                    'changed since the last build (tracked in OUTPUT_FILE.fingerprints.json)')
+parser.add_argument('--prune', action='store_true',
+                    help='skip street pairs whose known shapes never come near each other, so cannot meet')
+parser.add_argument('--prune-margin', type=float, default=PRUNE_MARGIN, metavar='METERS',
+                    help='how near street shapes must come to be kept by --prune (default: %d)' % PRUNE_MARGIN)
+parser.add_argument('--prune-conservative', action='store_true',
+                    help='with --prune, only skip pairs whose bounding boxes are that far apart, and never cached ones')
+parser.add_argument('--metrics', default=None, metavar='METRICS_FILE',
+                    help='write stage timings, request latencies and cache hits to this JSON file')
+parser.add_argument('--profile', default=None, metavar='PSTATS_FILE',
+                    help='run the build under cProfile and write its stats to this file')
 parser.add_argument('input_data', help="input data file (i.e. data/sf_test.py)")
 parser.add_argument('output_file', help="output file location")
 parser.add_argument('bad_cache', help="cache for bad addresses")
 
 
-if __name__ == "__main__":
+def run_build(args):
+    """
+    Build a city, given its command line args, and return a summary dict
+    of what was fetched. With --profile, the build runs under cProfile.
+    """
+    if args.profile:
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(run_stages, args)
+        finally:
+            profile.dump_stats(args.profile)
+    return run_stages(args)
+
+def run_stages(args):
+    global fetch_store, geocoder, elevation_source
+
     now = time.time()
-    args = parser.parse_args()
     print args
+    profiler.reset()
 
 
     if args.verbose:
@@ -606,16 +2151,49 @@ if __name__ == "__main__":
 
     logging.getLogger('requests.packages.urllib3.connectionpool').setLevel(logging.WARNING)
 
+    # (a limiter shared with other builds keeps its rate unless one is given)
+    if args.rate_limit is not None or not isinstance(rate_limiter, SharedRateLimiter):
+        rate_limiter.set_rate(args.rate_limit)
+    api_session.configure(pool_size=max(args.pool_size, args.workers), max_retries=args.max_retries)
+    api_session.stats = {}
+    api_session.budget = None
+    if args.store:
+        fetch_store = FetchStore(args.store, ttl=args.store_ttl * 24 * 60 * 60 if args.store_ttl else None)
+
+    # Get the intersection data
+    city_data = CityDefinition(args.input_data)
+
+    geocoder = None
+    if args.geocoder == 'osm':
+        if not args.osm_extract:
+            raise osm_geocoder.OsmExtractException('--geocoder osm needs an --osm-extract')
+        geocoder = osm_geocoder.OsmGeocoder.load(args.osm_extract)
+        # only the city's own streets, if the extract covers other towns too
+        bounds = city_data.get_bounds()
+        if bounds is not None:
+            geocoder = geocoder.within(*bounds)
+        else:
+            geocoder.check_single_city(city_data.city)
+        print "OSM street pairs that meet:", len(geocoder.intersections)
+    elevation_source = None
+    if args.dem_dir:
+        elevation_source = dem_elevation.DemElevation(args.dem_dir, open_tiles=args.dem_open_tiles)
+        print "DEM tiles:", len(elevation_source.tiles)
+
     # Set the cache from an existing output file
     if args.force or not os.path.exists(args.output_file):
         cache = {'paths': {}, 'intersections': {}, 'directions': {}, 'custom_path_names': []}
     else:
-        with open(args.output_file) as filecache:
-            cache = json.load(filecache)
-            for key in ['paths', 'intersections', 'directions']:
-                if key not in cache:
-                    cache[key] = {}
-            cache['custom_path_names'] = []
+        # route directives, custom paths and tbds are worked out again every build
+        cache = profiler.stage(city_output.load_city_sections)(args.output_file,
+                                                               skip=('route_directives', 'custom_path_names', 'tbds'))
+        for key in ['paths', 'intersections', 'directions']:
+            if key not in cache:
+                cache[key] = {}
+        cache['custom_path_names'] = []
+    # Intersections are kept as columns until they are written out
+    cache['intersections'] = IntersectionRegistry.from_json(cache['intersections'])
+    cache['intersections'].share_path_names(cache['paths'])
 
     # Get the bad address cache, if it exists
     if args.bad_cache and os.path.exists(args.bad_cache):
@@ -625,44 +2203,141 @@ if __name__ == "__main__":
         bad_address_cache = create_empty_bad_address_cache()
 
 
-    # Get the intersection data
-    intersections = compute_all_intersections(args.input_data)
+    # Replay anything fetched by an interrupted build.
+    journal_file = args.output_file + '.journal'
+    if os.path.exists(journal_file):
+        with open(journal_file) as journal_fp:
+            print "replayed journal entries:", replay_journal(journal_fp, cache, bad_address_cache)
 
-    city = get_city(args.input_data)
+    # With fingerprints of the last build, only new and changed regions (and
+    # whatever was left pending) need their intersections looked up.
+    fingerprints = BuildFingerprints(args.output_file + '.fingerprints.json',
+                                     cache.get('buildtimestamp') if args.incremental and not args.plan else None)
+    if fingerprints.valid:
+        changed_regions = fingerprints.changed_regions(city_data)
+        intersections = compute_all_intersections(city_data, regions=changed_regions) | fingerprints.pending
+    else:
+        intersections = compute_all_intersections(city_data)
+
+    # Drop the street pairs that cannot meet, going by what we know of
+    # their shapes, before spending any requests on them.
+    pruned = set([])
+    if args.prune:
+        intersections, pruned = prune_intersections(cache, intersections, margin=args.prune_margin,
+                                                    conservative=args.prune_conservative)
+        bad_keys = index_intersections(bad_address_cache['not_intersection'])
+        bad_keys.update(index_intersections(bad_address_cache['ambiguous']))
+        print "pruned street pairs: %d, geocode requests avoided: %d" % \
+            (len(pruned), len([key for key in pruned if key not in bad_keys]))
+
+    city = city_data.city
+
+    if args.plan:
+        plan = plan_build(cache, intersections, bad_address_cache, city_data, rate_limit=args.rate_limit)
+        with open(args.plan, 'w') as plan_fp:
+            json.dump(plan, plan_fp, indent=2, separators=(',', ': '), sort_keys=True)
+
+        print "total intersections:", len(intersections)
+        for endpoint in sorted(plan['requests']):
+            print "planned %s requests: %d" % (endpoint, plan['requests'][endpoint])
+        if plan['estimated_seconds'] is not None:
+            print "estimated time at %s requests/sec: %.0f sec" % (args.rate_limit, plan['estimated_seconds'])
+        if plan['incomplete_curved_roads']:
+            print "curved roads with intersections still to look up:", ', '.join(plan['incomplete_curved_roads'])
+        if fetch_store is not None:
+            fetch_store.close()
+            fetch_store = None
+        return {'city': city, 'output_file': args.output_file, 'plan': plan}
+
+    # Keep journaling this build until the output is written.
+    journal = ScrapeJournal(journal_file)
+
+    budget = None
+    if args.daily_budget:
+        budget = QuotaBudget(parse_budget(args.daily_budget), args.budget_state or args.output_file + '.quota.json')
+        api_session.budget = budget
 
     # Lookup every intersection's lat/lng/elevation, fill out the paths json
-    cache, bad_address_cache, stats = lookup_all_intersections(cache, intersections, bad_address_cache, city)
+    cache, bad_address_cache, stats = lookup_all_intersections(cache, intersections, bad_address_cache, city,
+                                                              workers=args.workers, journal=journal, budget=budget)
 
     # Look up custom paths. These should all be ordered, so we do not need to sort these paths!
-    cache = lookup_and_add_custom_paths(cache, args.input_data, city)
+    cache = lookup_and_add_custom_paths(cache, city_data, city, workers=args.workers, journal=journal,
+                                        budget=budget)
 
     # Sort the paths json. TODO: fix docs - this also adds BREAKs into the paths.
-    cache = sort_path_cache(cache, args.input_data)
+    changed_paths = fingerprints.changed_paths(cache, city_data) if fingerprints.valid else None
+    cache = sort_path_cache(cache, city_data, paths=changed_paths)
 
     # Get any custom Google Directions API info we need.
-    cache = lookup_curved_road_directions(cache, args.input_data, city)
+    # With a budget, roads whose intersections are not all looked up yet
+    # would get directions between the wrong ones, so they wait.
+    incomplete_streets = set([])
+    if budget is not None:
+        incomplete_streets = set(street for key in find_uncached_intersections(cache['intersections'], intersections,
+                                                                               bad_address_cache)
+                                 for street in key)
+    changed_roads = fingerprints.changed_curved_roads(cache, city_data) if fingerprints.valid else None
+    cache = lookup_curved_road_directions(cache, city_data, city, journal=journal,
+                                          incomplete_streets=incomplete_streets, roads=changed_roads)
 
     # Get the route directive definitions (bike paths, etc)
-    cache = define_route_directives(cache, args.input_data)
+    cache, walked_directives = define_route_directives(cache, city_data, memo=fingerprints.route_directives)
 
     cache['tbds'] = {}
-    for tbd, latlng in get_tbds(args.input_data).iteritems():
+    for tbd, latlng in city_data.get_tbds().iteritems():
         cache['tbds'][tbd] = {'lat': latlng[0], 'lng': latlng[1]}
 
 
     cache['buildtimestamp'] = int(now)
     cache['buildtimereadable'] = datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d-%H:%M')
 
-    with open(args.output_file, 'w') as result_file:
-        json.dump(cache, result_file, indent=2, separators=(',', ': '), sort_keys=True)
+    # Indented and minified, in one pass, with an index of where each section is
+    profiler.stage(city_output.write_city_json)(cache, args.output_file)
+
+    # Compact string table + columns
+    with open(os.path.splitext(args.output_file)[0] + '.bin', 'wb') as compact_result_file:
+        profiler.stage(city_output.write_compact_city)(compact_result_file, cache)
+
+    # Routing graph, so searches don't have to rebuild adjacency
+    graph = profiler.stage(routing_graph.build_routing_graph)(cache)
+    with open(os.path.splitext(args.output_file)[0] + '-graph.json', 'w') as graph_file:
+        routing_graph.write_routing_graph(graph_file, graph)
+
+    # Landmark distances, for quick route queries over that graph
+    if args.alt_landmarks > 0:
+        with open(os.path.splitext(args.output_file)[0] + '-landmarks.bin', 'wb') as landmarks_file:
+            landmarks.write_landmarks(landmarks_file, graph,
+                                      profiler.stage(landmarks.compute_landmarks)(graph, args.alt_landmarks))
 
-    # Minified
-    with open('-min.'.join(args.output_file.split('.', 1)), 'w') as min_result_file:
-        json.dump(cache, min_result_file, sort_keys=True)
+    # Tiles, for loading only what is in view
+    if args.tile_zoom is not None:
+        tile_count = profiler.stage(city_output.write_tiled_city)(os.path.splitext(args.output_file)[0] + '-tiles',
+                                                                  cache, args.tile_zoom)
+        logging.info('Wrote %d tiles at zoom %d' % (tile_count, args.tile_zoom))
 
     with open(args.bad_cache, 'w') as bcache_fp:
         write_bad_address_cache(bcache_fp, bad_address_cache)
 
+    # Pruned pairs stay pending, so they are looked at again as more of
+    # their streets' shapes are known.
+    fingerprints.save(cache, city_data, find_uncached_intersections(cache['intersections'], intersections | pruned,
+                                                                    bad_address_cache))
+
+    # Everything fetched is in the output now.
+    journal.remove()
+
+    if fingerprints.valid:
+        print "incremental build, regions redone: %d of %d" % (len(changed_regions), len(city_data.get_regions()))
+        print "paths sorted: %d of %d" % (len(changed_paths), len(cache['paths']) - len(cache['custom_path_names']))
+        print "curved roads walked: %d of %d" % (len(changed_roads), len(city_data.get_curved_roads()))
+        print "route directive definitions walked:", walked_directives
+        for path in sorted(changed_paths):
+            logging.info(' [rebuilt path] %s' % path)
+
+    if fingerprints.valid:
+        print "intersections in the output:", len(cache['intersections'])
+        print "of the intersections in redone regions or pending:"
     print "total intersections:", len(intersections)
     print "good intersections looked up:", stats['good']
     print "bad intersections looked up and to be skipped next time:", stats['bad']
@@ -670,4 +2345,40 @@ if __name__ == "__main__":
     print "bad skipped intersections:", stats['skipped']
     print "error on lookup:", stats['error']
 
+    if budget is not None:
+        budget.save()
+        print "deferred to a later run:", stats['deferred']
+        for endpoint in sorted(budget.limits):
+            print "%s budget left today: %d" % (endpoint, budget.remaining(endpoint))
+
+    summary = {'city': city, 'output_file': args.output_file, 'total_intersections': len(intersections),
+               'stats': stats, 'requests': api_session.stats, 'seconds': time.time() - now,
+               'pruned': len(pruned)}
+
+    if fetch_store is not None:
+        for table in sorted(fetch_store.hits):
+            print "%s store hits: %d, misses: %d" % (table, fetch_store.hits[table], fetch_store.misses[table])
+            profiler.count('store_' + table, True, fetch_store.hits[table])
+            profiler.count('store_' + table, False, fetch_store.misses[table])
+        summary['store_hits'] = fetch_store.hits
+        summary['store_misses'] = fetch_store.misses
+        fetch_store.close()
+        fetch_store = None
+
+    summary['metrics'] = profiler.report(api_session.stats)
+    summary['metrics']['seconds'] = summary['seconds']
+    if args.metrics:
+        with open(args.metrics, 'w') as metrics_fp:
+            json.dump(summary['metrics'], metrics_fp, indent=2, separators=(',', ': '), sort_keys=True)
+
+    for endpoint, endpoint_stats in sorted(api_session.stats.iteritems()):
+        print "%s requests: %d, retries: %d, failures: %d, avg latency: %.3f sec, max latency: %.3f sec" % \
+            (endpoint, endpoint_stats['requests'], endpoint_stats['retries'], endpoint_stats['failures'],
+             endpoint_stats['total_latency'] / max(endpoint_stats['requests'], 1), endpoint_stats['max_latency'])
+
     logging.info('Done!')
+    return summary
+
+
+if __name__ == "__main__":
+    run_build(parser.parse_args())
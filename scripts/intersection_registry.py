@@ -0,0 +1,153 @@
+"""
+The intersection cache, kept compactly while a build runs.
+
+cache['intersections'] in the output is a dict of intersection name to a
+{'lat', 'lng', 'elevation'} dict. Held that way in memory, every
+intersection costs a dict and three float objects on top of its name.
+IntersectionRegistry keeps the same data as three array('d') columns
+indexed by integer id, with a dict of name to id, and one copy of each
+name that the path lists share.
+
+It is a mapping with the same interface as the dict it replaces:
+registry[name] builds the {'lat', 'lng', 'elevation'} dict for that one
+entry, and setting one stores it back into the columns. So only the
+output (and journal entries) ever see the JSON form. Stages that work on
+many intersections at once use the columns and ids directly.
+
+The dict registry[name] gives is built fresh, so a change to it could
+never reach the columns; it is read-only, and raises TypeError on any
+change. Set registry[name] to a whole entry instead.
+
+To compare its memory against the dict of dicts:
+    python benchmarks.py registry web/data/sf.json
+"""
+import collections
+from array import array
+
+import numpy
+
+COLUMNS = ['lat', 'lng', 'elevation']
+
+
+class IntersectionEntry(dict):
+    """
+    One intersection's {'lat', 'lng', 'elevation'}, as the registry hands it
+    out: a dict that can't be changed.
+    """
+    def read_only(self, *args, **kwargs):
+        raise TypeError('intersection entries are read-only; set registry[name] to a whole entry instead')
+
+    __setitem__ = __delitem__ = update = setdefault = pop = popitem = clear = read_only
+
+    def __reduce__(self):
+        # copies and pickles are plain dicts
+        return dict, (dict(self),)
+
+
+class IntersectionRegistry(collections.MutableMapping):
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.lat = array('d')
+        self.lng = array('d')
+        self.elevation = array('d')
+
+    @classmethod
+    def from_json(cls, i_cache):
+        """
+        Given an intersection cache as it is in the output, return its
+        registry.
+        """
+        registry = cls()
+        for name, entry in i_cache.iteritems():
+            registry[name] = entry
+        return registry
+
+    def to_json(self):
+        return dict((name, self.entry(node_id)) for node_id, name in enumerate(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __getitem__(self, name):
+        return IntersectionEntry(self.entry(self.ids[name]))
+
+    def entry(self, node_id):
+        return {'lat': self.lat[node_id], 'lng': self.lng[node_id], 'elevation': self.elevation[node_id]}
+
+    def __setitem__(self, name, entry):
+        node_id = self.ids.get(name)
+        if node_id is None:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.lat.append(entry['lat'])
+            self.lng.append(entry['lng'])
+            self.elevation.append(entry['elevation'])
+        else:
+            self.lat[node_id] = entry['lat']
+            self.lng[node_id] = entry['lng']
+            self.elevation[node_id] = entry['elevation']
+
+    def __delitem__(self, name):
+        # move the last intersection into the hole, so ids stay dense
+        node_id = self.ids.pop(name)
+        last_name = self.names.pop()
+        last = (self.lat.pop(), self.lng.pop(), self.elevation.pop())
+        if last_name != name:
+            self.names[node_id] = last_name
+            self.ids[last_name] = node_id
+            self.lat[node_id], self.lng[node_id], self.elevation[node_id] = last
+
+    def coordinates(self, name):
+        """
+        Return an intersection's (lat, lng, elevation), without building its
+        dict.
+        """
+        node_id = self.ids[name]
+        return self.lat[node_id], self.lng[node_id], self.elevation[node_id]
+
+    def shared_name(self, name):
+        """
+        Return the registry's own copy of name (or name, if it is not an
+        intersection), so lists of names hold one string per intersection.
+        """
+        node_id = self.ids.get(name)
+        return name if node_id is None else self.names[node_id]
+
+    def share_path_names(self, p_cache):
+        """
+        Point every path's intersection names at the registry's copies.
+        """
+        for path, intersections in p_cache.iteritems():
+            p_cache[path] = [self.shared_name(name) for name in intersections]
+
+    def columns(self):
+        """
+        Return numpy copies of the lat, lng and elevation columns, indexed by
+        id.
+        """
+        return [numpy.frombuffer(getattr(self, column), dtype=numpy.float64).copy() if len(self) else
+                numpy.zeros(0, dtype=numpy.float64) for column in COLUMNS]
+
+
+if __name__ == '__main__':
+    import json
+    import sys
+
+    # check that a city's intersections survive the round trip
+    with open(sys.argv[1]) as city_fp:
+        i_cache = json.load(city_fp)['intersections']
+    registry = IntersectionRegistry.from_json(i_cache)
+    assert registry.to_json() == i_cache
+    assert json.dumps(registry.to_json(), sort_keys=True) == json.dumps(i_cache, sort_keys=True)
+    for name in list(registry)[::2]:
+        del registry[name]
+    assert registry.to_json() == dict((name, i_cache[name]) for name in registry)
+    assert [registry.ids[name] for name in registry.names] == range(len(registry))
+    print 'ok: %d intersections' % len(i_cache)
@@ -0,0 +1,241 @@
+"""
+ALT (A*, landmarks and the triangle inequality) preprocessing for the
+routing graph.
+
+A handful of landmark intersections are chosen far apart from each other,
+and the cheapest cost from each landmark to every intersection, and from
+every intersection back to it, is stored. For any landmark L, both
+d(L, t) - d(L, v) and d(v, L) - d(t, L) are lower bounds on the cost from
+v to t. This holds for the map's grade-penalized, one-way-elevation costs
+because it only needs the triangle inequality. It is far tighter than
+straight-line distance once hills and missing bike paths raise costs, so
+A* settles far fewer intersections.
+
+File layout (little-endian), written next to the city as -landmarks.bin:
+
+    magic 'TBLM', uint32 version
+    uint32 node count, uint32 crc32 of the graph's node names
+    uint32 landmark count K, uint32 landmark node ids[K]
+    float64 from_landmark[K][node count], float64 to_landmark[K][node count]
+
+An unreachable pair is stored as infinity. Each query only uses the few
+landmarks that bound its start best, which is nearly as tight as using all
+of them and far cheaper to work out.
+
+To check routes with landmarks against plain Dijkstra:
+    python landmarks.py web/data/sf.json -n 1000
+"""
+import heapq
+import struct
+import zlib
+
+import numpy
+
+LANDMARKS_MAGIC = 'TBLM'
+LANDMARKS_VERSION = 1
+
+INF = float('inf')
+
+
+class LandmarksMismatchException(Exception):
+    def __init__(self, *args):
+        self.args = args
+    def __str__(self):
+        return repr(self.args)
+
+
+def dijkstra(offsets, targets, costs, source):
+    """
+    Given a CSR graph as lists, return the cheapest cost from source to every
+    node (infinity where there is no path).
+    """
+    distances = [INF] * (len(offsets) - 1)
+    distances[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        distance, node = heapq.heappop(heap)
+        if distance > distances[node]:
+            continue
+        for edge in xrange(offsets[node], offsets[node + 1]):
+            target = targets[edge]
+            tentative = distance + costs[edge]
+            if tentative < distances[target]:
+                distances[target] = tentative
+                heapq.heappush(heap, (tentative, target))
+    return distances
+
+
+def reverse_graph(graph):
+    """
+    Return the graph with every edge turned around, as (offsets, targets,
+    costs) lists.
+    """
+    node_count = len(graph.nodes)
+    sources = numpy.repeat(numpy.arange(node_count), numpy.diff(graph.offsets))
+    order = numpy.argsort(graph.targets, kind='mergesort')
+    offsets = numpy.zeros(node_count + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum(numpy.bincount(graph.targets, minlength=node_count))
+    return offsets.tolist(), sources[order].tolist(), graph.cost[order].tolist()
+
+
+def node_checksum(graph):
+    return zlib.crc32('\n'.join(graph.nodes).encode('utf-8')) & 0xFFFFFFFF
+
+
+# Stands in for infinity in the tables, so unreachable pairs subtract to
+# huge (still valid) or zero bounds instead of NaN.
+UNREACHABLE = 1e18
+
+# How many of the landmarks a query uses, the ones that bound its start best
+ACTIVE_LANDMARKS = 4
+
+
+class Landmarks(object):
+    def __init__(self, landmark_ids, from_landmark, to_landmark):
+        self.landmark_ids = landmark_ids
+        # [landmark][node]
+        self.from_landmark = numpy.array(from_landmark, dtype=numpy.float64).reshape(len(landmark_ids), -1)
+        self.to_landmark = numpy.array(to_landmark, dtype=numpy.float64).reshape(len(landmark_ids), -1)
+        # Plain lists index much faster than numpy arrays, one node at a time.
+        self.from_rows = numpy.minimum(self.from_landmark, UNREACHABLE).tolist()
+        self.to_rows = numpy.minimum(self.to_landmark, UNREACHABLE).tolist()
+
+    def lower_bound(self, start, goal, active=ACTIVE_LANDMARKS):
+        """
+        Return a function giving a lower bound on the cost from a node to
+        goal, using the active landmarks that give the best bound from start.
+        A node's bound is worked out the first time it is asked for and kept,
+        so a query only pays for the nodes its search reaches.
+        """
+        from_rows = self.from_rows
+        to_rows = self.to_rows
+        start_bounds = [max(from_row[goal] - from_row[start], to_row[start] - to_row[goal])
+                        for from_row, to_row in zip(from_rows, to_rows)]
+        chosen = sorted(range(len(start_bounds)), key=start_bounds.__getitem__)[-active:]
+        terms = [(from_rows[landmark][goal], from_rows[landmark], to_rows[landmark], to_rows[landmark][goal])
+                 for landmark in chosen]
+        bounds = {}
+
+        def bound(node):
+            value = bounds.get(node)
+            if value is None:
+                value = 0.0
+                for from_goal, from_row, to_row, to_goal in terms:
+                    landmark_bound = from_goal - from_row[node]
+                    if landmark_bound > value:
+                        value = landmark_bound
+                    landmark_bound = to_row[node] - to_goal
+                    if landmark_bound > value:
+                        value = landmark_bound
+                bounds[node] = value
+            return value
+
+        return bound
+
+
+def compute_landmarks(graph, count):
+    """
+    Pick count landmarks by farthest selection, each the intersection
+    farthest (by cost, both ways) from the ones already picked, and return
+    their Landmarks.
+    """
+    offsets = graph.offsets.tolist()
+    targets = graph.targets.tolist()
+    costs = graph.cost.tolist()
+    reverse_offsets, reverse_targets, reverse_costs = reverse_graph(graph)
+
+    node_count = len(graph.nodes)
+    count = min(count, node_count)
+    landmark_ids = []
+    from_landmark = []
+    to_landmark = []
+    # (node -> the least distance to any landmark so far); start from the
+    # intersection farthest from the one with the most edges.
+    nearest = numpy.array(dijkstra(offsets, targets, costs, int(numpy.argmax(numpy.diff(graph.offsets)))))
+    while len(landmark_ids) < count:
+        reachable = numpy.where(numpy.isinf(nearest), -1.0, nearest)
+        if landmark_ids:
+            reachable[landmark_ids] = -1.0
+        landmark = int(numpy.argmax(reachable))
+        if reachable[landmark] < 0:
+            break
+        landmark_ids.append(landmark)
+        from_landmark.append(dijkstra(offsets, targets, costs, landmark))
+        to_landmark.append(dijkstra(reverse_offsets, reverse_targets, reverse_costs, landmark))
+        both_ways = numpy.array(from_landmark[-1]) + numpy.array(to_landmark[-1])
+        nearest = both_ways if len(landmark_ids) == 1 else numpy.minimum(nearest, both_ways)
+
+    return Landmarks(landmark_ids, from_landmark, to_landmark)
+
+
+def write_landmarks(fp, graph, landmarks):
+    fp.write(LANDMARKS_MAGIC)
+    fp.write(struct.pack('<IIII', LANDMARKS_VERSION, len(graph.nodes), node_checksum(graph),
+                         len(landmarks.landmark_ids)))
+    fp.write(numpy.array(landmarks.landmark_ids, dtype='<u4').tostring())
+    fp.write(landmarks.from_landmark.astype('<f8').tostring())
+    fp.write(landmarks.to_landmark.astype('<f8').tostring())
+
+
+def read_landmarks(fp, graph):
+    """
+    Read the Landmarks for graph, raising LandmarksMismatchException if they
+    were computed for some other graph.
+    """
+    data = fp.read()
+    if data[:4] != LANDMARKS_MAGIC:
+        raise LandmarksMismatchException('Not a landmarks file')
+    version, node_count, checksum, count = struct.unpack('<IIII', data[4:20])
+    if version != LANDMARKS_VERSION:
+        raise LandmarksMismatchException('Unsupported landmarks version', version)
+    if node_count != len(graph.nodes) or checksum != node_checksum(graph):
+        raise LandmarksMismatchException('Landmarks are for a different graph')
+    offset = 20
+    landmark_ids = numpy.frombuffer(data, dtype='<u4', count=count, offset=offset).tolist()
+    offset += 4 * count
+    from_landmark = numpy.frombuffer(data, dtype='<f8', count=count * node_count, offset=offset)
+    offset += 8 * count * node_count
+    to_landmark = numpy.frombuffer(data, dtype='<f8', count=count * node_count, offset=offset)
+    return Landmarks(landmark_ids, from_landmark.reshape(count, node_count), to_landmark.reshape(count, node_count))
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    from bike_router import BikeRouter, random_queries
+
+    parser = argparse.ArgumentParser(description='Check routes with landmarks against plain Dijkstra.')
+    parser.add_argument('city_file', help='city output (i.e. web/data/sf.json)')
+    parser.add_argument('-n', '--queries', type=int, default=1000, help='number of random queries')
+    parser.add_argument('-k', '--landmarks', type=int, default=16,
+                        help='landmarks to compute, if none were written next to the city')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the queries')
+    args = parser.parse_args()
+
+    router = BikeRouter.from_city_file(args.city_file)
+    if router.landmarks is None:
+        start = time.time()
+        router.landmarks = compute_landmarks(router.graph, args.landmarks)
+        print 'computed %d landmarks in %.2f sec' % (len(router.landmarks.landmark_ids), time.time() - start)
+
+    mismatches = 0
+    query_time = 0.0
+    by_origin = {}
+    for origin, destination in random_queries(router.graph, args.queries, args.seed):
+        start = time.time()
+        route = router.route(origin, destination)
+        query_time += time.time() - start
+
+        origin_id = router.graph.index[origin]
+        if origin_id not in by_origin:
+            by_origin[origin_id] = dijkstra(router.offsets, router.targets, router.costs, origin_id)
+        expected = by_origin[origin_id][router.graph.index[destination]]
+        actual = INF if route is None else route['cost']
+        if abs(actual - expected) > 1e-6 * max(1.0, expected) and not (actual == expected == INF):
+            print 'mismatch: %s | %s costs %r, Dijkstra says %r' % (origin, destination, actual, expected)
+            mismatches += 1
+
+    print '%d queries, %.3f msec per query, %d mismatches' % \
+        (args.queries, query_time * 1000 / max(args.queries, 1), mismatches)
+    raise SystemExit(1 if mismatches else 0)
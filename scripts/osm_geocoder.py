@@ -0,0 +1,347 @@
+"""
+Geocodes intersections from a local OpenStreetMap extract, instead of the
+Google Geocoding API.
+
+The extract (.osm XML, or .osm.bz2 / .osm.gz) is parsed once: every named
+highway way is indexed by its normalized street name, and wherever two
+differently named ways share a node, that node is an intersection of the two
+streets. Queries are then answered from memory: geocode() looks streets up
+by name, and a grid over the intersection nodes finds the ones near a point
+for nearest(), and the ones inside a city's bounds for within(). The index
+is pickled next to the extract (as EXTRACT.index.pickle) so later builds
+skip the parse.
+
+Street names are matched after lowercasing and spelling out abbreviations,
+so "Divisadero St" finds OSM's "Divisadero Street". Two streets meeting at
+a few nodes close together (a divided road) geocode to their middle; if
+they meet at places farther apart than INTERSECTION_SPREAD, the
+intersection is ambiguous, the same as Google giving more than one result.
+
+Lookups don't know which town a street is in, so an extract covering
+several towns (each with its own "Main St and 1st St") has to be narrowed
+to the city's bounds with within(). Without bounds, check_single_city()
+refuses an extract holding more than one city, town or village.
+
+PBF extracts need a protobuf parser this repo does not depend on; convert
+them first, i.e. `osmium cat city.osm.pbf -o city.osm`.
+
+To look up an intersection, or the intersection nearest a point:
+    python osm_geocoder.py city.osm "Divisadero St and McAllister St"
+    python osm_geocoder.py city.osm --near 37.7775,-122.4376
+"""
+import bz2
+import cPickle as pickle
+import gzip
+import math
+import os.path
+import xml.etree.cElementTree as ElementTree
+from array import array
+
+INDEX_SUFFIX = '.index.pickle'
+INDEX_VERSION = 2
+
+# OSM place=* values that are a town of their own
+PLACE_TYPES = ('city', 'town', 'village')
+
+# Meters: nodes two streets share that are all this close together are one
+# intersection.
+INTERSECTION_SPREAD = 60.0
+
+# Degrees: the cell size of the spatial index.
+GRID_CELL = 0.005
+
+EARTH_RADIUS = 6378137.0
+
+ABBREVIATIONS = {
+    'st': 'street',
+    'ave': 'avenue',
+    'av': 'avenue',
+    'blvd': 'boulevard',
+    'dr': 'drive',
+    'rd': 'road',
+    'ln': 'lane',
+    'ct': 'court',
+    'pl': 'place',
+    'ter': 'terrace',
+    'terr': 'terrace',
+    'hwy': 'highway',
+    'pkwy': 'parkway',
+    'cir': 'circle',
+    'sq': 'square',
+    'aly': 'alley',
+    'n': 'north',
+    's': 'south',
+    'e': 'east',
+    'w': 'west',
+}
+
+
+class OsmExtractException(Exception):
+    def __init__(self, *args):
+        self.args = args
+    def __str__(self):
+        return repr(self.args)
+
+
+def normalize_street(name):
+    """
+    Given a street name, from a city definition or from OSM, return the
+    form they are matched in ("divisadero street").
+    """
+    words = name.lower().replace('.', '').split()
+    return ' '.join(ABBREVIATIONS.get(word, word) for word in words)
+
+
+def distance_between(lat, lng, other_lat, other_lng):
+    a = math.sin(math.radians(other_lat - lat) / 2) ** 2 + \
+        math.cos(math.radians(lat)) * math.cos(math.radians(other_lat)) * \
+        math.sin(math.radians(other_lng - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def open_extract(path):
+    if path.endswith('.pbf'):
+        raise OsmExtractException('PBF extracts are not supported, convert to .osm first', path)
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path)
+    if path.endswith('.gz'):
+        return gzip.open(path)
+    return open(path, 'rb')
+
+
+def parse_extract(fp):
+    """
+    Given an OSM XML file, return (node coordinates, ways, named nodes,
+    places): node id -> index into the lat and lng arrays, (lat array, lng
+    array), normalized street name -> lists of node ids of each of its ways,
+    normalized name -> node ids of the named (non-way) nodes, and the name
+    of every city, town and village -> its (lat, lng).
+    """
+    node_ids = {}
+    lats = array('d')
+    lngs = array('d')
+    ways = {}
+    named_nodes = {}
+    places = {}
+
+    context = ElementTree.iterparse(fp, events=('start', 'end'))
+    _, root = next(context)
+    for event, element in context:
+        if event != 'end':
+            continue
+        if element.tag == 'node':
+            node_ids[element.get('id')] = len(lats)
+            lats.append(float(element.get('lat')))
+            lngs.append(float(element.get('lon')))
+            tags = dict((tag.get('k'), tag.get('v')) for tag in element.iterfind('tag'))
+            if 'name' in tags:
+                named_nodes.setdefault(normalize_street(tags['name']), []).append(element.get('id'))
+                if tags.get('place') in PLACE_TYPES:
+                    places[tags['name']] = (lats[-1], lngs[-1])
+        elif element.tag == 'way':
+            tags = dict((tag.get('k'), tag.get('v')) for tag in element.iterfind('tag'))
+            if 'highway' in tags:
+                refs = [nd.get('ref') for nd in element.iterfind('nd')]
+                names = set()
+                for key in ('name', 'alt_name', 'old_name'):
+                    names.update(normalize_street(name) for name in tags.get(key, '').split(';') if name.strip())
+                for name in names:
+                    ways.setdefault(name, []).append(refs)
+        else:
+            continue
+        root.clear()
+    return node_ids, (lats, lngs), ways, named_nodes, places
+
+
+class OsmGeocoder(object):
+    """
+    Intersections and named places of an OSM extract, in memory.
+    """
+    def __init__(self, lat, lng, intersections, named_places, places=None):
+        # coordinates of every intersection node, by index
+        self.lat = lat
+        self.lng = lng
+        # (street, street), sorted -> indexes of the nodes they share
+        self.intersections = intersections
+        # name -> indexes of nodes with that name
+        self.named_places = named_places
+        # the cities, towns and villages in the extract -> (lat, lng)
+        self.places = places or {}
+        self.build_grid()
+
+    @classmethod
+    def from_extract(cls, fp):
+        node_ids, (all_lats, all_lngs), ways, named_nodes, places = parse_extract(fp)
+
+        names_at = {}
+        for name, name_ways in ways.iteritems():
+            for refs in name_ways:
+                for ref in refs:
+                    names_at.setdefault(ref, set()).add(name)
+
+        lat = array('d')
+        lng = array('d')
+        indexes = {}
+
+        def index_of(ref):
+            if ref not in indexes:
+                indexes[ref] = len(lat)
+                lat.append(all_lats[node_ids[ref]])
+                lng.append(all_lngs[node_ids[ref]])
+            return indexes[ref]
+
+        intersections = {}
+        for ref, names in names_at.iteritems():
+            if len(names) < 2 or ref not in node_ids:
+                continue
+            names = sorted(names)
+            for position, name in enumerate(names):
+                for other_name in names[position + 1:]:
+                    intersections.setdefault((name, other_name), []).append(index_of(ref))
+
+        named_places = dict((name, [index_of(ref) for ref in refs if ref in node_ids])
+                            for name, refs in named_nodes.iteritems())
+        return cls(lat, lng, intersections, named_places, places)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return the geocoder for the extract at path, from its pickled index
+        if that is newer than the extract, or parsing the extract (and
+        pickling its index) if not.
+        """
+        index_file = path + INDEX_SUFFIX
+        if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(path):
+            with open(index_file, 'rb') as index_fp:
+                version, state = pickle.load(index_fp)
+            if version == INDEX_VERSION:
+                return cls(*state)
+
+        with open_extract(path) as extract_fp:
+            geocoder = cls.from_extract(extract_fp)
+        with open(index_file, 'wb') as index_fp:
+            pickle.dump((INDEX_VERSION, (geocoder.lat, geocoder.lng, geocoder.intersections, geocoder.named_places,
+                                         geocoder.places)),
+                        index_fp, pickle.HIGHEST_PROTOCOL)
+        return geocoder
+
+    def within(self, south, west, north, east):
+        """
+        Return the geocoder for just the part of the extract inside the
+        given bounds, so streets of the same names in other towns the
+        extract covers are never matched.
+        """
+        def inside(lat, lng):
+            return south <= lat <= north and west <= lng <= east
+
+        # the intersection nodes in the grid cells the bounds cover (or in
+        # every cell, if the bounds cover more cells than there are)
+        (low_row, low_column), (high_row, high_column) = self.cell(south, west), self.cell(north, east)
+        if (high_row - low_row + 1) * (high_column - low_column + 1) > len(self.grid):
+            cells = self.grid.itervalues()
+        else:
+            cells = (self.grid.get((row, column), ()) for row in xrange(low_row, high_row + 1)
+                     for column in xrange(low_column, high_column + 1))
+        inside_nodes = set(index for cell in cells for index in cell if inside(self.lat[index], self.lng[index]))
+
+        intersections = {}
+        for pair, indexes in self.intersections.iteritems():
+            indexes = [index for index in indexes if index in inside_nodes]
+            if indexes:
+                intersections[pair] = indexes
+        named_places = {}
+        for name, indexes in self.named_places.iteritems():
+            indexes = [index for index in indexes if inside(self.lat[index], self.lng[index])]
+            if indexes:
+                named_places[name] = indexes
+        places = dict((name, point) for name, point in self.places.iteritems() if inside(*point))
+        return OsmGeocoder(self.lat, self.lng, intersections, named_places, places)
+
+    def check_single_city(self, city):
+        """
+        Raise OsmExtractException if the extract holds more than one city,
+        town or village, whose streets lookups for city can't tell apart.
+        """
+        if len(self.places) > 1:
+            raise OsmExtractException('The extract covers several towns; give the city definition bounds '
+                                      'to look up %s in' % city, sorted(self.places))
+
+    def build_grid(self):
+        self.grid = {}
+        for indexes in self.intersections.itervalues():
+            for index in indexes:
+                self.grid.setdefault(self.cell(self.lat[index], self.lng[index]), set()).add(index)
+
+    def cell(self, lat, lng):
+        return int(math.floor(lat / GRID_CELL)), int(math.floor(lng / GRID_CELL))
+
+    def locate(self, indexes):
+        """
+        Given node indexes, return ('ok', lat, lng) of their middle, or
+        ('ambiguous', None, None) if they are too far apart to be one place.
+        """
+        points = [(self.lat[index], self.lng[index]) for index in sorted(set(indexes))]
+        if not points:
+            return 'not_intersection', None, None
+        for position, (lat, lng) in enumerate(points):
+            for other_lat, other_lng in points[position + 1:]:
+                if distance_between(lat, lng, other_lat, other_lng) > INTERSECTION_SPREAD:
+                    return 'ambiguous', None, None
+        return 'ok', sum(lat for lat, _ in points) / len(points), sum(lng for _, lng in points) / len(points)
+
+    def geocode(self, intersection):
+        """
+        Given an intersection string ("Divisadero St and McAllister St"), or
+        a single place name, return (status, lat, lng), with status one of
+        'ok', 'not_intersection' and 'ambiguous', like the fetch store does.
+        """
+        parts = [normalize_street(part) for part in intersection.split(' and ')]
+        if len(parts) == 1:
+            return self.locate(self.named_places.get(parts[0], []))
+        if len(parts) != 2 or parts[0] == parts[1]:
+            return 'not_intersection', None, None
+        return self.locate(self.intersections.get(tuple(sorted(parts)), []))
+
+    def nearest(self, lat, lng, max_distance=500.0):
+        """
+        Return the streets of the intersection nearest (lat, lng) and its
+        distance in meters, or None if there is none within max_distance.
+        """
+        row, column = self.cell(lat, lng)
+        reach = int(math.ceil(max_distance / (GRID_CELL * math.pi / 180 * EARTH_RADIUS *
+                                              max(math.cos(math.radians(lat)), 0.01))))
+        best = None
+        for cell_row in xrange(row - reach, row + reach + 1):
+            for cell_column in xrange(column - reach, column + reach + 1):
+                for index in self.grid.get((cell_row, cell_column), ()):
+                    distance = distance_between(lat, lng, self.lat[index], self.lng[index])
+                    if distance <= max_distance and (best is None or distance < best[1]):
+                        best = (index, distance)
+        if best is None:
+            return None
+        streets = [pair for pair, indexes in self.intersections.iteritems() if best[0] in indexes]
+        return streets, best[1]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Geocode intersections from an OSM extract.')
+    parser.add_argument('extract', help='OSM XML extract (.osm, .osm.bz2 or .osm.gz)')
+    parser.add_argument('intersections', nargs='*', help='i.e. "Divisadero St and McAllister St"')
+    parser.add_argument('--near', default=None, metavar='LAT,LNG', help='find the intersection nearest a point')
+    parser.add_argument('--bounds', default=None, metavar='SOUTH,WEST,NORTH,EAST',
+                        help='only look in these bounds, for an extract covering several towns')
+    args = parser.parse_args()
+
+    geocoder = OsmGeocoder.load(args.extract)
+    if args.bounds:
+        geocoder = geocoder.within(*[float(value) for value in args.bounds.split(',')])
+    if len(geocoder.places) > 1:
+        print 'several towns: %s' % ', '.join(sorted(geocoder.places))
+    print '%d street pairs meet' % len(geocoder.intersections)
+    for intersection in args.intersections:
+        print '%s: %s' % (intersection, geocoder.geocode(intersection))
+    if args.near:
+        lat, lng = [float(value) for value in args.near.split(',')]
+        print 'nearest %s: %s' % (args.near, geocoder.nearest(lat, lng))
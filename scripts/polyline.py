@@ -0,0 +1,54 @@
+"""
+Google's encoded polyline format, as returned by the Directions API in
+'overview_polyline' and each step's 'polyline'.
+
+See https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+"""
+
+def decode_polyline(encoded):
+    """
+    Given an encoded polyline string, return its points as a list of
+    (lat, lng) tuples.
+    """
+    points = []
+    index = 0
+    lat = 0
+    lng = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in (0, 1):
+            shift = 0
+            result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / 1e5, lng / 1e5))
+    return points
+
+
+def encode_polyline(points):
+    """
+    Given a list of (lat, lng) tuples, return them as an encoded polyline string.
+    """
+    encoded = []
+    last_lat = 0
+    last_lng = 0
+    for lat, lng in points:
+        lat = int(round(lat * 1e5))
+        lng = int(round(lng * 1e5))
+        for delta in (lat - last_lat, lng - last_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        last_lat = lat
+        last_lng = lng
+    return ''.join(encoded)
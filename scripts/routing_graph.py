@@ -0,0 +1,243 @@
+"""
+A routing graph over a city's intersections, built once from the scraper
+output so a search indexes arrays instead of scanning path lists.
+
+The graph is stored CSR style. Node i is intersection nodes[i], and its
+edges are offsets[i] to offsets[i + 1] in targets and in every per-edge
+column (length, grade, directive, cost).
+
+Neighbors and costs follow BikeMap.Search in web/js/bikemap.js:
+  - The neighbors of an intersection come from the paths named in it plus
+    every custom path. On each path only its first appearance counts, and
+    its neighbors are the entries just after and just before it. '--BREAK'
+    is never a neighbor, and each neighbor is listed once, in the order
+    GetNeighbors finds them.
+  - An edge's length is the directions leg from its origin to its target
+    when there is one, and otherwise the distance between them. The
+    reverse leg is not used.
+  - An edge's directive is the route directive in either direction, and
+    'standard' when there is none.
+  - Costs are CostFunction's, and the heuristic is AStarHeuristic's.
+"""
+import json
+import math
+
+import numpy
+
+BREAK = '--BREAK'
+LINK_DELIMITER = ' | '
+
+# google.maps.geometry.spherical's earth radius, in meters
+EARTH_RADIUS = 6378137.0
+
+DIRECTIVE_CLASSES = ['path', 'route', 'standard']
+DIRECTIVE_PENALTIES = [1.0, 1.05, 1.15]
+STANDARD = DIRECTIVE_CLASSES.index('standard')
+
+# (grade above this percent, penalty), steepest first
+GRADE_PENALTIES = [(10, 3.0), (6, 2.0), (2, 1.10)]
+
+
+#################
+# cost model
+#################
+def distance_between(lat1, lng1, lat2, lng2):
+    """
+    Great circle distance in meters, as computeDistanceBetween gives it.
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def grade_penalty(elevation_diff, run_distance):
+    if elevation_diff <= 0:
+        return 1.0
+    grade = elevation_diff / run_distance * 100 if run_distance else float('inf')
+    for steepness, penalty in GRADE_PENALTIES:
+        if grade > steepness:
+            return penalty
+    return 1.0
+
+
+def edge_cost(run_distance, elevation_diff, directive):
+    """
+    CostFunction, given an edge's length, its elevation change and the index
+    of its directive class.
+    """
+    return DIRECTIVE_PENALTIES[directive] * grade_penalty(elevation_diff, run_distance) * \
+        math.sqrt(run_distance ** 2 + min(0, elevation_diff) ** 2)
+
+
+def heuristic(start, goal):
+    """
+    AStarHeuristic, given two (lat, lng, elevation) tuples.
+    """
+    run_distance = distance_between(start[0], start[1], goal[0], goal[1])
+    return math.sqrt(run_distance ** 2 + min(0, goal[2] - start[2]) ** 2)
+
+
+#################
+# graph building
+#################
+def get_neighbors(cache, intersection):
+    """
+    BikeMap.Search.GetNeighbors, as is. The graph below is built without
+    the repeated scans; this is what it is checked against.
+    """
+    paths = intersection.split(' and ') + cache.get('custom_path_names', [])
+    neighbors = []
+    for path in paths:
+        if path not in cache['paths'] or intersection not in cache['paths'][path]:
+            continue
+        path_list = cache['paths'][path]
+        index = path_list.index(intersection)
+        for neighbor_index in (index + 1, index - 1):
+            if 0 <= neighbor_index < len(path_list):
+                neighbor = path_list[neighbor_index]
+                if neighbor != BREAK and neighbor not in neighbors:
+                    neighbors.append(neighbor)
+    return neighbors
+
+
+class RoutingGraph(object):
+    def __init__(self, nodes, lat, lng, elevation, offsets, targets, length, grade, directive, cost):
+        self.nodes = nodes
+        self.index = dict((node, node_id) for node_id, node in enumerate(nodes))
+        self.lat = lat
+        self.lng = lng
+        self.elevation = elevation
+        self.offsets = offsets
+        self.targets = targets
+        self.length = length
+        self.grade = grade
+        self.directive = directive
+        self.cost = cost
+
+    def edges(self, node_id):
+        """
+        Return the (start, end) slice of node_id's edges.
+        """
+        return int(self.offsets[node_id]), int(self.offsets[node_id + 1])
+
+    def neighbors(self, intersection):
+        start, end = self.edges(self.index[intersection])
+        return [self.nodes[target] for target in self.targets[start:end]]
+
+    def coordinates(self, node_id):
+        return self.lat[node_id], self.lng[node_id], self.elevation[node_id]
+
+    def to_json(self):
+        return {
+            'nodes': self.nodes,
+            'lat': self.lat.tolist(),
+            'lng': self.lng.tolist(),
+            'elevation': self.elevation.tolist(),
+            'offsets': self.offsets.tolist(),
+            'targets': self.targets.tolist(),
+            'length': self.length.tolist(),
+            'grade': self.grade.tolist(),
+            'directive': self.directive.tolist(),
+            'cost': self.cost.tolist(),
+            'directive_classes': DIRECTIVE_CLASSES,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['nodes'],
+                   numpy.array(data['lat'], dtype=numpy.float64),
+                   numpy.array(data['lng'], dtype=numpy.float64),
+                   numpy.array(data['elevation'], dtype=numpy.float64),
+                   numpy.array(data['offsets'], dtype=numpy.int32),
+                   numpy.array(data['targets'], dtype=numpy.int32),
+                   numpy.array(data['length'], dtype=numpy.float64),
+                   numpy.array(data['grade'], dtype=numpy.float64),
+                   numpy.array(data['directive'], dtype=numpy.uint8),
+                   numpy.array(data['cost'], dtype=numpy.float64))
+
+
+def build_routing_graph(cache):
+    """
+    Given a city cache, as written to sf.json, return its RoutingGraph.
+    """
+    i_cache = cache['intersections']
+    p_cache = cache['paths']
+    d_cache = cache.get('directions', {})
+    rd_cache = cache.get('route_directives', {})
+    custom_path_names = [path for path in cache.get('custom_path_names', []) if path in p_cache]
+
+    # (path -> {intersection: first index}), in place of indexOf
+    first_indexes = {}
+    for path, path_list in p_cache.iteritems():
+        indexes = {}
+        for index, intersection in enumerate(path_list):
+            indexes.setdefault(intersection, index)
+        first_indexes[path] = indexes
+
+    # (intersection -> the custom paths it is on, in custom_path_names order)
+    on_custom_paths = {}
+    for path in custom_path_names:
+        for intersection in first_indexes[path]:
+            on_custom_paths.setdefault(intersection, []).append(path)
+
+    nodes = sorted(i_cache)
+    node_ids = dict((node, node_id) for node_id, node in enumerate(nodes))
+    lat = numpy.array([i_cache[node]['lat'] for node in nodes], dtype=numpy.float64)
+    lng = numpy.array([i_cache[node]['lng'] for node in nodes], dtype=numpy.float64)
+    elevation = numpy.array([i_cache[node]['elevation'] for node in nodes], dtype=numpy.float64)
+
+    offsets = [0]
+    targets = []
+    lengths = []
+    grades = []
+    directives = []
+    costs = []
+    for node in nodes:
+        neighbors = []
+        for path in node.split(' and ') + on_custom_paths.get(node, []):
+            index = first_indexes.get(path, {}).get(node)
+            if index is None:
+                continue
+            path_list = p_cache[path]
+            for neighbor_index in (index + 1, index - 1):
+                if 0 <= neighbor_index < len(path_list):
+                    neighbor = path_list[neighbor_index]
+                    if neighbor != BREAK and neighbor in node_ids and neighbor not in neighbors:
+                        neighbors.append(neighbor)
+
+        node_id = node_ids[node]
+        for neighbor in neighbors:
+            neighbor_id = node_ids[neighbor]
+            leg = d_cache.get(node + LINK_DELIMITER + neighbor)
+            if leg and leg.get('length') is not None:
+                run_distance = float(leg['length'])
+            else:
+                run_distance = distance_between(lat[node_id], lng[node_id], lat[neighbor_id], lng[neighbor_id])
+            elevation_diff = elevation[neighbor_id] - elevation[node_id]
+            directive = rd_cache.get(node + LINK_DELIMITER + neighbor) or \
+                rd_cache.get(neighbor + LINK_DELIMITER + node) or 'standard'
+            directive = DIRECTIVE_CLASSES.index(directive) if directive in DIRECTIVE_CLASSES else STANDARD
+
+            targets.append(neighbor_id)
+            lengths.append(run_distance)
+            grades.append(elevation_diff / run_distance * 100 if run_distance else 0.0)
+            directives.append(directive)
+            costs.append(edge_cost(run_distance, elevation_diff, directive))
+        offsets.append(len(targets))
+
+    return RoutingGraph(nodes, lat, lng, elevation,
+                        numpy.array(offsets, dtype=numpy.int32),
+                        numpy.array(targets, dtype=numpy.int32),
+                        numpy.array(lengths, dtype=numpy.float64),
+                        numpy.array(grades, dtype=numpy.float64),
+                        numpy.array(directives, dtype=numpy.uint8),
+                        numpy.array(costs, dtype=numpy.float64))
+
+
+def write_routing_graph(fp, graph):
+    json.dump(graph.to_json(), fp, sort_keys=True)
+
+
+def read_routing_graph(fp):
+    return RoutingGraph.from_json(json.load(fp))
+
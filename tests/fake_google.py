@@ -0,0 +1,222 @@
+"""
+A stand-in for the Google Maps Geocoding, Elevation and Directions APIs, for
+tests and for trying builds without spending quota.
+
+The city is a grid: avenues (1st Ave to 12th Ave) run north-south, streets
+(A St to J St) east-west, and every avenue meets every street. Geocoding
+answers like Google does:
+
+  - "1st Ave and B St": one result, at the grid point
+  - two avenues, two streets, or an unknown street: one result that isn't
+    the intersection asked for (a not-intersection address)
+  - an address with "Ambiguous" in it: two results
+  - an address with "Broken" in it: HTTP 400
+
+Elevations are a plane over the city. Directions go from each point to the
+next in two steps, via the middle of the leg, while the route's overview
+polyline, like Google's smoothed one, only holds the points themselves.
+Directions through a place with "Broken" in it fail with HTTP 400.
+
+Failures can also be queued up for the next requests, whatever they ask:
+server.failures = ['OVER_QUERY_LIMIT', 503] answers the next one with an
+OVER_QUERY_LIMIT status, and the one after with HTTP 503.
+
+In a test:
+    server = FakeGoogleMaps().start()
+    google_maps_scraper.GOOGLE_MAPS_API_BASE = server.api_base
+    ...
+    server.stop()
+
+Or on its own, on a port:
+    python fake_google.py 8765
+"""
+import BaseHTTPServer
+import json
+import math
+import SocketServer
+import sys
+import threading
+import urlparse
+
+CITY = 'San Francisco, CA'
+
+AVENUES = ['%d%s Ave' % (number, {1: 'st', 2: 'nd', 3: 'rd'}.get(number, 'th')) for number in range(1, 13)]
+STREETS = ['%s St' % letter for letter in 'ABCDEFGHIJ']
+
+# Degrees between neighbouring avenues and neighbouring streets
+GRID_STEP = 0.002
+WEST = -122.5
+SOUTH = 37.70
+
+
+def grid_position(street):
+    """
+    Return ('lng', longitude) of an avenue, ('lat', latitude) of a street, or
+    (None, None) for anything else.
+    """
+    if street in AVENUES:
+        return 'lng', WEST + AVENUES.index(street) * GRID_STEP
+    if street in STREETS:
+        return 'lat', SOUTH + STREETS.index(street) * GRID_STEP
+    return None, None
+
+
+def intersection_point(address):
+    """
+    Given "1st Ave and B St", return its (lat, lng), or None if it isn't an
+    intersection on the grid.
+    """
+    parts = [part.strip() for part in address.split(' and ')]
+    if len(parts) != 2:
+        return None
+    first, second = grid_position(parts[0]), grid_position(parts[1])
+    if first[0] is None or second[0] is None or first[0] == second[0]:
+        return None
+    lat = first[1] if first[0] == 'lat' else second[1]
+    lng = first[1] if first[0] == 'lng' else second[1]
+    return lat, lng
+
+
+def elevation_at(lat, lng):
+    return round((lat - SOUTH) * 20000 + (lng - WEST) * 3000, 6)
+
+
+def encode_value(value):
+    value = int(round(value * 1e5))
+    value = ~(value << 1) if value < 0 else value << 1
+    encoded = ''
+    while value >= 0x20:
+        encoded += chr((0x20 | (value & 0x1f)) + 63)
+        value >>= 5
+    return encoded + chr(value + 63)
+
+
+def encode_points(points):
+    encoded = ''
+    last_lat = last_lng = 0
+    for lat, lng in points:
+        encoded += encode_value(lat - last_lat) + encode_value(lng - last_lng)
+        last_lat, last_lng = lat, lng
+    return encoded
+
+
+def geocode_response(address, city):
+    if 'Broken' in address:
+        return None
+    if 'Ambiguous' in address:
+        return {'status': 'OK', 'results': [{}, {}]}
+    point = intersection_point(address)
+    if point is None:
+        return {'status': 'OK', 'results': [{'address_components': [],
+                                             'formatted_address': 'Somewhere, %s, USA' % city,
+                                             'geometry': {'location': {'lat': 37.0, 'lng': -122.0}}}]}
+    return {'status': 'OK', 'results': [{'address_components': [],
+                                         'formatted_address': '%s, %s, USA' % (address.replace(' and ', ' & '), city),
+                                         'geometry': {'location': {'lat': point[0], 'lng': point[1]}}}]}
+
+
+def elevation_response(locations):
+    results = []
+    for location in locations.split('|'):
+        lat, lng = [float(value) for value in location.split(',')]
+        results.append({'elevation': elevation_at(lat, lng), 'location': {'lat': lat, 'lng': lng}})
+    return {'status': 'OK', 'results': results}
+
+
+def directions_response(origin, destination, waypoints=None):
+    places = [origin] + [waypoint for waypoint in (waypoints or '').split('|') if waypoint] + [destination]
+    if any('Broken' in place for place in places):
+        return None
+    # "1st Ave and B St,+San Francisco,+CA"
+    points = [intersection_point(place.rsplit(',', 2)[0].strip()) or (37.0, -122.0) for place in places]
+    legs = []
+    for start, end in zip(points, points[1:]):
+        meters = int(math.hypot((start[0] - end[0]) * 111000, (start[1] - end[1]) * 88000))
+        middle = ((start[0] + end[0]) / 2, (start[1] + end[1]) / 2)
+        legs.append({'distance': {'value': meters},
+                     'steps': [{'polyline': {'points': encode_points([start, middle])}},
+                               {'polyline': {'points': encode_points([middle, end])}}]})
+    return {'status': 'OK', 'routes': [{'overview_polyline': {'points': encode_points(points)}, 'legs': legs}]}
+
+
+class FakeGoogleMapsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict((name, values[0]) for name, values in urlparse.parse_qs(url.query).iteritems())
+        endpoint = url.path.rstrip('/').split('/')[-2]
+        self.server.count(endpoint)
+
+        failure = self.server.next_failure()
+        body = None
+        if failure == 'OVER_QUERY_LIMIT':
+            body = {'status': 'OVER_QUERY_LIMIT', 'results': []}
+        elif failure is not None:
+            self.send_response(failure)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        elif endpoint == 'geocode':
+            address, city = query['address'].split(',', 1)
+            body = geocode_response(address, city.strip())
+        elif endpoint == 'elevation':
+            body = elevation_response(query['locations'])
+        elif endpoint == 'directions':
+            body = directions_response(query['origin'], query['destination'], query.get('waypoints'))
+
+        if body is None:
+            self.send_response(404 if endpoint not in ('geocode', 'elevation', 'directions') else 400)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = json.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeGoogleMaps(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    The stand-in server, counting the requests made to each endpoint.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), FakeGoogleMapsHandler)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.failures = []
+
+    @property
+    def api_base(self):
+        return 'http://127.0.0.1:%d/maps/api' % self.server_address[1]
+
+    def count(self, endpoint):
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def next_failure(self):
+        with self.lock:
+            return self.failures.pop(0) if self.failures else None
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    server = FakeGoogleMaps(int(sys.argv[1]) if len(sys.argv) > 1 else 8765)
+    print 'serving %s' % server.api_base
+    server.serve_forever()
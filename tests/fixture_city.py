@@ -0,0 +1,66 @@
+"""
+A small built city, as the scraper writes it to sf.json: a three by three
+grid, with a break in 2nd Ave, a custom path through a place with no cross
+street, a failed directions lookup, route directives and a TBD.
+"""
+import copy
+
+GRID_STEP = 0.002
+
+AVENUES = ['1st Ave', '2nd Ave', '3rd Ave']
+STREETS = ['A St', 'B St', 'C St']
+
+
+def grid_intersections():
+    intersections = {}
+    for column, avenue in enumerate(AVENUES):
+        for row, street in enumerate(STREETS):
+            intersections['%s and %s' % (avenue, street)] = {
+                'lat': 37.7 + row * GRID_STEP,
+                'lng': -122.5 + column * GRID_STEP,
+                'elevation': 10.0 * row + 2.5 * column,
+            }
+    return intersections
+
+
+CITY = {
+    'intersections': dict(grid_intersections(), **{
+        'Golden Gate Park': {'lat': 37.701, 'lng': -122.499, 'elevation': 4.25},
+    }),
+    'paths': {
+        '1st Ave': ['1st Ave and A St', '1st Ave and B St', '1st Ave and C St'],
+        '2nd Ave': ['2nd Ave and A St', '2nd Ave and B St', '--BREAK', '2nd Ave and C St'],
+        '3rd Ave': ['3rd Ave and A St', '3rd Ave and B St', '3rd Ave and C St'],
+        'A St': ['1st Ave and A St', '2nd Ave and A St', '3rd Ave and A St'],
+        'B St': ['1st Ave and B St', '2nd Ave and B St', '3rd Ave and B St'],
+        'C St': ['1st Ave and C St', '2nd Ave and C St', '3rd Ave and C St'],
+        'Greenway': ['1st Ave and A St', 'Golden Gate Park', '2nd Ave and B St', '3rd Ave and C St'],
+    },
+    'custom_path_names': ['Greenway'],
+    'directions': {
+        '1st Ave and A St | Golden Gate Park': {'path': '_zceF~wtjVoK_cB', 'length': 180},
+        'Golden Gate Park | 2nd Ave and B St': {'path': 'oKoK_cB~wtjV', 'length': 151.5},
+        '2nd Ave and B St | 3rd Ave and C St': None,
+        '2nd Ave and B St | 2nd Ave and A St': {'path': '??', 'length': None},
+        '3rd Ave and A St | 3rd Ave and B St': {'path': '_ibE_ibE', 'length': 222},
+    },
+    'route_directives': {
+        '1st Ave and A St | 2nd Ave and A St': 'route',
+        '2nd Ave and A St | 3rd Ave and A St': 'route',
+        '1st Ave and A St | Golden Gate Park': 'path',
+        'Golden Gate Park | 2nd Ave and B St': 'path',
+        '2nd Ave and B St | 3rd Ave and C St': 'path',
+    },
+    'tbds': {
+        'Somewhere': {'lat': 37.71, 'lng': -122.49},
+    },
+    'buildtimestamp': 1381000000,
+    'buildtimereadable': '2013-10-05-12:06',
+}
+
+
+def city():
+    """
+    Return a copy of the city, to change as a test likes.
+    """
+    return copy.deepcopy(CITY)
@@ -0,0 +1,61 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import google_maps_scraper
+from google_maps_scraper import GoogleMapsApiException
+from fake_google import FakeGoogleMaps
+
+
+class GoogleMapsSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeGoogleMaps().start()
+        self.session = google_maps_scraper.GoogleMapsSession(max_retries=2, backoff=0.0)
+        self.uri = self.server.api_base + '/geocode/json?address=1st Ave and A St, San Francisco, CA&sensor=false'
+
+    def tearDown(self):
+        self.session.session.close()
+        self.server.stop()
+
+    def test_retries_until_it_succeeds(self):
+        self.server.failures = ['OVER_QUERY_LIMIT', 503]
+        data = self.session.get_json(self.uri)
+
+        self.assertEqual(data['status'], 'OK')
+        self.assertEqual(self.server.counts['geocode'], 3)
+        stats = self.session.stats['geocode']
+        self.assertEqual((stats['requests'], stats['retries'], stats['failures']), (3, 2, 0))
+
+    def test_raises_once_out_of_retries(self):
+        self.server.failures = [500, 'OVER_QUERY_LIMIT', 502]
+        with self.assertRaises(GoogleMapsApiException) as raised:
+            self.session.get_json(self.uri)
+
+        self.assertEqual(raised.exception.args, (self.uri, 502))
+        self.assertEqual(self.server.counts['geocode'], 3)
+        stats = self.session.stats['geocode']
+        self.assertEqual((stats['requests'], stats['retries'], stats['failures']), (3, 2, 1))
+
+    def test_client_errors_are_not_retried(self):
+        self.server.failures = [400]
+        self.assertRaises(GoogleMapsApiException, self.session.get_json, self.uri)
+        self.assertEqual(self.server.counts['geocode'], 1)
+        self.assertEqual(self.session.stats['geocode']['retries'], 0)
+
+    def test_configure_closes_the_old_session(self):
+        self.session.get_json(self.uri)
+        old_session = self.session.session
+        closed = []
+        close = old_session.close
+        old_session.close = lambda: closed.append(close())
+
+        self.session.configure(max_retries=0)
+        self.assertEqual(len(closed), 1)
+        self.assertIsNot(self.session.session, old_session)
+        self.assertEqual(self.session.get_json(self.uri)['status'], 'OK')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from google_maps_scraper import CityDefinition
+
+WITH_SECTIONS = '''
+city = 'San Francisco, CA'
+regions = [[['1st Ave'], ['A St']]]
+custom_paths = {'Greenway': {'path': ['1st Ave and A St', 'Golden Gate Park'], 'type': 'path'}}
+tbds = {'Somewhere': (37.71, -122.49)}
+'''
+
+WITHOUT_SECTIONS = '''
+city = 'Oakland, CA'
+regions = [[['1st Ave'], ['A St']]]
+'''
+
+
+class CityDefinitionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, name, source):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as city_fp:
+            city_fp.write(source)
+        return CityDefinition(path)
+
+    def test_left_out_sections_are_empty_after_another_city(self):
+        first = self.load('first.py', WITH_SECTIONS)
+        second = self.load('second.py', WITHOUT_SECTIONS)
+
+        self.assertEqual(sorted(first.get_custom_paths()), ['Greenway'])
+        self.assertEqual((second.city, second.get_custom_paths(), second.get_tbds()), ('Oakland, CA', {}, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import city_output
+from fixture_city import city
+from intersection_registry import IntersectionRegistry
+from polyline import decode_polyline, encode_polyline
+
+
+class CompactCityTest(unittest.TestCase):
+    def test_round_trip(self):
+        cache = city()
+        self.assertEqual(city_output.decode_compact_city(city_output.encode_compact_city(cache)), cache)
+
+    def test_round_trip_keeps_breaks_custom_paths_and_tbds(self):
+        decoded = city_output.decode_compact_city(city_output.encode_compact_city(city()))
+        self.assertEqual(decoded['paths']['2nd Ave'][2], '--BREAK')
+        self.assertEqual(decoded['custom_path_names'], ['Greenway'])
+        self.assertEqual(decoded['paths']['Greenway'][1], 'Golden Gate Park')
+        self.assertEqual(decoded['tbds'], {'Somewhere': {'lat': 37.71, 'lng': -122.49}})
+        self.assertIsNone(decoded['directions']['2nd Ave and B St | 3rd Ave and C St'])
+
+    def test_round_trip_keeps_other_keys(self):
+        cache = city()
+        cache['region_bounds'] = [37.7, -122.5, 37.71, -122.49]
+        del cache['buildtimereadable']
+        self.assertEqual(city_output.decode_compact_city(city_output.encode_compact_city(cache)), cache)
+
+    def test_round_trip_of_loaded_json(self):
+        cache = json.loads(json.dumps(city()))
+        self.assertEqual(city_output.decode_compact_city(city_output.encode_compact_city(cache)), cache)
+
+
+class CityJsonTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.directory, 'sf.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, path):
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+    def assert_matches_json_dump(self, cache, written=None):
+        city_output.write_city_json(written if written is not None else cache, self.output_file)
+        self.assertEqual(self.read(self.output_file),
+                         json.dumps(cache, indent=2, separators=(',', ': '), sort_keys=True))
+        self.assertEqual(self.read(os.path.join(self.directory, 'sf-min.json')), json.dumps(cache, sort_keys=True))
+
+    def test_matches_json_dump(self):
+        self.assert_matches_json_dump(city())
+
+    def test_matches_json_dump_of_registry(self):
+        written = city()
+        written['intersections'] = IntersectionRegistry.from_json(written['intersections'])
+        self.assert_matches_json_dump(city(), written)
+
+    def test_matches_json_dump_of_empty_sections(self):
+        cache = city()
+        cache['directions'] = {}
+        cache['custom_path_names'] = []
+        self.assert_matches_json_dump(cache)
+        self.assert_matches_json_dump({})
+
+    def test_loads_sections(self):
+        cache = city()
+        city_output.write_city_json(cache, self.output_file)
+        for path in [self.output_file, os.path.join(self.directory, 'sf-min.json')]:
+            self.assertEqual(city_output.load_city_sections(path), cache)
+            self.assertEqual(city_output.load_city_sections(path, sections=['paths', 'tbds']),
+                             {'paths': cache['paths'], 'tbds': cache['tbds']})
+            self.assertEqual(city_output.load_city_sections(path, skip=['route_directives', 'tbds']),
+                             dict((key, value) for key, value in cache.iteritems()
+                                  if key not in ('route_directives', 'tbds')))
+
+    def test_loads_sections_without_a_matching_index(self):
+        cache = city()
+        city_output.write_city_json(cache, self.output_file)
+        with open(self.output_file, 'a') as city_fp:
+            city_fp.write('\n')
+        self.assertIsNone(city_output.read_section_index(self.output_file))
+        self.assertEqual(city_output.load_city_sections(self.output_file, sections=['tbds']),
+                         {'tbds': cache['tbds']})
+
+        os.remove(city_output.index_path(self.output_file))
+        self.assertEqual(city_output.load_city_sections(self.output_file), cache)
+
+
+class TiledCityTest(unittest.TestCase):
+    # at zoom 17, 3rd Ave is a tile east of 1st and 2nd, and each street a tile apart
+    ZOOM = 17
+
+    def setUp(self):
+        self.cache = city()
+        # directions along each leg, bending to the side of it, in place of
+        # the fixture's short placeholder paths
+        i_cache = self.cache['intersections']
+        for link, directions in self.cache['directions'].iteritems():
+            if directions:
+                origin, destination = [i_cache[intersection] for intersection in link.split(' | ')]
+                middle = ((origin['lat'] + destination['lat']) / 2 + 0.0005,
+                          (origin['lng'] + destination['lng']) / 2 + 0.0005)
+                directions['path'] = encode_polyline([(origin['lat'], origin['lng']), middle,
+                                                      (destination['lat'], destination['lng'])])
+        self.manifest, self.tiles = city_output.partition_city_tiles(self.cache, self.ZOOM)
+
+    def tile_of(self, intersection):
+        entry = self.cache['intersections'][intersection]
+        return city_output.lat_lng_to_tile(entry['lat'], entry['lng'], self.ZOOM)
+
+    def segments(self, tile):
+        return set((origin, destination) for runs in self.tiles[tile]['paths'].itervalues()
+                   for run in runs for origin, destination in zip(run, run[1:]))
+
+    def test_every_intersection_is_in_its_own_tile(self):
+        self.assertEqual(len(self.tiles), 6)
+        for intersection in self.cache['intersections']:
+            home = self.tile_of(intersection)
+            self.assertIn(intersection, self.tiles[home]['intersections'])
+            # and anywhere else only as the end of a segment crossing into it
+            for tile, tile_data in self.tiles.iteritems():
+                if tile != home and intersection in tile_data['intersections']:
+                    self.assertTrue(any(intersection in segment for segment in self.segments(tile)),
+                                    (intersection, tile))
+
+    def test_segments_are_in_every_tile_they_cross(self):
+        crossing = 0
+        for path, intersections in self.cache['paths'].iteritems():
+            for origin, destination in zip(intersections, intersections[1:]):
+                if '--BREAK' in (origin, destination):
+                    continue
+                tiles = set(tile for tile in self.tiles if (origin, destination) in self.segments(tile))
+                self.assertLessEqual(set([self.tile_of(origin), self.tile_of(destination)]), tiles,
+                                     (origin, destination))
+                crossing += len(tiles) > 1
+        self.assertGreater(crossing, 0)
+
+        # 2nd Ave and A St to 3rd Ave and A St crosses a tile edge
+        segment = ('2nd Ave and A St', '3rd Ave and A St')
+        for intersection in segment:
+            tile_data = self.tiles[self.tile_of(intersection)]
+            self.assertIn(segment, self.segments(self.tile_of(intersection)))
+            self.assertEqual(tile_data['route_directives']['2nd Ave and A St | 3rd Ave and A St'], 'route')
+
+    def test_manifest_bboxes_hold_their_tiles(self):
+        for (x, y), tile_data in self.tiles.iteritems():
+            south, west, north, east = self.manifest['tiles']['%d/%d' % (x, y)]['bbox']
+            points = [(entry['lat'], entry['lng']) for entry in tile_data['intersections'].itervalues()]
+            for directions in tile_data['directions'].itervalues():
+                if directions:
+                    points.extend(decode_polyline(directions['path']))
+            for lat, lng in points:
+                self.assertTrue(south <= lat <= north and west <= lng <= east, ((x, y), lat, lng))
+        self.assertEqual(self.manifest['bbox'], [37.7, -122.5, 37.704, -122.496])
+
+
+if __name__ == '__main__':
+    unittest.main()
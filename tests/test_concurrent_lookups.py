@@ -0,0 +1,66 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import google_maps_scraper
+from fake_google import AVENUES, CITY, STREETS, FakeGoogleMaps
+
+
+def lookup(intersections, workers):
+    cache = {'intersections': {}, 'paths': {}}
+    bad_address_cache = google_maps_scraper.create_empty_bad_address_cache()
+    cache, bad_address_cache, stats = google_maps_scraper.lookup_all_intersections(
+        cache, intersections, bad_address_cache, CITY, workers=workers)
+    return cache, bad_address_cache, stats
+
+
+class ConcurrentLookupTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeGoogleMaps().start()
+        google_maps_scraper.GOOGLE_MAPS_API_BASE = self.server.api_base
+        google_maps_scraper.api_session.configure(max_retries=0)
+        google_maps_scraper.api_session.stats = {}
+        google_maps_scraper.api_session.budget = None
+
+    def tearDown(self):
+        google_maps_scraper.api_session.session.close()
+        self.server.stop()
+
+    def test_workers_match_one_at_a_time(self):
+        intersections = [tuple(sorted([avenue, street])) for avenue in AVENUES[:4] for street in STREETS[:5]]
+        intersections += [
+            ('1st Ave', '2nd Ave'),            # not an intersection
+            ('A St', 'Nowhere St'),            # not an intersection
+            ('A St', 'Ambiguous Way'),         # ambiguous
+            ('B St', 'Ambiguous Way'),         # ambiguous
+            ('A St', 'Broken Rd'),             # request fails
+        ]
+
+        one_cache, one_bad, one_stats = lookup(intersections, workers=1)
+        many_cache, many_bad, many_stats = lookup(intersections, workers=8)
+
+        self.assertEqual(one_stats, {'good': 20, 'cached': 0, 'skipped': 0, 'bad': 4, 'error': 1, 'deferred': 0})
+        self.assertEqual(many_stats, one_stats)
+        self.assertEqual(many_bad, one_bad)
+        self.assertEqual(one_bad['not_intersection'], set(['1st Ave and 2nd Ave', 'A St and Nowhere St']))
+        self.assertEqual(one_bad['ambiguous'], set(['A St and Ambiguous Way', 'B St and Ambiguous Way']))
+        self.assertEqual(many_cache, one_cache)
+
+    def test_skips_cached_and_bad(self):
+        intersections = [('1st Ave', 'A St'), ('1st Ave', '2nd Ave'), ('1st Ave', 'B St')]
+        cache = {'intersections': {'1st Ave and A St': {'lat': 37.7, 'lng': -122.5, 'elevation': 0.0}},
+                 'paths': {}}
+        bad_address_cache = google_maps_scraper.create_empty_bad_address_cache()
+        bad_address_cache['not_intersection'].add('1st Ave and 2nd Ave')
+
+        _, _, stats = google_maps_scraper.lookup_all_intersections(cache, intersections, bad_address_cache, CITY,
+                                                                   workers=4)
+
+        self.assertEqual((stats['good'], stats['cached'], stats['skipped']), (1, 1, 1))
+        self.assertEqual(self.server.counts, {'geocode': 1, 'elevation': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import google_maps_scraper
+from fake_google import AVENUES, CITY, STREETS, FakeGoogleMaps
+
+
+class DailyBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeGoogleMaps().start()
+        self.directory = tempfile.mkdtemp()
+        self.chunk_size = google_maps_scraper.LOOKUP_CHUNK_SIZE
+        google_maps_scraper.LOOKUP_CHUNK_SIZE = 4
+        google_maps_scraper.GOOGLE_MAPS_API_BASE = self.server.api_base
+        google_maps_scraper.api_session.configure(max_retries=0)
+        google_maps_scraper.api_session.stats = {}
+
+    def tearDown(self):
+        google_maps_scraper.LOOKUP_CHUNK_SIZE = self.chunk_size
+        google_maps_scraper.api_session.budget = None
+        google_maps_scraper.api_session.session.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def lookup(self, limits, intersections):
+        budget = google_maps_scraper.QuotaBudget(limits, os.path.join(self.directory, 'quota.json'))
+        google_maps_scraper.api_session.budget = budget
+        cache = {'intersections': {}, 'paths': {}}
+        _, _, stats = google_maps_scraper.lookup_all_intersections(
+            cache, intersections, google_maps_scraper.create_empty_bad_address_cache(), CITY, budget=budget)
+        return cache, stats
+
+    def test_spends_the_geocode_budget_over_several_chunks(self):
+        intersections = [tuple(sorted([avenue, street])) for avenue in AVENUES[:2] for street in STREETS[:7]]
+
+        cache, stats = self.lookup({'geocode': 10}, intersections)
+
+        self.assertEqual((stats['good'], stats['deferred']), (10, 4))
+        self.assertEqual(len(cache['intersections']), 10)
+        self.assertEqual(self.server.counts['geocode'], 10)
+        # 4, 4 and 2 intersections' elevations
+        self.assertEqual(self.server.counts['elevation'], 3)
+
+    def test_spends_the_elevation_budget_over_several_chunks(self):
+        intersections = [tuple(sorted([avenue, street])) for avenue in AVENUES[:2] for street in STREETS[:7]]
+
+        cache, stats = self.lookup({'geocode': 100, 'elevation': 2}, intersections)
+
+        self.assertEqual((stats['good'], stats['deferred']), (8, 6))
+        self.assertEqual(self.server.counts, {'geocode': 8, 'elevation': 2})
+
+    def test_spend_is_saved_as_it_goes(self):
+        intersections = [tuple(sorted([avenue, street])) for avenue in AVENUES[:2] for street in STREETS[:3]]
+
+        # as if the build died before it could save at the end
+        self.lookup({'geocode': 100, 'elevation': 100}, intersections)
+
+        budget = google_maps_scraper.QuotaBudget({'geocode': 100, 'elevation': 100},
+                                                 os.path.join(self.directory, 'quota.json'))
+        self.assertEqual(budget.used, self.server.counts)
+        self.assertEqual(os.listdir(self.directory), ['quota.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
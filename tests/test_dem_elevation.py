@@ -0,0 +1,141 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import dem_elevation
+from dem_elevation import DemElevation
+
+# 3 samples square: a tile's corners and middles, half a degree apart
+SAMPLES = numpy.array([[10, 20, 30],
+                       [40, 50, 60],
+                       [70, 80, 90]], dtype=numpy.int16)
+
+
+def write_hgt(directory, name, samples=SAMPLES):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as hgt_fp:
+        hgt_fp.write(samples.astype('>i2').tostring())
+    return path
+
+
+def write_geotiff(path, byte_order, samples, tiepoint, scale, raster_type=None, nodata=None):
+    """
+    Write a single band, 16 bit GeoTIFF, in one strip.
+    """
+    rows, columns = samples.shape
+    geo_keys = [1, 1, 0, 0]
+    if raster_type is not None:
+        geo_keys = [1, 1, 0, 1, dem_elevation.GT_RASTER_TYPE_GEO_KEY, 0, 1, raster_type]
+    entries = [(256, 3, [columns]), (257, 3, [rows]), (258, 3, [16]), (259, 3, [1]), (273, 4, [0]),
+               (277, 3, [1]), (279, 4, [rows * columns * 2]), (284, 3, [1]), (339, 3, [2]),
+               (33550, 12, list(scale) + [0.0]), (33922, 12, list(tiepoint)), (34735, 3, geo_keys)]
+    if nodata is not None:
+        entries.append((42113, 2, str(nodata) + '\0'))
+    codes = {2: 'c', 3: 'H', 4: 'I', 12: 'd'}
+
+    def encode(kind, values):
+        return struct.pack(byte_order + codes[kind] * len(values), *values)
+
+    # the IFD, then the values that don't fit in it, then the samples
+    extra_start = 8 + 2 + len(entries) * 12 + 4
+    extra_length = sum(len(encode(kind, values)) for _, kind, values in entries if len(encode(kind, values)) > 4)
+    entries[4] = (273, 4, [extra_start + extra_length])
+
+    ifd = struct.pack(byte_order + 'H', len(entries))
+    extra = ''
+    for tag, kind, values in entries:
+        raw = encode(kind, values)
+        if len(raw) > 4:
+            ifd += struct.pack(byte_order + 'HHI', tag, kind, len(values)) + \
+                struct.pack(byte_order + 'I', extra_start + len(extra))
+            extra += raw
+        else:
+            ifd += struct.pack(byte_order + 'HHI', tag, kind, len(values)) + raw.ljust(4, '\0')
+    ifd += struct.pack(byte_order + 'I', 0)
+
+    with open(path, 'wb') as tiff_fp:
+        tiff_fp.write({'<': 'II', '>': 'MM'}[byte_order] + struct.pack(byte_order + 'HI', 42, 8))
+        tiff_fp.write(ifd + extra + samples.astype(byte_order + 'i2').tostring())
+
+
+class DemTileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hgt_bilinear(self):
+        tile = dem_elevation.read_hgt_header(write_hgt(self.directory, 'N37W123.hgt'))
+        self.assertEqual((tile.north, tile.south, tile.west, tile.east), (38, 37, -123, -122))
+        lats = numpy.array([38.0, 37.0, 37.75, 37.75, 37.5, 37.25])
+        lngs = numpy.array([-123.0, -122.0, -123.0, -122.75, -122.25, -122.5])
+        numpy.testing.assert_allclose(tile.sample(lats, lngs), [10, 90, 25, 30, 55, 65])
+
+    def test_nan_next_to_voids(self):
+        samples = SAMPLES.copy()
+        samples[0, 0] = dem_elevation.HGT_VOID
+        tile = dem_elevation.read_hgt_header(write_hgt(self.directory, 'N37W123.hgt', samples))
+        elevations = tile.sample(numpy.array([37.75, 37.75, 37.25, 37.0]), numpy.array([-122.75, -122.25, -122.75, -123.0]))
+        self.assertTrue(numpy.isnan(elevations[0]))
+        numpy.testing.assert_allclose(elevations[1:], [40, 60, 70])
+
+    def test_geotiff_headers(self):
+        samples = SAMPLES.copy()
+        for byte_order in '<>':
+            for raster_type, north, west in [(None, 37.75, -122.75),
+                                             (dem_elevation.RASTER_PIXEL_IS_AREA, 37.75, -122.75),
+                                             (dem_elevation.RASTER_PIXEL_IS_POINT, 38.0, -123.0)]:
+                path = os.path.join(self.directory, 'dem.tif')
+                write_geotiff(path, byte_order, samples, (0, 0, 0, -123.0, 38.0, 0), (0.5, 0.5),
+                              raster_type=raster_type, nodata=-32768)
+                tile = dem_elevation.read_tiff_header(path)
+                self.assertEqual((tile.north, tile.west, tile.rows, tile.columns), (north, west, 3, 3))
+                self.assertEqual((tile.lat_step, tile.lng_step, tile.dtype), (0.5, 0.5, byte_order + 'i2'))
+                self.assertEqual(tile.nodata, -32768)
+                numpy.testing.assert_allclose(tile.sample(numpy.array([north, north - 1]), numpy.array([west, west + 1])),
+                                              [10, 90])
+
+    def test_geotiff_tiepoint_away_from_the_corner(self):
+        path = os.path.join(self.directory, 'dem.tif')
+        write_geotiff(path, '<', SAMPLES, (1, 2, 0, -122.5, 37.0, 0), (0.5, 0.5),
+                      raster_type=dem_elevation.RASTER_PIXEL_IS_POINT)
+        tile = dem_elevation.read_tiff_header(path)
+        self.assertEqual((tile.north, tile.west, tile.nodata), (38.0, -123.0, None))
+
+
+class DemElevationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ['N37W123.hgt', 'N37W122.hgt', 'N38W123.hgt']:
+            write_hgt(self.directory, name)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_elevations_across_tiles(self):
+        dem = DemElevation(self.directory)
+        elevations = dem.elevations([37.5, 37.5, 38.5, 40.0], [-122.25, -121.25, -122.25, -122.0])
+        numpy.testing.assert_allclose(elevations[:3], [55, 55, 55])
+        self.assertTrue(numpy.isnan(elevations[3]))
+
+    def test_least_recently_used_tile_is_closed(self):
+        dem = DemElevation(self.directory, open_tiles=2)
+        tiles = dict((os.path.basename(tile.path), tile) for tile in dem.tiles)
+        for lat, lng in [(37.5, -122.5), (37.5, -121.5), (37.5, -122.5), (38.5, -122.5)]:
+            dem.elevations([lat], [lng])
+
+        self.assertEqual([os.path.basename(path) for path in dem.opened], ['N37W123.hgt', 'N38W123.hgt'])
+        self.assertIsNone(tiles['N37W122.hgt'].samples)
+        self.assertIsNotNone(tiles['N37W123.hgt'].samples)
+
+
+if __name__ == '__main__':
+    unittest.main()
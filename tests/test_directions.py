@@ -0,0 +1,67 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import google_maps_scraper
+from fake_google import AVENUES, CITY, STREETS, FakeGoogleMaps
+from polyline import decode_polyline
+
+# 11 legs: up 1st Ave, then along J St
+RUN = ['1st Ave and %s' % street for street in STREETS] + ['2nd Ave and J St', '3rd Ave and J St']
+
+
+class DirectionsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeGoogleMaps().start()
+        google_maps_scraper.GOOGLE_MAPS_API_BASE = self.server.api_base
+        google_maps_scraper.api_session.configure(max_retries=0)
+        google_maps_scraper.api_session.stats = {}
+        google_maps_scraper.api_session.budget = None
+        google_maps_scraper.fetch_store = None
+
+    def tearDown(self):
+        google_maps_scraper.api_session.budget = None
+        google_maps_scraper.api_session.session.close()
+        self.server.stop()
+
+    def test_runs_match_pairs(self):
+        along = google_maps_scraper.get_directions_along(RUN, CITY)
+        self.assertEqual(self.server.counts['directions'], 2)
+
+        pairs = [google_maps_scraper.get_directions_and_length(origin, destination, CITY)
+                 for origin, destination in zip(RUN, RUN[1:])]
+        self.assertEqual(along, pairs)
+        # built from the steps (via the middle of each leg), not the overview
+        for directions in along:
+            self.assertEqual(len(decode_polyline(directions['path'])), 3)
+        self.assertEqual(along[0]['length'], 222)
+
+    def test_failed_request_falls_back_to_pairs(self):
+        run = ['1st Ave and A St', '1st Ave and B St', 'Broken Rd and C St', '1st Ave and D St']
+        directions = google_maps_scraper.get_directions_along(run, CITY)
+
+        self.assertEqual(directions[0], google_maps_scraper.get_directions_and_length(run[0], run[1], CITY))
+        self.assertEqual(directions[1:], [None, None])
+        # the run, each of its legs, and the check of the first
+        self.assertEqual(self.server.counts['directions'], 5)
+
+    def test_lookup_defers_once_out_of_budget(self):
+        directory = tempfile.mkdtemp()
+        try:
+            google_maps_scraper.api_session.budget = google_maps_scraper.QuotaBudget(
+                {'directions': 1}, os.path.join(directory, 'quota.json'))
+            d_cache = {}
+            legs = zip(RUN[:4], RUN[1:4]) + [('%s and A St' % AVENUES[2], '%s and A St' % AVENUES[3])]
+            self.assertFalse(google_maps_scraper.lookup_directions(d_cache, legs, CITY))
+            self.assertEqual(sorted(d_cache), sorted('%s | %s' % leg for leg in legs[:3]))
+            self.assertEqual(self.server.counts['directions'], 1)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import google_maps_scraper
+from google_maps_scraper import FetchStore, normalize_intersection
+from fake_google import FakeGoogleMaps
+
+CITY_FILE = '''
+city = 'San Francisco, CA'
+regions = [
+    [
+        ['1st Ave', '2nd Ave', '3rd Ave'],
+        ['A St', 'B St', 'C St', 'Ambiguous St'],
+    ],
+]
+curved_roads = {
+    'B St': [('1st Ave', '3rd Ave')],
+}
+custom_paths = {
+    'Greenway': {'path': ['1st Ave and A St', '3rd Ave and C St'], 'type': 'path'},
+}
+'''
+
+DAY = 24 * 60 * 60
+
+
+class FetchStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = FetchStore(os.path.join(self.directory, 'store.sqlite'), ttl=DAY)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def age(self, seconds):
+        for table in ['geocodes', 'elevations', 'directions']:
+            with self.store.conn:
+                self.store.conn.execute('UPDATE %s SET fetched_at = fetched_at - ?' % table, (seconds,))
+
+    def test_names_are_normalized(self):
+        self.assertEqual(normalize_intersection('McAllister St and  Divisadero St'), 'divisadero st and mcallister st')
+        self.store.put_geocode('McAllister St and Divisadero St', 'San Francisco, CA', 'ok', 37.7, -122.4)
+        self.assertEqual(self.store.get_geocode('divisadero st and MCALLISTER ST', 'San Francisco, CA'),
+                         ('ok', 37.7, -122.4))
+        self.assertIsNone(self.store.get_geocode('Divisadero St and McAllister St', 'Oakland, CA'))
+
+        self.store.put_directions('B St and A St', 'C St and A St', 'San Francisco, CA', {'path': '??', 'length': 5})
+        self.assertEqual(self.store.get_directions('a st and b st', 'A St and C St', 'San Francisco, CA'),
+                         {'path': '??', 'length': 5})
+        # but directions have a way
+        self.assertIsNone(self.store.get_directions('A St and C St', 'A St and B St', 'San Francisco, CA'))
+        self.assertEqual((self.store.hits['geocode'], self.store.misses['geocode']), (1, 1))
+
+    def test_stale_entries_are_missing(self):
+        self.store.put_geocode('A St and B St', 'San Francisco, CA', 'not_intersection')
+        self.store.put_elevations({(37.7, -122.4): 12.5})
+        self.age(DAY - 60)
+        self.assertEqual(self.store.get_geocode('A St and B St', 'San Francisco, CA'), ('not_intersection', None, None))
+        self.assertEqual(self.store.get_elevations([(37.7, -122.4)]), {(37.7, -122.4): 12.5})
+        self.age(120)
+        self.assertIsNone(self.store.get_geocode('A St and B St', 'San Francisco, CA'))
+        self.assertEqual(self.store.get_elevations([(37.7, -122.4)]), {})
+
+        # fetching again replaces them
+        self.store.put_geocode('A St and B St', 'San Francisco, CA', 'not_intersection')
+        self.assertIsNotNone(self.store.get_geocode('A St and B St', 'San Francisco, CA'))
+
+
+class StoredBuildTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeGoogleMaps().start()
+        self.directory = tempfile.mkdtemp()
+        self.store = os.path.join(self.directory, 'store.sqlite')
+        self.city_file = os.path.join(self.directory, 'city.py')
+        with open(self.city_file, 'w') as city_fp:
+            city_fp.write(CITY_FILE)
+        google_maps_scraper.GOOGLE_MAPS_API_BASE = self.server.api_base
+
+    def tearDown(self):
+        google_maps_scraper.api_session.session.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def build(self, output, *flags):
+        output = os.path.join(self.directory, output)
+        args = google_maps_scraper.parser.parse_args(list(flags) + ['--max-retries', '0', '--store', self.store,
+                                                                    self.city_file, output, output + '.bad'])
+        google_maps_scraper.run_build(args)
+        with open(output) as output_fp:
+            city = json.load(output_fp)
+        del city['buildtimestamp'], city['buildtimereadable']
+        return city
+
+    def test_second_build_is_served_from_the_store(self):
+        first = self.build('first.json')
+        counts = dict(self.server.counts)
+        self.assertEqual(sorted(counts), ['directions', 'elevation', 'geocode'])
+
+        # a build of its own, with no output or bad address cache to go on
+        self.assertEqual(self.build('second.json'), first)
+        self.assertEqual(self.server.counts, counts)
+
+    def test_expired_entries_are_fetched_again(self):
+        first = self.build('first.json')
+        counts = dict(self.server.counts)
+        conn = sqlite3.connect(self.store)
+        with conn:
+            for table in ['geocodes', 'elevations', 'directions']:
+                conn.execute('UPDATE %s SET fetched_at = fetched_at - ?' % table, (2 * DAY,))
+        conn.close()
+
+        self.assertEqual(self.build('second.json', '--store-ttl', '1'), first)
+        self.assertEqual(self.server.counts, dict((endpoint, 2 * count) for endpoint, count in counts.iteritems()))
+
+
+if __name__ == '__main__':
+    unittest.main()
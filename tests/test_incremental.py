@@ -0,0 +1,117 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import google_maps_scraper
+from fake_google import FakeGoogleMaps
+
+CITY_FILE = '''
+city = 'San Francisco, CA'
+regions = [
+    [
+        ['1st Ave', '2nd Ave', '3rd Ave', '4th Ave'],
+        ['A St', 'B St', 'C St', 'Ambiguous St'],
+    ],
+    [
+        ['5th Ave', '6th Ave'],
+        ['D St', 'E St'%(more_streets)s],
+    ],%(more_regions)s
+]
+breaks = {
+    'B St': set(['3rd Ave']),
+}
+curved_roads = {
+    'A St': [('1st Ave', '3rd Ave')],%(more_curved_roads)s
+}
+custom_paths = {
+    'Greenway': {'path': ['1st Ave and A St', '2nd Ave and C St'], 'type': 'path'},
+}
+route_directives = [
+    ('A St', [('1st Ave', '3rd Ave', 'route')]),%(more_route_directives)s
+]
+tbds = {
+    'Somewhere': (37.71, -122.49),
+}
+'''
+
+FIRST = {'more_streets': '', 'more_regions': '', 'more_curved_roads': '', 'more_route_directives': ''}
+
+# a street more in a region, a new curved road and a new directive
+EDITED = {'more_streets': ", 'F St'", 'more_regions': '',
+          'more_curved_roads': "\n    'C St': [('2nd Ave', '4th Ave')],",
+          'more_route_directives': "\n    ('1st Ave', [('A St', 'C St', 'path')]),"}
+
+
+class IncrementalBuildTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeGoogleMaps().start()
+        self.directory = tempfile.mkdtemp()
+        google_maps_scraper.GOOGLE_MAPS_API_BASE = self.server.api_base
+
+    def tearDown(self):
+        google_maps_scraper.api_session.session.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def build(self, sections, output, *flags):
+        # a new city file each time, so a stale compiled one is never loaded
+        city_file = self.path('city%d.py' % len(os.listdir(self.directory)))
+        with open(city_file, 'w') as city_fp:
+            city_fp.write(CITY_FILE % sections)
+        args = google_maps_scraper.parser.parse_args(list(flags) + ['--max-retries', '0', city_file,
+                                                                    self.path(output), self.path(output + '.bad')])
+        return google_maps_scraper.run_build(args)
+
+    def load(self, output):
+        with open(self.path(output)) as output_fp:
+            city = json.load(output_fp)
+        del city['buildtimestamp'], city['buildtimereadable']
+        with open(self.path(output + '.bad')) as bad_fp:
+            return city, google_maps_scraper.load_bad_address_cache(bad_fp)
+
+    def pending(self, output):
+        with open(self.path(output + '.fingerprints.json')) as fingerprints_fp:
+            return set(tuple(key) for key in json.load(fingerprints_fp)['pending'])
+
+    def test_incremental_build_matches_a_full_one(self):
+        self.build(FIRST, 'incremental.json')
+        summary = self.build(EDITED, 'incremental.json', '--incremental')
+        # only the changed region's street pairs
+        self.assertEqual(summary['total_intersections'], 2 * 3)
+        self.build(EDITED, 'full.json')
+
+        self.assertEqual(self.load('incremental.json'), self.load('full.json'))
+        self.assertEqual(self.pending('incremental.json'), self.pending('full.json'))
+
+    def test_an_unchanged_build_fetches_nothing(self):
+        self.build(FIRST, 'city.json')
+        before = dict(self.server.counts)
+        summary = self.build(FIRST, 'city.json', '--incremental')
+        self.assertEqual(summary['total_intersections'], 0)
+        self.assertEqual(self.server.counts, before)
+
+    def test_pruned_pairs_stay_pending(self):
+        self.build(FIRST, 'city.json')
+        # pairs of parallel avenues, which --prune skips
+        avenues = dict(FIRST, more_regions="\n    [['1st Ave', '2nd Ave'], ['3rd Ave']],")
+        summary = self.build(avenues, 'city.json', '--incremental', '--prune')
+        self.assertEqual(summary['pruned'], 2)
+        self.assertEqual(self.pending('city.json'), set([('1st Ave', '3rd Ave'), ('2nd Ave', '3rd Ave')]))
+
+        # and are looked at again, without --prune
+        self.build(avenues, 'city.json', '--incremental')
+        self.assertEqual(self.pending('city.json'), set([]))
+        _, bad_address_cache = self.load('city.json')
+        self.assertIn('1st Ave and 3rd Ave', bad_address_cache['not_intersection'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import copy
+import json
+import os
+import pickle
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from fixture_city import city
+from intersection_registry import IntersectionRegistry
+
+
+class IntersectionRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.i_cache = city()['intersections']
+        self.registry = IntersectionRegistry.from_json(self.i_cache)
+
+    def test_round_trip(self):
+        self.assertEqual(self.registry.to_json(), self.i_cache)
+        self.assertEqual(json.dumps(self.registry.to_json(), sort_keys=True), json.dumps(self.i_cache, sort_keys=True))
+        self.assertEqual(json.dumps(self.registry['Golden Gate Park'], sort_keys=True),
+                         json.dumps(self.i_cache['Golden Gate Park'], sort_keys=True))
+
+    def test_delete_keeps_ids_dense(self):
+        for name in sorted(self.registry)[::2]:
+            del self.registry[name]
+        self.assertEqual(self.registry.to_json(), dict((name, self.i_cache[name]) for name in self.registry))
+        self.assertEqual([self.registry.ids[name] for name in self.registry.names], range(len(self.registry)))
+
+    def test_entries_are_read_only(self):
+        entry = self.registry['1st Ave and A St']
+        self.assertRaises(TypeError, entry.__setitem__, 'elevation', 99.0)
+        self.assertRaises(TypeError, entry.update, {'elevation': 99.0})
+        self.assertRaises(TypeError, entry.pop, 'elevation')
+        self.assertRaises(TypeError, entry.setdefault, 'name', '1st Ave and A St')
+        self.assertEqual(self.registry['1st Ave and A St'], self.i_cache['1st Ave and A St'])
+
+        # a whole entry is stored back
+        self.registry['1st Ave and A St'] = dict(entry, elevation=99.0)
+        self.assertEqual(self.registry.coordinates('1st Ave and A St')[2], 99.0)
+
+    def test_copies_of_entries_are_plain_dicts(self):
+        entry = self.registry['1st Ave and A St']
+        for duplicate in [copy.copy(entry), copy.deepcopy(entry), pickle.loads(pickle.dumps(entry, 2))]:
+            self.assertIs(type(duplicate), dict)
+            self.assertEqual(duplicate, entry)
+            duplicate['elevation'] = 99.0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import landmarks
+import routing_graph
+from bike_router import BikeRouter
+from fixture_city import city
+
+
+class LandmarksTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = routing_graph.build_routing_graph(city())
+        self.landmarks = landmarks.compute_landmarks(self.graph, 3)
+        offsets = self.graph.offsets.tolist()
+        targets = self.graph.targets.tolist()
+        costs = self.graph.cost.tolist()
+        self.distances = [landmarks.dijkstra(offsets, targets, costs, node) for node in range(len(self.graph.nodes))]
+
+    def test_bounds_are_lower_bounds(self):
+        for start in range(len(self.graph.nodes)):
+            for goal in range(len(self.graph.nodes)):
+                bound = self.landmarks.lower_bound(start, goal, active=2)
+                for node in range(len(self.graph.nodes)):
+                    self.assertLessEqual(bound(node), self.distances[node][goal] + 1e-9)
+
+    def test_routes_cost_the_same_as_dijkstra(self):
+        router = BikeRouter(self.graph, self.landmarks)
+        for origin_id, origin in enumerate(self.graph.nodes):
+            for destination_id, destination in enumerate(self.graph.nodes):
+                route = router.route(origin, destination)
+                expected = self.distances[origin_id][destination_id]
+                if expected == landmarks.INF:
+                    self.assertIsNone(route)
+                else:
+                    self.assertAlmostEqual(route['cost'], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
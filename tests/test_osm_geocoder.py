@@ -0,0 +1,102 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import osm_geocoder
+from osm_geocoder import OsmExtractException, OsmGeocoder
+
+# Two towns, 0.1 degrees apart, each with a Main Street crossing 1st and
+# 2nd Street, and a divided Oak Avenue crossing 1st Street twice in Northtown.
+TWO_TOWNS = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="37.800" lon="-122.400"/>
+  <node id="2" lat="37.800" lon="-122.398"/>
+  <node id="3" lat="37.802" lon="-122.400"/>
+  <node id="4" lat="37.802" lon="-122.398"/>
+  <node id="5" lat="37.8001" lon="-122.3970"/>
+  <node id="6" lat="37.8002" lon="-122.3969"/>
+  <node id="7" lat="37.801" lon="-122.399"><tag k="place" v="town"/><tag k="name" v="Northtown"/></node>
+  <node id="11" lat="37.700" lon="-122.400"/>
+  <node id="12" lat="37.700" lon="-122.398"/>
+  <node id="17" lat="37.701" lon="-122.399"><tag k="place" v="village"/><tag k="name" v="Southtown"/></node>
+  <node id="18" lat="37.7005" lon="-122.3995"><tag k="name" v="Town Hall"/></node>
+  <node id="19" lat="37.8005" lon="-122.3995"><tag k="name" v="Town Hall"/></node>
+  <way id="1"><nd ref="1"/><nd ref="2"/><nd ref="5"/><tag k="highway" v="residential"/><tag k="name" v="1st Street"/></way>
+  <way id="2"><nd ref="3"/><nd ref="4"/><tag k="highway" v="residential"/><tag k="name" v="2nd Street"/></way>
+  <way id="3"><nd ref="1"/><nd ref="3"/><tag k="highway" v="residential"/><tag k="name" v="Main Street"/></way>
+  <way id="4"><nd ref="2"/><nd ref="4"/><tag k="highway" v="residential"/><tag k="name" v="Elm Street"/></way>
+  <way id="5"><nd ref="5"/><nd ref="6"/><tag k="highway" v="primary"/><tag k="name" v="Oak Avenue"/></way>
+  <way id="6"><nd ref="6"/><nd ref="5"/><tag k="highway" v="primary"/><tag k="name" v="Oak Avenue"/></way>
+  <way id="11"><nd ref="11"/><nd ref="12"/><tag k="highway" v="residential"/><tag k="name" v="1st Street"/></way>
+  <way id="13"><nd ref="11"/><tag k="highway" v="residential"/><tag k="name" v="Main Street"/></way>
+  <way id="14"><nd ref="12"/><tag k="highway" v="residential"/><tag k="name" v="Pine St"/></way>
+</osm>
+'''
+
+NORTHTOWN = (37.75, -122.45, 37.85, -122.35)
+
+
+class OsmGeocoderTest(unittest.TestCase):
+    def setUp(self):
+        self.geocoder = OsmGeocoder.from_extract(StringIO(TWO_TOWNS))
+
+    def test_intersections(self):
+        north = self.geocoder.within(*NORTHTOWN)
+        self.assertEqual(north.geocode('Main St and 2nd St'), ('ok', 37.802, -122.400))
+        self.assertEqual(north.geocode('2nd Street and Main Street'), ('ok', 37.802, -122.400))
+        self.assertEqual(north.geocode('Main St and Elm St')[0], 'not_intersection')
+        self.assertEqual(north.geocode('Main St and Main St')[0], 'not_intersection')
+        # a divided road meets 1st St twice, close together
+        status, lat, lng = north.geocode('Oak Ave and 1st St')
+        self.assertEqual(status, 'ok')
+        self.assertAlmostEqual(lat, 37.8001)
+        self.assertAlmostEqual(lng, -122.3970)
+
+    def test_several_towns_are_ambiguous_without_bounds(self):
+        self.assertEqual(sorted(self.geocoder.places), ['Northtown', 'Southtown'])
+        self.assertEqual(self.geocoder.geocode('Main St and 1st St')[0], 'ambiguous')
+        self.assertRaises(OsmExtractException, self.geocoder.check_single_city, 'Northtown, CA')
+
+    def test_bounds_pick_the_town(self):
+        north = self.geocoder.within(*NORTHTOWN)
+        south = self.geocoder.within(37.65, -122.45, 37.75, -122.35)
+        self.assertEqual(north.geocode('Main St and 1st St'), ('ok', 37.800, -122.400))
+        self.assertEqual(south.geocode('Main St and 1st St'), ('ok', 37.700, -122.400))
+        self.assertEqual(south.geocode('Pine St and 1st St'), ('ok', 37.700, -122.398))
+        self.assertEqual(north.geocode('Pine St and 1st St')[0], 'not_intersection')
+        self.assertEqual(north.geocode('Town Hall'), ('ok', 37.8005, -122.3995))
+        self.assertEqual(self.geocoder.geocode('Town Hall')[0], 'ambiguous')
+        self.assertEqual(north.nearest(37.7001, -122.4001), None)
+        north.check_single_city('Northtown, CA')
+
+    def test_bounds_over_many_cells(self):
+        # more cells than the grid holds, so every cell is looked at instead
+        world = self.geocoder.within(-90, -180, 90, 180)
+        self.assertEqual(world.intersections, self.geocoder.intersections)
+        # and just the row of them along 2nd Street
+        self.assertEqual(sorted(self.geocoder.within(37.8015, -122.45, 37.85, -122.35).intersections),
+                         [('2nd street', 'elm street'), ('2nd street', 'main street')])
+
+    def test_index_is_pickled_next_to_the_extract(self):
+        directory = tempfile.mkdtemp()
+        try:
+            extract = os.path.join(directory, 'towns.osm')
+            with open(extract, 'w') as extract_fp:
+                extract_fp.write(TWO_TOWNS)
+            parsed = OsmGeocoder.load(extract)
+            self.assertTrue(os.path.exists(extract + osm_geocoder.INDEX_SUFFIX))
+            loaded = OsmGeocoder.load(extract)
+            self.assertEqual(loaded.intersections, parsed.intersections)
+            self.assertEqual(loaded.places, parsed.places)
+            self.assertEqual(loaded.within(*NORTHTOWN).geocode('Main St and 1st St'), ('ok', 37.800, -122.400))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import google_maps_scraper
+from intersection_registry import IntersectionRegistry
+
+# About 176 m between avenues, and 222 m between streets
+GRID_STEP = 0.002
+
+
+def shape(*points):
+    return numpy.array(points, dtype=numpy.float64)
+
+
+def grid_cache():
+    """
+    1st, 2nd and 3rd Ave, known where they cross A and B St, and Far St a
+    kilometer north, known only where it crosses two avenues further east.
+    """
+    registry = IntersectionRegistry()
+    paths = {}
+    for column, avenue in enumerate(['1st Ave', '2nd Ave', '3rd Ave']):
+        for row, street in enumerate(['A St', 'B St']):
+            name = '%s and %s' % (avenue, street)
+            registry[name] = {'lat': 37.7 + row * GRID_STEP, 'lng': -122.5 + column * GRID_STEP, 'elevation': 0.0}
+            paths.setdefault(avenue, []).append(name)
+            paths.setdefault(street, []).append(name)
+    for column, avenue in [(5, '6th Ave'), (6, '7th Ave')]:
+        name = '%s and Far St' % avenue
+        registry[name] = {'lat': 37.71, 'lng': -122.5 + column * GRID_STEP, 'elevation': 0.0}
+        paths.setdefault('Far St', []).append(name)
+    return {'intersections': registry, 'paths': paths, 'directions': {}}
+
+
+class PolylineDistanceTest(unittest.TestCase):
+    def test_segment_distances(self):
+        points = shape((5, 5), (-3, 4), (13, 4), (3, 4))
+        distances = google_maps_scraper.segment_distances(points, shape((0, 0), (0, 0)), shape((10, 0), (0, 0)))
+        self.assertEqual(distances.shape, (4, 2))
+        # along the segment, past either end of it, and to a segment of no length
+        numpy.testing.assert_allclose(distances[:, 0], [5, 5, 5, 4])
+        numpy.testing.assert_allclose(distances[:, 1], [numpy.hypot(5, 5), 5, numpy.hypot(13, 4), 5])
+
+    def test_crossing(self):
+        self.assertEqual(google_maps_scraper.polyline_distance(shape((0, 0), (10, 10)), shape((0, 10), (10, 0))), 0.0)
+        zigzag = shape((0, 0), (10, 10), (20, 0), (30, 10))
+        self.assertEqual(google_maps_scraper.polyline_distance(zigzag, shape((25, -5), (25, 20))), 0.0)
+
+    def test_parallel(self):
+        self.assertAlmostEqual(google_maps_scraper.polyline_distance(shape((0, 0), (100, 0)),
+                                                                     shape((0, 30), (50, 30), (100, 30))), 30)
+        # on the same line, but apart
+        self.assertAlmostEqual(google_maps_scraper.polyline_distance(shape((0, 0), (10, 0)),
+                                                                     shape((20, 0), (30, 0))), 10)
+
+    def test_touching_at_an_end(self):
+        self.assertEqual(google_maps_scraper.polyline_distance(shape((0, 0), (10, 0)), shape((10, 0), (10, 10))), 0.0)
+        self.assertEqual(google_maps_scraper.polyline_distance(shape((0, 0), (10, 0)), shape((5, 0), (5, 10))), 0.0)
+
+    def test_single_segments_apart(self):
+        self.assertAlmostEqual(google_maps_scraper.polyline_distance(shape((0, 0), (0, 10)), shape((10, 5), (20, 5))), 10)
+
+    def test_extend_polyline(self):
+        extended = google_maps_scraper.extend_polyline(shape((0, 0), (0, 0), (3, 4), (3, 4)), 10)
+        numpy.testing.assert_allclose(extended, [(-6, -8), (0, 0), (0, 0), (3, 4), (3, 4), (9, 12)])
+
+
+class PruneIntersectionsTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = grid_cache()
+
+    def test_parallel_streets_are_pruned(self):
+        keys = [('1st Ave', '2nd Ave'), ('2nd Ave', '3rd Ave'), ('A St', 'B St')]
+        kept, pruned = google_maps_scraper.prune_intersections(self.cache, keys)
+        self.assertEqual((kept, pruned), (set([]), set(keys)))
+
+    def test_crossing_streets_are_kept(self):
+        keys = [('1st Ave', 'A St'), ('3rd Ave', 'B St')]
+        kept, pruned = google_maps_scraper.prune_intersections(self.cache, keys)
+        self.assertEqual((kept, pruned), (set(keys), set([])))
+
+    def test_streets_run_on_past_their_known_ends(self):
+        # 1st Ave is only known up to B St, and Far St only east of 6th Ave,
+        # but carried on, they meet
+        kept, pruned = google_maps_scraper.prune_intersections(self.cache, [('1st Ave', 'Far St')])
+        self.assertEqual((kept, pruned), (set([('1st Ave', 'Far St')]), set([])))
+
+        # unless they are kept to their known ends
+        polylines = google_maps_scraper.street_polylines(self.cache, ['1st Ave', 'Far St'], reach=0)
+        self.assertGreater(google_maps_scraper.polyline_distance(polylines['1st Ave'], polylines['Far St']), 800)
+
+    def test_streets_without_a_shape_are_kept(self):
+        keys = [('1st Ave', 'Nowhere St'), ('Nowhere St', 'Somewhere St')]
+        kept, pruned = google_maps_scraper.prune_intersections(self.cache, keys)
+        self.assertEqual((kept, pruned), (set(keys), set([])))
+
+    def test_conservative(self):
+        keys = [('1st Ave', '2nd Ave'), ('1st Ave', '3rd Ave'), ('A St', 'Far St')]
+        kept, pruned = google_maps_scraper.prune_intersections(self.cache, keys, margin=100)
+        self.assertEqual(pruned, set(keys))
+        # 1st and 2nd Ave are 176 m apart, so their boxes, grown by 100 m, overlap
+        kept, pruned = google_maps_scraper.prune_intersections(self.cache, keys, margin=100, conservative=True)
+        self.assertEqual(kept, set([('1st Ave', '2nd Ave')]))
+
+        # and a cached pair is never dropped, however far apart
+        self.cache['intersections']['1st Ave and 3rd Ave'] = {'lat': 37.7, 'lng': -122.5, 'elevation': 0.0}
+        kept, pruned = google_maps_scraper.prune_intersections(self.cache, keys, margin=100, conservative=True)
+        self.assertEqual(pruned, set([('A St', 'Far St')]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import json
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import routing_graph
+from fixture_city import city
+
+
+class RoutingGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = city()
+        self.graph = routing_graph.build_routing_graph(self.cache)
+
+    def edge(self, origin, target):
+        start, end = self.graph.edges(self.graph.index[origin])
+        for edge in range(start, end):
+            if self.graph.nodes[self.graph.targets[edge]] == target:
+                return edge
+        self.fail('no edge from %s to %s' % (origin, target))
+
+    def test_neighbors_match_get_neighbors(self):
+        self.assertEqual(sorted(self.graph.nodes), sorted(self.cache['intersections']))
+        for node in self.graph.nodes:
+            self.assertEqual(self.graph.neighbors(node), routing_graph.get_neighbors(self.cache, node), node)
+
+    def test_breaks_are_not_crossed(self):
+        self.assertEqual(self.graph.neighbors('2nd Ave and B St'),
+                         ['2nd Ave and A St', '3rd Ave and B St', '1st Ave and B St',
+                          '3rd Ave and C St', 'Golden Gate Park'])
+        self.assertEqual(self.graph.neighbors('2nd Ave and C St'), ['3rd Ave and C St', '1st Ave and C St'])
+
+    def test_custom_paths(self):
+        self.assertEqual(self.graph.neighbors('Golden Gate Park'), ['2nd Ave and B St', '1st Ave and A St'])
+        self.assertIn('Golden Gate Park', self.graph.neighbors('1st Ave and A St'))
+
+    def test_neighbors_match_get_neighbors_with_repeats(self):
+        # a custom path through the same intersection twice, and one that isn't in the paths
+        self.cache['paths']['Loop'] = ['1st Ave and B St', '2nd Ave and B St', '2nd Ave and C St',
+                                       '1st Ave and B St', '1st Ave and C St']
+        self.cache['custom_path_names'] += ['Loop', 'Missing']
+        graph = routing_graph.build_routing_graph(self.cache)
+        for node in graph.nodes:
+            self.assertEqual(graph.neighbors(node), routing_graph.get_neighbors(self.cache, node), node)
+
+    def test_edge_lengths_and_directives(self):
+        edge = self.edge('1st Ave and A St', 'Golden Gate Park')
+        self.assertEqual(self.graph.length[edge], 180)
+        self.assertEqual(routing_graph.DIRECTIVE_CLASSES[self.graph.directive[edge]], 'path')
+
+        # no directions the other way, but the directive goes both ways
+        edge = self.edge('Golden Gate Park', '1st Ave and A St')
+        gate = self.graph.coordinates(self.graph.index['Golden Gate Park'])
+        corner = self.graph.coordinates(self.graph.index['1st Ave and A St'])
+        self.assertAlmostEqual(self.graph.length[edge], routing_graph.distance_between(*(gate[:2] + corner[:2])))
+        self.assertEqual(routing_graph.DIRECTIVE_CLASSES[self.graph.directive[edge]], 'path')
+
+        # directions without a length
+        edge = self.edge('2nd Ave and B St', '2nd Ave and A St')
+        self.assertAlmostEqual(self.graph.length[edge], math.radians(0.002) * routing_graph.EARTH_RADIUS, places=3)
+        self.assertEqual(routing_graph.DIRECTIVE_CLASSES[self.graph.directive[edge]], 'standard')
+
+    def test_costs(self):
+        for node_id in range(len(self.graph.nodes)):
+            start, end = self.graph.edges(node_id)
+            for edge in range(start, end):
+                elevation_diff = self.graph.elevation[self.graph.targets[edge]] - self.graph.elevation[node_id]
+                self.assertAlmostEqual(self.graph.cost[edge], routing_graph.edge_cost(
+                    self.graph.length[edge], elevation_diff, self.graph.directive[edge]))
+
+    def test_json_round_trip(self):
+        data = json.loads(json.dumps(self.graph.to_json()))
+        self.assertEqual(routing_graph.RoutingGraph.from_json(data).to_json(), self.graph.to_json())
+
+
+if __name__ == '__main__':
+    unittest.main()
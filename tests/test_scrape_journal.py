@@ -0,0 +1,96 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import google_maps_scraper
+from fake_google import AVENUES, CITY, FakeGoogleMaps
+
+# grid intersections, a pair of avenues that never meet, and an ambiguous one
+INTERSECTIONS = [tuple(sorted([avenue, street])) for avenue in AVENUES[:3] for street in ['A St', 'B St']] + \
+    [('1st Ave', '2nd Ave'), ('1st Ave', 'Ambiguous St')]
+LEGS = [('1st Ave and A St', '1st Ave and B St'), ('2nd Ave and A St', '2nd Ave and B St')]
+
+
+class ScrapeJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeGoogleMaps().start()
+        self.directory = tempfile.mkdtemp()
+        self.journal_file = os.path.join(self.directory, 'city.json.journal')
+        google_maps_scraper.GOOGLE_MAPS_API_BASE = self.server.api_base
+        google_maps_scraper.api_session.configure(max_retries=0)
+        google_maps_scraper.api_session.stats = {}
+
+    def tearDown(self):
+        google_maps_scraper.api_session.session.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def empty_caches(self):
+        return {'intersections': {}, 'paths': {}, 'directions': {}}, google_maps_scraper.create_empty_bad_address_cache()
+
+    def interrupted_build(self):
+        """
+        Look up half the intersections and the directions, journaling them,
+        then stop without writing any output, mid-way through an entry.
+        """
+        cache, bad_address_cache = self.empty_caches()
+        journal = google_maps_scraper.ScrapeJournal(self.journal_file)
+        google_maps_scraper.lookup_all_intersections(cache, INTERSECTIONS[:4] + INTERSECTIONS[6:], bad_address_cache,
+                                                     CITY, journal=journal)
+        google_maps_scraper.lookup_directions(cache['directions'], LEGS, CITY, journal=journal)
+        journal.close()
+        with open(self.journal_file, 'a') as journal_fp:
+            journal_fp.write('{"intersection": "3rd Ave and A St", "val')
+        return cache, bad_address_cache
+
+    def replay(self):
+        cache, bad_address_cache = self.empty_caches()
+        with open(self.journal_file) as journal_fp:
+            replayed = google_maps_scraper.replay_journal(journal_fp, cache, bad_address_cache)
+        return cache, bad_address_cache, replayed
+
+    def test_replay_gives_back_what_was_fetched(self):
+        fetched_cache, fetched_bad_address_cache = self.interrupted_build()
+        cache, bad_address_cache, replayed = self.replay()
+
+        # 4 good, 2 bad and 2 directions; not the partial last line
+        self.assertEqual(replayed, 8)
+        self.assertEqual(cache, fetched_cache)
+        self.assertEqual(bad_address_cache, fetched_bad_address_cache)
+        self.assertEqual(bad_address_cache['ambiguous'], set(['1st Ave and Ambiguous St']))
+
+    def test_nothing_replayed_is_fetched_again(self):
+        self.interrupted_build()
+        counts = dict(self.server.counts)
+        cache, bad_address_cache, _ = self.replay()
+
+        _, _, stats = google_maps_scraper.lookup_all_intersections(cache, INTERSECTIONS, bad_address_cache, CITY)
+        self.assertEqual(google_maps_scraper.lookup_directions(cache['directions'], LEGS, CITY), True)
+        self.assertEqual((stats['cached'], stats['skipped'], stats['good']), (4, 2, 2))
+        # only the two intersections the interrupted build never reached
+        self.assertEqual(self.server.counts['geocode'], counts['geocode'] + 2)
+        self.assertEqual(self.server.counts['directions'], counts['directions'])
+
+    def test_journal_after_a_partial_line(self):
+        self.interrupted_build()
+        journal = google_maps_scraper.ScrapeJournal(self.journal_file)
+        journal.record_bad_address('not_intersection', '2nd Ave and 3rd Ave')
+        journal.close()
+
+        _, bad_address_cache, replayed = self.replay()
+        self.assertEqual(replayed, 9)
+        self.assertIn('2nd Ave and 3rd Ave', bad_address_cache['not_intersection'])
+
+    def test_journal_is_removed_once_written_out(self):
+        journal = google_maps_scraper.ScrapeJournal(self.journal_file)
+        journal.record_directions('%s | %s' % LEGS[0], None)
+        journal.remove()
+        self.assertFalse(os.path.exists(self.journal_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
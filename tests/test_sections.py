@@ -0,0 +1,97 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import google_maps_scraper
+from fixture_city import city
+
+CITY_FILE = '''
+city = 'San Francisco, CA'
+regions = []
+curved_roads = {
+    '3rd Ave': [('B St', 'A St'), ('A St', 'Z St')],
+    'Nowhere Rd': [('A St', 'B St')],
+}
+route_directives = [
+    ('A St', [('1st Ave', '2nd Ave', 'route'), ('2nd Ave', '3rd Ave', 'path'), ('1st Ave', '1st Ave', 'route')]),
+]
+'''
+
+
+class WarningsCaught(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class ResolveSectionsTest(unittest.TestCase):
+    def setUp(self):
+        self.paths = city()['paths']
+
+    def resolve(self, path, sections):
+        unresolved = []
+        resolved = list(google_maps_scraper.resolve_sections(self.paths[path], path, sections, unresolved))
+        return resolved, unresolved
+
+    def test_sections_end_to_end(self):
+        # the second section starts where the first ended
+        sections = [('1st Ave', '2nd Ave'), ('2nd Ave', '3rd Ave')]
+        self.assertEqual(self.resolve('A St', sections), ([(0, 1, sections[0]), (1, 2, sections[1])], []))
+
+    def test_ends_in_either_order(self):
+        self.assertEqual(self.resolve('A St', [('3rd Ave', '1st Ave', 'path')]),
+                         ([(0, 2, ('3rd Ave', '1st Ave', 'path'))], []))
+
+    def test_unresolved_sections_are_reported(self):
+        sections = [('1st Ave', '9th Ave'), ('2nd Ave', '2nd Ave'), ('2nd Ave', '3rd Ave')]
+        resolved, unresolved = self.resolve('A St', sections)
+        # and ones after them still resolve
+        self.assertEqual(resolved, [(1, 2, sections[2])])
+        self.assertEqual(unresolved, [('A St', sections[0]), ('A St', sections[1])])
+
+    def test_curved_road_legs_stop_at_breaks(self):
+        legs = list(google_maps_scraper.curved_road_legs(self.paths, {'2nd Ave': [('C St', 'A St')]}))
+        self.assertEqual(legs, [('2nd Ave and A St', '2nd Ave and B St')])
+
+
+class UnresolvedSectionsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        city_file = os.path.join(self.directory, 'city.py')
+        with open(city_file, 'w') as city_fp:
+            city_fp.write(CITY_FILE)
+        self.city_data = google_maps_scraper.CityDefinition(city_file)
+        self.warnings = WarningsCaught()
+        logging.getLogger().addHandler(self.warnings)
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.warnings)
+        shutil.rmtree(self.directory)
+
+    def test_curved_road_sections(self):
+        cache = city()
+        directions = dict(cache['directions'])
+        # its one leg is already cached, so nothing is fetched
+        google_maps_scraper.lookup_curved_road_directions(cache, self.city_data, self.city_data.city)
+        self.assertEqual(cache['directions'], directions)
+        self.assertEqual(sorted(self.warnings.messages),
+                         [' [unresolved curved road section] 3rd Ave: A St to Z St',
+                          ' [unresolved curved road section] Nowhere Rd: A St to B St'])
+
+    def test_route_directive_sections(self):
+        cache, _ = google_maps_scraper.define_route_directives(city(), self.city_data)
+        self.assertEqual(cache['route_directives'], {'1st Ave and A St | 2nd Ave and A St': 'route',
+                                                     '2nd Ave and A St | 3rd Ave and A St': 'path'})
+        self.assertEqual(self.warnings.messages, [' [unresolved route directive section] A St: 1st Ave to 1st Ave'])
+
+
+if __name__ == '__main__':
+    unittest.main()